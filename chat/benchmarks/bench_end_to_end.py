@@ -0,0 +1,426 @@
+# End-to-end benchmark: N concurrent users drive the gateway (spa/SPA.py), which
+# routes to the chat service (deepseek.py) backed by a fake streaming LLM and an
+# in-memory Supabase. Everything runs locally, no credentials are needed.
+#
+# Run from the chat directory:
+#   python -m benchmarks.bench_end_to_end --users 20 --turns 3
+#
+# Each run is saved as JSON under benchmarks/results/ and compared with the
+# latest earlier run of the same configuration (or --baseline), so regressions
+# between commits stand out.
+import argparse
+import datetime
+import glob
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import jwt
+import requests
+from tests.fake_openai import FakeOpenAIServer
+
+CHAT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPA_DIR = os.path.join(os.path.dirname(CHAT_DIR), "spa")
+RESULTS_DIR = os.path.join(CHAT_DIR, "benchmarks", "results")
+SECRET = "bench_secret"
+
+# The chat service and the gateway both import a top-level `utils` package, so
+# each runs in its own process
+SPA_SERVER = (
+    "import sys\n"
+    "from SPA import app\n"
+    "app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)\n"
+)
+
+# A figure this much worse than the baseline is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+# (path in the results, True when higher is better)
+TRACKED = [
+    (("throughput", "turns_per_second"), True),
+    (("ttft_ms", "p50"), False),
+    (("ttft_ms", "p95"), False),
+    (("ttft_ms", "p99"), False),
+    (("latency_ms", "send_message", "p95"), False),
+    (("latency_ms", "chat_history", "p95"), False),
+]
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _distribution(seconds):
+    return {
+        "count": len(seconds),
+        "mean": round(sum(seconds) / len(seconds) * 1000, 2) if seconds else None,
+        **{
+            name: (
+                None
+                if _percentile(seconds, q) is None
+                else round(_percentile(seconds, q) * 1000, 2)
+            )
+            for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+        },
+    }
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url, process, log_path, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"{url} exited with {process.returncode}, see {log_path}"
+            )
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not start within {timeout}s, see {log_path}")
+
+
+class Services:
+    """The chat service and the gateway, each in a subprocess."""
+
+    def __init__(self, llm_base_url, storage="memory"):
+        self.workdir = tempfile.mkdtemp(prefix="bench-e2e-")
+        self.processes = []
+        chat_port, spa_port = _free_port(), _free_port()
+        self.chat_url = f"http://127.0.0.1:{chat_port}"
+        self.spa_url = f"http://127.0.0.1:{spa_port}"
+
+        env = dict(os.environ)
+        env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        chat_env = dict(
+            env,
+            SECRET_KEY=SECRET,
+            SUPABASE_URL="http://in-memory",
+            SUPABASE_KEY="in-memory",
+            CLIENT_XUNFEI_BASE_URL=llm_base_url,
+            CLIENT_XUNFEI_API_KEY="bench",
+            LOAD_STATE_PATH=os.path.join(self.workdir, "load-state.json"),
+            LOAD_SAMPLE_INTERVAL="0",
+            COMPLETION_CACHE_BYTES="0",
+        )
+        if storage == "sqlite":
+            chat_env.update(
+                STORAGE_BACKEND="sqlite",
+                SQLITE_DB_PATH=os.path.join(self.workdir, "chat.sqlite3"),
+            )
+        spa_env = dict(
+            env, CHAT_SERVICE_URL1=self.chat_url, CHAT_SERVICE_URL2=self.chat_url
+        )
+        try:
+            self._start(
+                "chat",
+                [sys.executable, "-m", "benchmarks.e2e_chat_server", str(chat_port)],
+                CHAT_DIR,
+                chat_env,
+                f"{self.chat_url}/health",
+            )
+            self._start(
+                "spa",
+                [sys.executable, "-c", SPA_SERVER, str(spa_port)],
+                SPA_DIR,
+                spa_env,
+                f"{self.spa_url}/api/backends",
+            )
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, name, command, cwd, env, ready_url):
+        log_path = os.path.join(self.workdir, f"{name}.log")
+        with open(log_path, "wb") as log:
+            process = subprocess.Popen(
+                command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT
+            )
+        self.processes.append(process)
+        _wait_ready(ready_url, process, log_path)
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class Recorder:
+    """Latency samples and errors of every operation, shared by the users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.ttfts = []
+        self.errors = {}
+
+    def record(self, operation, seconds, ok, ttft=None):
+        with self.lock:
+            if not ok:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+                return
+            self.latencies.setdefault(operation, []).append(seconds)
+            if ttft is not None:
+                self.ttfts.append(ttft)
+
+
+def _user(spa_url, user_id, turns, recorder):
+    session = requests.Session()
+    token = jwt.encode(
+        {"user_id": user_id, "exp": int(time.time()) + 3600}, SECRET, algorithm="HS256"
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    chat_name = f"bench-{user_id}"
+
+    def timed(operation, send):
+        started = time.perf_counter()
+        try:
+            ok = send().status_code == 200
+        except requests.RequestException:
+            ok = False
+        recorder.record(operation, time.perf_counter() - started, ok)
+
+    timed(
+        "start_chat",
+        lambda: session.post(
+            f"{spa_url}/api/start_chat", json={"chat_name": chat_name}, headers=headers
+        ),
+    )
+    for turn in range(turns):
+        started = time.perf_counter()
+        ttft, ok = None, False
+        try:
+            response = session.post(
+                f"{spa_url}/api/send_message",
+                json={
+                    "message": f"Question {turn} of user {user_id}",
+                    "chat_name": chat_name,
+                },
+                headers=headers,
+                stream=True,
+            )
+            with response:
+                for chunk in response.iter_content(chunk_size=None):
+                    if chunk and ttft is None:
+                        ttft = time.perf_counter() - started
+            ok = response.status_code == 200 and ttft is not None
+        except requests.RequestException:
+            pass
+        recorder.record("send_message", time.perf_counter() - started, ok, ttft)
+        timed(
+            "chat_history",
+            lambda: session.get(
+                f"{spa_url}/api/chat_history",
+                params={"chat_name": chat_name},
+                headers=headers,
+            ),
+        )
+
+
+def run_benchmark(
+    users=20, turns=3, ttft=0.2, token_rate=50.0, reply_tokens=40, storage="memory"
+):
+    """
+    Run the scenario (start_chat, then `turns` times send_message and
+    chat_history) for `users` concurrent users and return the results.
+    `storage` is "memory" (tables in the chat process) or "sqlite".
+    """
+    llm = FakeOpenAIServer(
+        chunks=["token "] * reply_tokens, ttft=ttft, delay=1.0 / token_rate
+    )
+    services = None
+    try:
+        services = Services(llm.base_url, storage)
+        recorder = Recorder()
+        threads = [
+            threading.Thread(
+                target=_user, args=(services.spa_url, user, turns, recorder)
+            )
+            for user in range(1, users + 1)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+    finally:
+        if services is not None:
+            services.close()
+        llm.close()
+
+    completed = len(recorder.latencies.get("send_message", []))
+    requests_done = sum(len(samples) for samples in recorder.latencies.values())
+    return {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": _commit(),
+        "config": {
+            "users": users,
+            "turns": turns,
+            "ttft": ttft,
+            "token_rate": token_rate,
+            "reply_tokens": reply_tokens,
+            "storage": storage,
+        },
+        "wall_seconds": round(wall, 3),
+        "errors": recorder.errors,
+        "throughput": {
+            "requests_per_second": round(requests_done / wall, 2),
+            "turns_per_second": round(completed / wall, 2),
+            "tokens_per_second": round(completed * reply_tokens / wall, 2),
+        },
+        "ttft_ms": _distribution(recorder.ttfts),
+        "latency_ms": {
+            operation: _distribution(samples)
+            for operation, samples in sorted(recorder.latencies.items())
+        },
+    }
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=CHAT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(result, directory=RESULTS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(directory, f"e2e-{stamp}-{result['commit'] or 'nogit'}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def latest_baseline(config, directory=RESULTS_DIR, exclude=None):
+    """The most recent saved run with the same configuration, if any."""
+    for path in sorted(glob.glob(os.path.join(directory, "e2e-*.json")), reverse=True):
+        if path == exclude:
+            continue
+        with open(path) as f:
+            result = json.load(f)
+        if result.get("config") == config:
+            return path, result
+    return None, None
+
+
+def _lookup(result, keys):
+    for key in keys:
+        result = (result or {}).get(key)
+    return result
+
+
+def compare(baseline, result, threshold=REGRESSION_THRESHOLD):
+    """Rows of (figure, baseline, current, change, regressed) for TRACKED figures."""
+    rows = []
+    for keys, higher_is_better in TRACKED:
+        before, after = _lookup(baseline, keys), _lookup(result, keys)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        rows.append((".".join(keys), before, after, change, worse > threshold))
+    return rows
+
+
+def report(result):
+    config = result["config"]
+    print(
+        f"{config['users']} users x {config['turns']} turns, fake LLM "
+        f"ttft {config['ttft']}s at {config['token_rate']} tokens/s "
+        f"({config['reply_tokens']} tokens per reply), "
+        f"{config.get('storage', 'memory')} storage, commit {result['commit']}"
+    )
+    throughput = result["throughput"]
+    print(
+        f"  wall {result['wall_seconds']}s, {throughput['requests_per_second']} req/s, "
+        f"{throughput['turns_per_second']} turns/s, "
+        f"{throughput['tokens_per_second']} tokens/s, errors {result['errors'] or 0}"
+    )
+    rows = [("ttft", result["ttft_ms"])] + list(result["latency_ms"].items())
+    print(f"  {'ms':<14}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, d in rows:
+        print(
+            f"  {name:<14}{d['count']:>7}{d['p50'] or '-':>10}"
+            f"{d['p95'] or '-':>10}{d['p99'] or '-':>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of the gateway and the chat service"
+    )
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--ttft", type=float, default=0.2, help="fake LLM seconds")
+    parser.add_argument("--token-rate", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--storage", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--baseline", help="results file to compare with")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help=f"exit 1 if a figure is {REGRESSION_THRESHOLD:.0%} worse than the baseline",
+    )
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        args.users,
+        args.turns,
+        args.ttft,
+        args.token_rate,
+        args.reply_tokens,
+        args.storage,
+    )
+    report(result)
+    path = None if args.no_save else save(result)
+    if path:
+        print(f"Saved {path}")
+
+    if args.baseline:
+        baseline_path = args.baseline
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    else:
+        baseline_path, baseline = latest_baseline(result["config"], exclude=path)
+    if baseline is None:
+        print("No baseline with the same configuration to compare with")
+        return
+    print(f"Compared with {baseline_path} (commit {baseline.get('commit')}):")
+    regressed = False
+    for name, before, after, change, worse in compare(baseline, result):
+        regressed = regressed or worse
+        flag = "  REGRESSION" if worse else ""
+        print(f"  {name:<28}{before:>10}{after:>10}{change:>+9.1%}{flag}")
+    if regressed and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Benchmark of LLM slot scheduling when one heavy user floods the host: how long
+# the requests of light users wait for a slot, with a FIFO queue and with the
+# fair scheduler (per-user caps, lightest user first).
+# Run from the chat directory: python -m benchmarks.bench_fair_scheduling
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from utils.load_utils import AdmissionController, LoadSampler, SharedState
+
+
+def run(fair, slots, heavy_requests, light_users, hold):
+    """Wait times (seconds) of the light users' requests."""
+    with tempfile.TemporaryDirectory() as tmp:
+        state = SharedState(os.path.join(tmp, "load.json"))
+        admission = AdmissionController(
+            state,
+            LoadSampler(state, interval=0),
+            limit=slots,
+            queue_size=10000,
+            timeout=600,
+            poll_interval=0.002,
+            user_limit=max(1, slots // 2),
+            heavy_tokens=10000,
+            heavy_user_limit=1,
+        )
+        waits = []
+
+        def request(user, tokens, record):
+            started = time.perf_counter()
+            # Requests without a user are served in arrival order
+            slot = admission.acquire(user if fair else None)
+            if record:
+                waits.append(time.perf_counter() - started)
+            time.sleep(hold)
+            slot.release(tokens)
+
+        # The heavy user has been busy and floods the queue first
+        admission.acquire("heavy").release(50000)
+        threads = [
+            threading.Thread(target=request, args=("heavy", 2000, False))
+            for _ in range(heavy_requests)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(hold)
+        light = [
+            threading.Thread(target=request, args=(f"light{i}", 500, True))
+            for i in range(light_users)
+        ]
+        for thread in light:
+            thread.start()
+        for thread in threads + light:
+            thread.join()
+    return waits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slots", type=int, default=4)
+    parser.add_argument("--heavy-requests", type=int, default=40)
+    parser.add_argument("--light-users", type=int, default=8)
+    parser.add_argument("--hold", type=float, default=0.05)
+    args = parser.parse_args()
+
+    print(
+        f"{args.slots} slots, {args.heavy_requests} requests of a heavy user, "
+        f"{args.light_users} light users, {args.hold * 1000:.0f} ms per call"
+    )
+    for name, fair in [("FIFO", False), ("fair", True)]:
+        waits = sorted(
+            run(fair, args.slots, args.heavy_requests, args.light_users, args.hold)
+        )
+        p95 = waits[int(0.95 * (len(waits) - 1))]
+        print(
+            f"{name:<6} light user wait: median {statistics.median(waits) * 1000:7.1f}"
+            f" ms, p95 {p95 * 1000:7.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Benchmark of /search queries on the SQLite storage backend: latency of a
+# search over a user with many chats, next to a scan of all their messages.
+# Run from the chat directory: python -m benchmarks.bench_search
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from utils import db_utils
+from utils.storage_utils import SQLiteClient
+
+WORDS = (
+    "python asyncio profile cache kyoto temple database index query latency "
+    "stream token model reply gateway worker budget travel recipe garden music "
+    "history search ranking snippet offset chat message summary context window"
+).split()
+# Terms are suffixed with numbers like the generated words
+QUERIES = ["profile1 python1", "kyoto2 temple2", "latency3", "garden4 recipe4 music4"]
+
+
+def sentence(rng, words=30):
+    return " ".join(rng.choice(WORDS) + str(rng.randrange(50)) for _ in range(words))
+
+
+def populate(db, chats, turns, rng):
+    for chat in range(chats):
+        name = f"Chat {chat}"
+        db_utils.create_chat(db, 1, name)
+        for _ in range(turns):
+            conversation = db_utils.get_conversation(db, 1, name)
+            db_utils.update_database(
+                db,
+                conversation.data[0]["messages"],
+                sentence(rng, 12),
+                sentence(rng),
+                conversation,
+            )
+
+
+def scan(db, terms):
+    # What finding a message took without the index: read every message
+    rows = db.table("chat_messages").select("chat_id,seq,content").execute().data
+    return [row for row in rows if all(t in row["content"].lower() for t in terms)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = SQLiteClient(os.path.join(tmp, "chat.sqlite3"))
+        populate(db, args.chats, args.turns, rng)
+        print(f"{args.chats} chats, {args.chats * args.turns * 2} messages")
+        for name, run in [
+            ("search", lambda q: db_utils.search(db, 1, q)),
+            ("scan", lambda q: scan(db, q.split())),
+        ]:
+            started = time.perf_counter()
+            for _ in range(args.rounds):
+                for query in QUERIES:
+                    run(query)
+            seconds = (time.perf_counter() - started) / args.rounds / len(QUERIES)
+            print(f"{name:<8} {seconds * 1000:8.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Benchmark of the streaming path with and without chunk coalescing: buffer and
+# HTTP writes per reply, and CPU time per stream, for replies of small deltas.
+# Run from the chat directory: python -m benchmarks.bench_stream_coalescing
+import argparse
+import os
+import tempfile
+import threading
+import time
+import timeit
+
+from utils.stream_utils import StreamBuffer
+
+
+def deltas(tokens, interval):
+    # Provider deltas are a token or two, a few bytes each
+    for i in range(tokens):
+        if interval:
+            time.sleep(interval)
+        yield "tok " if i % 3 else "token, "
+
+
+def run(flush_bytes, streams, tokens, interval):
+    """Stream `streams` replies at once; return writes per reply and CPU per stream."""
+    with tempfile.TemporaryDirectory() as tmp:
+        buffer = StreamBuffer(
+            os.path.join(tmp, "streams.sqlite3"), flush_bytes=flush_bytes
+        )
+        appends, writes = [], []
+        append = buffer.append
+
+        def counted_append(stream_id, text):
+            appends.append(len(text))
+            append(stream_id, text)
+
+        buffer.append = counted_append
+
+        def reader(stream_id):
+            writes.extend(len(data) for data in buffer.follow(stream_id))
+
+        stream_ids = [buffer.create(i) for i in range(streams)]
+        threads = [
+            threading.Thread(target=reader, args=(stream_id,))
+            for stream_id in stream_ids
+        ] + [
+            threading.Thread(
+                target=buffer.pump, args=(stream_id, deltas(tokens, interval))
+            )
+            for stream_id in stream_ids
+        ]
+        cpu, wall = time.process_time(), time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    return {
+        "appends": len(appends) / streams,
+        "writes": len(writes) / streams,
+        "cpu_ms": cpu / streams * 1000,
+        "wall_s": wall,
+    }
+
+
+def accumulate(tokens):
+    # Building a long reply by concatenation versus joining a list of parts
+    chunks = list(deltas(tokens, 0))
+
+    def concatenate():
+        message = ""
+        for chunk in chunks:
+            message += chunk
+        return message
+
+    def join():
+        parts = []
+        for chunk in chunks:
+            parts.append(chunk)
+        return "".join(parts)
+
+    return {
+        "+=": timeit.timeit(concatenate, number=20) / 20,
+        "list": timeit.timeit(join, number=20) / 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--streams", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=500)
+    parser.add_argument("--interval", type=float, default=0.001)
+    args = parser.parse_args()
+
+    print(f"{args.streams} streams of {args.tokens} deltas, {args.interval}s apart")
+    print(f"{'':<20}{'appends':>10}{'writes':>10}{'CPU ms':>10}{'wall s':>10}")
+    for name, flush_bytes in [("per delta", 0), ("coalesced (32 B)", 32)]:
+        result = run(flush_bytes, args.streams, args.tokens, args.interval)
+        print(
+            f"{name:<20}{result['appends']:>10.0f}{result['writes']:>10.0f}"
+            f"{result['cpu_ms']:>10.1f}{result['wall_s']:>10.2f}"
+        )
+    for name, seconds in accumulate(100000).items():
+        print(f"accumulate 100k deltas with {name:<5} {seconds * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
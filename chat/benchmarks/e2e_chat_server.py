@@ -0,0 +1,16 @@
+# Chat service of the end-to-end benchmark: deepseek.py on a threaded server,
+# with the Supabase tables held in memory by this single process, or in a SQLite
+# file with STORAGE_BACKEND=sqlite.
+# Started by bench_end_to_end.py as: python -m benchmarks.e2e_chat_server PORT
+import sys
+
+import supabase
+from tests.fake_supabase import InMemorySupabaseClient
+
+database = InMemorySupabaseClient()
+supabase.create_client = lambda url, key, options=None: database
+
+import deepseek  # noqa: E402  (must see the patched create_client)
+
+if __name__ == "__main__":
+    deepseek.app.run(host="127.0.0.1", port=int(sys.argv[1]), threaded=True)
@@ -1,18 +1,43 @@
-from utils.chatbot_utils import ChatBot, is_system_under_high_load, combine_message
+from utils.chatbot_utils import ChatBot, SYSTEM_PROMPT, completion_cache
+from utils.context_utils import build_context
 from utils.db_utils import (
     check_chat_exists,
     create_chat,
+    export_chats,
+    import_chats,
+    ChatImporter,
     get_chat_history_list,
     get_conversation,
-    update_database,
+    get_chat_version,
+    get_messages_page,
+    parse_page_args,
+    empty_page,
+    queue_update_database,
+    search,
+    get_usage_summary,
+    write_behind,
+    usage_ledger,
 )
+from utils.idempotency_utils import (
+    idempotency,
+    fingerprint,
+    IdempotencyConflict,
+    IdempotencyPending,
+    MAX_KEY_LENGTH,
+)
+from utils.http_utils import make_etag, etag_matches, ndjson_lines, ndjson_records
+from utils.load_utils import admission, Overloaded
+from utils.metrics_utils import metrics_response
+from utils.stream_utils import stream_buffer, StreamGone
+from utils.storage_utils import SQLiteClient
+from utils.llm_pool_utils import LLMPool, llm_endpoints
 from utils.auth_utils import get_user_id_from_token, get_decoded_token
 from flask import Flask, request, jsonify, Response
 from openai import OpenAI
 import jwt
 from supabase import create_client
 import os
-
+import threading
 
 app = Flask(__name__)
 
@@ -22,17 +47,68 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "dummy_key")
 SECRET_KEY = os.environ.get("SECRET_KEY", "dummy_secret")
 
-supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Storage backend: "supabase" (hosted Postgres) or "sqlite" (embedded file at
+# SQLITE_DB_PATH, for single-node and edge deployments)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+SQLITE_DB_PATH = os.environ.get("SQLITE_DB_PATH", "chat.sqlite3")
+
+if STORAGE_BACKEND == "sqlite":
+    supabase_client = SQLiteClient(SQLITE_DB_PATH)
+elif STORAGE_BACKEND == "supabase":
+    supabase_client = create_client(SUPABASE_URL, SUPABASE_KEY)
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
 
 # create DeepSeek clients
 CLIENT_XUNFEI_API_KEY = os.environ.get("CLIENT_XUNFEI_API_KEY", "dummy_xunfei_key")
 CLIENT_XUNFEI_BASE_URL = os.environ.get("CLIENT_XUNFEI_BASE_URL")
-client_xunfei = OpenAI(api_key=CLIENT_XUNFEI_API_KEY, base_url=CLIENT_XUNFEI_BASE_URL)
+# Extra provider endpoints as comma separated "base_url|api_key" entries; the
+# pool routes to the fastest healthy one and fails over before the first token
+client_xunfei = LLMPool(
+    [
+        OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        for base_url, api_key in llm_endpoints(
+            CLIENT_XUNFEI_BASE_URL,
+            CLIENT_XUNFEI_API_KEY,
+            os.environ.get("LLM_ENDPOINTS"),
+        )
+    ],
+    max_attempts=int(os.environ.get("LLM_MAX_ATTEMPTS", "3")),
+    hedge=os.environ.get("LLM_HEDGE", "0") == "1",
+)
+
+
+def with_etag(response, etag):
+    response.headers["ETag"] = etag
+    # Browsers keep the body but revalidate it with If-None-Match on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def not_modified(etag):
+    return with_etag(Response(status=304), etag)
 
 
 @app.route("/health")
 def health():
-    return jsonify({"status": "ok"}), 200
+    status = {
+        "status": "ok",
+        "load": admission.snapshot(),
+        "write_behind": write_behind.stats(),
+        "usage_ledger": usage_ledger.stats(),
+    }
+    if isinstance(client_xunfei, LLMPool):
+        status["llm"] = client_xunfei.snapshot()
+    if completion_cache is not None:
+        status["completion_cache"] = completion_cache.stats()
+    return jsonify(status), 200
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics, summed over the workers of this host"""
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
 
 
 # start chat
@@ -76,7 +152,16 @@ def chat_list():
         # Retrieve the chat history list for the user
         response = get_chat_history_list(supabase_client, user_id)
 
-        return jsonify({"chats": [conv["name"] for conv in response.data]}), 200
+        # The list only changes when a chat is created or updated
+        etag = make_etag(
+            user_id,
+            sorted((c["name"], c.get("updated_at") or "") for c in response.data),
+        )
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified(etag)
+        return with_etag(
+            jsonify({"chats": [conv["name"] for conv in response.data]}), etag
+        )
 
     except jwt.ExpiredSignatureError:
         return jsonify({"message": "Token expired"}), 401
@@ -99,26 +184,195 @@ def chat_history():
         # Check if chat_name is provided
         if not chat_name:
             return jsonify({"message": "Chat name is required"}), 400
-        # Query the database for the user's specific chat history
-        conversation = get_conversation(supabase_client, user_id, chat_name)
-        if conversation.data:
-            messages = conversation.data[0].get("messages", {}).get("messages", [])
-            return (
-                jsonify({"messages": messages}),
-                200,
-            )  # Ensure that the returned value is a list
-        else:
-            return jsonify({"messages": []}), 200
+        try:
+            page_args = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        chat = get_chat_version(supabase_client, user_id, chat_name)
+        if chat is None:
+            return jsonify(empty_page()), 200
+        # The version changes with every appended message
+        etag = make_etag(
+            chat["id"],
+            chat["message_count"],
+            chat.get("updated_at"),
+            sorted(page_args.items()),
+        )
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified(etag)
+        # Query one page of the user's specific chat history, newest first
+        page = get_messages_page(
+            supabase_client, user_id, chat_name, chat=chat, **page_args
+        )
+        return with_etag(jsonify(page), etag)
 
     except Exception as e:
         print(f"Error in chat_history: {e}")  # Log the error
         # return jsonify({"message": "Internal Server Error", "error": str(e)}), 500
 
 
+# search the messages of all the user's chats
+@app.route("/search", methods=["GET"])
+def search_messages():
+    """Return the messages best matching `q`, with chat name, seq and snippet"""
+    try:
+        user_id = get_user_id_from_token(SECRET_KEY)
+        query = request.args.get("q", "").strip()
+        if not query:
+            return jsonify({"message": "Query is required"}), 400
+        limit = request.args.get("limit", "")
+        if limit and not limit.isdigit():
+            return jsonify({"message": "Invalid limit"}), 400
+        limit = int(limit) if limit else None
+        results = search(supabase_client, user_id, query, limit)
+        return jsonify({"query": query, "results": results}), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# export all the user's chats
+@app.route("/export", methods=["GET"])
+def export():
+    """Stream every chat of the user and its messages as NDJSON records"""
+    try:
+        user_id = get_user_id_from_token(SECRET_KEY)
+        # Read page by page while the response is sent, in constant memory
+        return Response(
+            ndjson_lines(export_chats(supabase_client, user_id)),
+            mimetype="application/x-ndjson",
+            headers={"Content-Disposition": 'attachment; filename="chats.ndjson"'},
+        )
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# import chats from an export
+@app.route("/import", methods=["POST"])
+def import_chat_export():
+    """
+    Write the chats of an NDJSON export streamed in the body, in batches. Chats
+    already there are resumed; `resume_from` skips the chats before that one.
+    """
+    try:
+        user_id = get_user_id_from_token(SECRET_KEY)
+        importer = ChatImporter(user_id, request.args.get("resume_from"))
+        try:
+            lines = iter(request.stream.readline, b"")
+            progress = import_chats(supabase_client, importer, ndjson_records(lines))
+        except ValueError as e:
+            return jsonify({"message": str(e), **importer.progress()}), 400
+        return jsonify(progress), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# token usage of the user
+@app.route("/usage", methods=["GET"])
+def usage():
+    """Return the user's token usage per day and per chat, and their limits"""
+    try:
+        user_id = get_user_id_from_token(SECRET_KEY)
+        days = request.args.get("days", "")
+        if days and not days.isdigit():
+            return jsonify({"message": "Invalid days"}), 400
+        days = int(days) if days else None
+        summary = get_usage_summary(supabase_client, user_id, days)
+        return jsonify({**summary, "limits": admission.limits(user_id)}), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# resume a streamed reply
+@app.route("/stream/<stream_id>", methods=["GET"])
+def resume_stream(stream_id):
+    """Stream the rest of a reply from the byte `offset` the client already has"""
+    try:
+        user_id = get_user_id_from_token(SECRET_KEY)
+        offset = request.args.get("offset", "0")
+        info = stream_buffer.info(stream_id)
+        if info is None or info["user_id"] != str(user_id):
+            return jsonify({"message": "Stream not found"}), 404
+        if not offset.isdigit() or int(offset) > info["total"]:
+            return jsonify({"message": "Invalid offset"}), 400
+        offset = int(offset)
+        stream_buffer.read(stream_id, offset)  # Raises if no longer buffered
+        return Response(
+            stream_buffer.follow(stream_id, offset),
+            content_type="text/plain;charset=utf-8",
+            headers={"X-Stream-Id": stream_id},
+        )
+
+    except ValueError:
+        return jsonify({"message": "Authorization token is missing"}), 401
+    except StreamGone as e:
+        return jsonify({"message": str(e)}), 410
+    except KeyError:
+        return jsonify({"message": "Stream not found"}), 404
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+
+
+def account(slot, chatbot, user_id, chat_name, context):
+    """Release the LLM slot of a call and record the tokens it used."""
+    prompt_tokens, completion_tokens = chatbot.tokens_used(context.prompt_tokens)
+    slot.release(prompt_tokens + completion_tokens)
+    usage_ledger.record(
+        supabase_client, user_id, chat_name, prompt_tokens, completion_tokens
+    )
+
+
+def replay(record, stream):
+    """The response of the request holding an Idempotency-Key, for a retry."""
+    headers = {"Idempotent-Replayed": "true"}
+    if record["done"]:
+        if stream:
+            return Response(
+                record["reply"],
+                content_type="text/plain;charset=utf-8",
+                headers=headers,
+            )
+        return jsonify({"message": record["reply"]}), 200, headers
+    # Still generating: follow the reply from its start, like a resume
+    stream_id = record["stream_id"]
+    try:
+        stream_buffer.read(stream_id, 0)
+    except (StreamGone, KeyError):
+        raise IdempotencyPending("The original request is still running") from None
+    return Response(
+        stream_buffer.follow(stream_id),
+        content_type="text/plain;charset=utf-8",
+        headers={**headers, "X-Stream-Id": stream_id},
+    )
+
+
 # send message
 @app.route("/send_message", methods=["POST"])
 def send_message():
     """Handle the /send_message request to send a message to deepseek."""
+    # Set while this request holds an Idempotency-Key it has not completed
+    claimed = False
     try:
         decoded_token = get_decoded_token(SECRET_KEY)
         user_id = decoded_token["user_id"]
@@ -126,53 +380,133 @@ def send_message():
         message = data["message"]
         chat_name = data.get("chat_name", "Default Chat")
 
+        # A retry of a request seen before gets that request's reply
+        key = request.headers.get("Idempotency-Key")
+        if key is not None:
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({"message": "Invalid Idempotency-Key"}), 400
+            record = idempotency.claim(user_id, key, fingerprint(data))
+            if record is not None:
+                return replay(record, data.get("stream", True))
+            claimed = True
+
         # Check if the chat history exists for the user and chat_name
         conversation = get_conversation(supabase_client, user_id, chat_name)
         if not conversation.data:
             return jsonify({"message": "Chat not found"}), 404
 
-        updated_messages = conversation.data[0]["messages"]
-        conversation_history = combine_message(message, updated_messages)
-
-        chatbot = ChatBot(client_xunfei)
-
-        # Determine whether to use a streaming response based on system load.
-        if is_system_under_high_load():
-            # Use a normal (non-streaming) response under high load.
-            assistant_message = chatbot.chat(conversation_history, stream=False)
-            update_database(
-                supabase_client,
-                updated_messages,
-                message,
-                assistant_message,
-                conversation,
+        chat = conversation.data[0]
+        updated_messages = chat["messages"]
+        # Fit the history into the prompt token budget
+        context = build_context(
+            message,
+            updated_messages,
+            SYSTEM_PROMPT,
+            summary=chat.get("summary"),
+            summary_seq=chat.get("summary_seq"),
+        )
+        conversation_history = context.messages
+        summary = (
+            (context.summary, context.summary_seq) if context.summary_changed else None
+        )
+        context_headers = {
+            "X-Prompt-Tokens": str(context.prompt_tokens),
+            "X-Prompt-Tokens-Saved": str(context.saved_tokens),
+        }
+
+        # Wait for one of the host's LLM slots, or give up with 429/503. Users
+        # are scheduled fairly, and heavy users get shorter replies.
+        slot = admission.acquire(user_id)
+        try:
+            chatbot = ChatBot(
+                client_xunfei, cache=completion_cache, max_tokens=slot.max_tokens
             )
-            return jsonify({"message": assistant_message}), 200
-        else:
-            # Use a streaming response.
-            assistant_message = ""  # Used to accumulate the entire output.
-
-            def generate():
-                nonlocal assistant_message
-                for chunk in chatbot.chat(conversation_history, stream=True):
-                    assistant_message += chunk
-                    yield chunk  # Send chunks to the frontend in real time
-                update_database(
+            if not data.get("stream", True):
+                # Non-streaming reply, requested by the client
+                try:
+                    assistant_message = chatbot.chat(conversation_history, stream=False)
+                finally:
+                    account(slot, chatbot, user_id, chat_name, context)
+                queue_update_database(
+                    supabase_client,
+                    updated_messages,
+                    message,
+                    assistant_message,
+                    conversation,
+                    summary,
+                )
+                if claimed:
+                    idempotency.complete(user_id, key, assistant_message)
+                    claimed = False
+                return jsonify({"message": assistant_message}), 200, context_headers
+            # Use a streaming response. The model writes the reply into the
+            # shared stream buffer from a background thread and the response
+            # follows the buffer, so a client that lost the connection can
+            # resume it with /stream/<id> instead of generating it again.
+            stream_id = stream_buffer.create(user_id)
+            idempotent = claimed
+
+            def persist(assistant_message, interrupted):
+                queue_update_database(
                     supabase_client,
                     updated_messages,
                     message,
                     assistant_message,
                     conversation,
+                    summary,
+                    interrupted,
                 )
+                # Written before the stream ends: the client's history sync
+                # that follows may reach another worker
+                write_behind.flush_chat(chat.get("user_id"), chat["name"])
+                if idempotent:
+                    idempotency.complete(user_id, key, assistant_message, interrupted)
+
+            def produce():
+                stream = chatbot.chat(conversation_history, stream=True)
+                try:
+                    # Cut short when nobody read the reply for the grace
+                    # period; pump then closes the stream, stopping the model
+                    stream_buffer.pump(stream_id, stream, persist)
+                finally:
+                    # The slot is free once the reply is done (a stalled model
+                    # is closed at its next chunk, charged for what it made)
+                    account(slot, chatbot, user_id, chat_name, context)
 
-            return Response(generate(), content_type="text/plain;charset=utf-8")
+            if claimed:
+                idempotency.attach(user_id, key, stream_id)
+            threading.Thread(target=produce, daemon=True).start()
+        except BaseException:
+            # Until account() runs (in the producer, for a stream) nothing
+            # else gives the slot back
+            slot.release()
+            raise
+        claimed = False  # Completed by persist
+        return Response(
+            stream_buffer.follow(stream_id),
+            content_type="text/plain;charset=utf-8",
+            headers={**context_headers, "X-Stream-Id": stream_id},
+        )
 
     except jwt.ExpiredSignatureError:
         return jsonify({"message": "Token expired"}), 401
     except jwt.InvalidTokenError:
         return jsonify({"message": "Invalid token"}), 401
+    except Overloaded as e:
+        return (
+            jsonify({"message": str(e)}),
+            e.status,
+            {"Retry-After": str(e.retry_after)},
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"message": str(e)}), 422
+    except IdempotencyPending as e:
+        return jsonify({"message": str(e)}), 409, {"Retry-After": "1"}
     except ValueError as e:
         return jsonify({"message": str(e)}), 401
+    finally:
+        if claimed:
+            idempotency.release(user_id, key)
 
 
 if __name__ == "__main__":
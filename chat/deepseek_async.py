@@ -0,0 +1,548 @@
+# Asyncio serving mode of deepseek.py with the same routes and responses.
+# A single process holds many concurrent LLM streams, e.g.
+#   hypercorn -w 1 -b 0.0.0.0:5002 deepseek_async:app
+from utils.chatbot_utils import ChatBot, SYSTEM_PROMPT, completion_cache
+from utils.context_utils import build_context
+from utils.db_utils import (
+    acheck_chat_exists,
+    acreate_chat,
+    aexport_chats,
+    aimport_chats,
+    ChatImporter,
+    aget_chat_history_list,
+    aget_conversation,
+    aget_chat_version,
+    aget_messages_page,
+    asearch,
+    aget_usage_summary,
+    parse_page_args,
+    empty_page,
+    queue_update_database,
+    write_behind,
+    usage_ledger,
+)
+from utils.idempotency_utils import (
+    idempotency,
+    fingerprint,
+    IdempotencyConflict,
+    IdempotencyPending,
+    MAX_KEY_LENGTH,
+)
+from utils.http_utils import make_etag, etag_matches, andjson_lines, andjson_records
+from utils.load_utils import admission, Overloaded
+from utils.metrics_utils import metrics_response
+from utils.stream_utils import stream_buffer, StreamGone
+from utils.storage_utils import AsyncSQLiteClient
+from utils.llm_pool_utils import AsyncLLMPool, llm_endpoints
+from utils.auth_utils import decode_auth_header
+from quart import Quart, request, jsonify, Response
+from openai import AsyncOpenAI
+import jwt
+from supabase import acreate_client
+import asyncio
+import os
+
+app = Quart(__name__)
+
+# Supabase connection config
+# database already exists
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY", "dummy_key")
+SECRET_KEY = os.environ.get("SECRET_KEY", "dummy_secret")
+
+# Storage backend: "supabase" (hosted Postgres) or "sqlite" (embedded file at
+# SQLITE_DB_PATH, for single-node and edge deployments)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+SQLITE_DB_PATH = os.environ.get("SQLITE_DB_PATH", "chat.sqlite3")
+if STORAGE_BACKEND not in ("supabase", "sqlite"):
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+
+# created on startup, the async client must live in the serving event loop
+supabase_client = None
+
+# Tasks writing streamed replies into the stream buffer, kept until done
+producers = set()
+
+# create DeepSeek clients
+CLIENT_XUNFEI_API_KEY = os.environ.get("CLIENT_XUNFEI_API_KEY", "dummy_xunfei_key")
+CLIENT_XUNFEI_BASE_URL = os.environ.get("CLIENT_XUNFEI_BASE_URL")
+# Extra provider endpoints as comma separated "base_url|api_key" entries; the
+# pool routes to the fastest healthy one and fails over before the first token
+client_xunfei = AsyncLLMPool(
+    [
+        AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        for base_url, api_key in llm_endpoints(
+            CLIENT_XUNFEI_BASE_URL,
+            CLIENT_XUNFEI_API_KEY,
+            os.environ.get("LLM_ENDPOINTS"),
+        )
+    ],
+    max_attempts=int(os.environ.get("LLM_MAX_ATTEMPTS", "3")),
+    hedge=os.environ.get("LLM_HEDGE", "0") == "1",
+)
+
+
+@app.before_serving
+async def create_supabase_client():
+    global supabase_client
+    if supabase_client is None and STORAGE_BACKEND == "sqlite":
+        supabase_client = AsyncSQLiteClient(SQLITE_DB_PATH)
+    elif supabase_client is None:
+        supabase_client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+@app.after_serving
+async def flush_pending_writes():
+    # Turns still in the write-behind queue, and usage not in the ledger yet,
+    # are written before shutdown
+    await write_behind.aflush()
+    await usage_ledger.aflush()
+
+
+def get_decoded_token():
+    return decode_auth_header(request.headers.get("Authorization"), SECRET_KEY)
+
+
+def with_etag(response, etag):
+    response.headers["ETag"] = etag
+    # Browsers keep the body but revalidate it with If-None-Match on every use
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def not_modified(etag):
+    return with_etag(Response(status=304), etag)
+
+
+@app.route("/health")
+async def health():
+    status = {
+        "status": "ok",
+        "load": await asyncio.to_thread(admission.snapshot),
+        "write_behind": write_behind.stats(),
+        "usage_ledger": usage_ledger.stats(),
+    }
+    if isinstance(client_xunfei, AsyncLLMPool):
+        status["llm"] = client_xunfei.snapshot()
+    if completion_cache is not None:
+        status["completion_cache"] = completion_cache.stats()
+    return jsonify(status), 200
+
+
+@app.route("/metrics")
+async def metrics():
+    """Prometheus metrics, summed over the workers of this host"""
+    body, content_type = metrics_response()
+    return Response(body, content_type=content_type)
+
+
+# start chat
+@app.route("/start_chat", methods=["POST"])
+async def start_chat():
+    """Handle the request forwarded by the API Gateway to create a new chat"""
+    try:
+        user_id = get_decoded_token().get("user_id")
+        data = await request.get_json()
+        if not data or "chat_name" not in data:
+            return jsonify({"message": "Invalid request, 'chat_name' is required"}), 400
+
+        chat_name = data.get("chat_name", "Untitled Chat")
+
+        # Check if a chat with the same name already exists
+        existing_chat = await acheck_chat_exists(supabase_client, user_id, chat_name)
+        if existing_chat.data:
+            return (
+                jsonify({"message": "Chat already exists", "chat_name": chat_name}),
+                409,
+            )
+
+        # **Create a new chat with no initial messages**
+        await acreate_chat(supabase_client, user_id, chat_name)
+        return jsonify({"message": "Chat started", "chat_name": chat_name}), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# get chat list
+@app.route("/chat_list", methods=["GET"])
+async def chat_list():
+    """Handle the request forwarded by the API Gateway to retrieve the chat history list"""
+    try:
+        user_id = get_decoded_token().get("user_id")
+        # Retrieve the chat history list for the user
+        response = await aget_chat_history_list(supabase_client, user_id)
+
+        # The list only changes when a chat is created or updated
+        etag = make_etag(
+            user_id,
+            sorted((c["name"], c.get("updated_at") or "") for c in response.data),
+        )
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified(etag)
+        return with_etag(
+            jsonify({"chats": [conv["name"] for conv in response.data]}), etag
+        )
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# get chat history
+@app.route("/chat_history", methods=["GET"])
+async def chat_history():
+    """Handle the /chat_history request forwarded by the API Gateway to fetch a specific chat history."""
+    try:
+        user_id = get_decoded_token()["user_id"]
+        chat_name = request.args.get("chat_name", "")
+        # Check if chat_name is provided
+        if not chat_name:
+            return jsonify({"message": "Chat name is required"}), 400
+        try:
+            page_args = parse_page_args(request.args)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        chat = await aget_chat_version(supabase_client, user_id, chat_name)
+        if chat is None:
+            return jsonify(empty_page()), 200
+        # The version changes with every appended message
+        etag = make_etag(
+            chat["id"],
+            chat["message_count"],
+            chat.get("updated_at"),
+            sorted(page_args.items()),
+        )
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return not_modified(etag)
+        # Query one page of the user's specific chat history, newest first
+        page = await aget_messages_page(
+            supabase_client, user_id, chat_name, chat=chat, **page_args
+        )
+        return with_etag(jsonify(page), etag)
+
+    except Exception as e:
+        print(f"Error in chat_history: {e}")  # Log the error
+        return jsonify({"message": "Internal Server Error", "error": str(e)}), 500
+
+
+# search the messages of all the user's chats
+@app.route("/search", methods=["GET"])
+async def search_messages():
+    """Return the messages best matching `q`, with chat name, seq and snippet"""
+    try:
+        user_id = get_decoded_token()["user_id"]
+        query = request.args.get("q", "").strip()
+        if not query:
+            return jsonify({"message": "Query is required"}), 400
+        limit = request.args.get("limit", "")
+        if limit and not limit.isdigit():
+            return jsonify({"message": "Invalid limit"}), 400
+        limit = int(limit) if limit else None
+        results = await asearch(supabase_client, user_id, query, limit)
+        return jsonify({"query": query, "results": results}), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# export all the user's chats
+@app.route("/export", methods=["GET"])
+async def export():
+    """Stream every chat of the user and its messages as NDJSON records"""
+    try:
+        user_id = get_decoded_token()["user_id"]
+        # Read page by page while the response is sent, in constant memory
+        return Response(
+            andjson_lines(aexport_chats(supabase_client, user_id)),
+            mimetype="application/x-ndjson",
+            headers={"Content-Disposition": 'attachment; filename="chats.ndjson"'},
+        )
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# import chats from an export
+@app.route("/import", methods=["POST"])
+async def import_chat_export():
+    """
+    Write the chats of an NDJSON export streamed in the body, in batches. Chats
+    already there are resumed; `resume_from` skips the chats before that one.
+    """
+    try:
+        user_id = get_decoded_token()["user_id"]
+        importer = ChatImporter(user_id, request.args.get("resume_from"))
+        try:
+            # Read as it arrives: a body sent with a Content-Length over
+            # MAX_CONTENT_LENGTH is refused, so the gateway sends it chunked
+            records = andjson_records(request.body)
+            progress = await aimport_chats(supabase_client, importer, records)
+        except ValueError as e:
+            return jsonify({"message": str(e), **importer.progress()}), 400
+        return jsonify(progress), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# token usage of the user
+@app.route("/usage", methods=["GET"])
+async def usage():
+    """Return the user's token usage per day and per chat, and their limits"""
+    try:
+        user_id = get_decoded_token()["user_id"]
+        days = request.args.get("days", "")
+        if days and not days.isdigit():
+            return jsonify({"message": "Invalid days"}), 400
+        days = int(days) if days else None
+        summary = await aget_usage_summary(supabase_client, user_id, days)
+        limits = await asyncio.to_thread(admission.limits, user_id)
+        return jsonify({**summary, "limits": limits}), 200
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Exception as e:
+        return jsonify({"message": "Internal server error", "error": str(e)}), 500
+
+
+# resume a streamed reply
+@app.route("/stream/<stream_id>", methods=["GET"])
+async def resume_stream(stream_id):
+    """Stream the rest of a reply from the byte `offset` the client already has"""
+    try:
+        user_id = get_decoded_token().get("user_id")
+        offset = request.args.get("offset", "0")
+        info = await asyncio.to_thread(stream_buffer.info, stream_id)
+        if info is None or info["user_id"] != str(user_id):
+            return jsonify({"message": "Stream not found"}), 404
+        if not offset.isdigit() or int(offset) > info["total"]:
+            return jsonify({"message": "Invalid offset"}), 400
+        offset = int(offset)
+        # Raises if no longer buffered
+        await asyncio.to_thread(stream_buffer.read, stream_id, offset)
+        return Response(
+            stream_buffer.afollow(stream_id, offset),
+            content_type="text/plain;charset=utf-8",
+            headers={"X-Stream-Id": stream_id},
+        )
+
+    except ValueError:
+        return jsonify({"message": "Authorization token is missing"}), 401
+    except StreamGone as e:
+        return jsonify({"message": str(e)}), 410
+    except KeyError:
+        return jsonify({"message": "Stream not found"}), 404
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+
+
+async def account(slot, chatbot, user_id, chat_name, context):
+    """Release the LLM slot of a call and record the tokens it used."""
+    prompt_tokens, completion_tokens = chatbot.tokens_used(context.prompt_tokens)
+    await slot.arelease(prompt_tokens + completion_tokens)
+    usage_ledger.record(
+        supabase_client, user_id, chat_name, prompt_tokens, completion_tokens
+    )
+
+
+async def replay(record, stream):
+    """The response of the request holding an Idempotency-Key, for a retry."""
+    headers = {"Idempotent-Replayed": "true"}
+    if record["done"]:
+        if stream:
+            return Response(
+                record["reply"],
+                content_type="text/plain;charset=utf-8",
+                headers=headers,
+            )
+        return jsonify({"message": record["reply"]}), 200, headers
+    # Still generating: follow the reply from its start, like a resume
+    stream_id = record["stream_id"]
+    try:
+        await asyncio.to_thread(stream_buffer.read, stream_id, 0)
+    except (StreamGone, KeyError):
+        raise IdempotencyPending("The original request is still running") from None
+    return Response(
+        stream_buffer.afollow(stream_id),
+        content_type="text/plain;charset=utf-8",
+        headers={**headers, "X-Stream-Id": stream_id},
+    )
+
+
+# send message
+@app.route("/send_message", methods=["POST"])
+async def send_message():
+    """Handle the /send_message request to send a message to deepseek."""
+    # Set while this request holds an Idempotency-Key it has not completed
+    claimed = False
+    try:
+        user_id = get_decoded_token()["user_id"]
+        data = await request.get_json()
+        message = data["message"]
+        chat_name = data.get("chat_name", "Default Chat")
+
+        # A retry of a request seen before gets that request's reply
+        key = request.headers.get("Idempotency-Key")
+        if key is not None:
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({"message": "Invalid Idempotency-Key"}), 400
+            record = await idempotency.aclaim(user_id, key, fingerprint(data))
+            if record is not None:
+                return await replay(record, data.get("stream", True))
+            claimed = True
+
+        # Check if the chat history exists for the user and chat_name
+        conversation = await aget_conversation(supabase_client, user_id, chat_name)
+        if not conversation.data:
+            return jsonify({"message": "Chat not found"}), 404
+
+        chat = conversation.data[0]
+        updated_messages = chat["messages"]
+        # Fit the history into the prompt token budget
+        context = build_context(
+            message,
+            updated_messages,
+            SYSTEM_PROMPT,
+            summary=chat.get("summary"),
+            summary_seq=chat.get("summary_seq"),
+        )
+        conversation_history = context.messages
+        summary = (
+            (context.summary, context.summary_seq) if context.summary_changed else None
+        )
+        context_headers = {
+            "X-Prompt-Tokens": str(context.prompt_tokens),
+            "X-Prompt-Tokens-Saved": str(context.saved_tokens),
+        }
+
+        # Wait for one of the host's LLM slots, or give up with 429/503. Users
+        # are scheduled fairly, and heavy users get shorter replies.
+        slot = await admission.aacquire(user_id)
+        try:
+            chatbot = ChatBot(
+                client_xunfei, cache=completion_cache, max_tokens=slot.max_tokens
+            )
+            if not data.get("stream", True):
+                # Non-streaming reply, requested by the client
+                try:
+                    assistant_message = await chatbot.achat(
+                        conversation_history, stream=False
+                    )
+                finally:
+                    await account(slot, chatbot, user_id, chat_name, context)
+                queue_update_database(
+                    supabase_client,
+                    updated_messages,
+                    message,
+                    assistant_message,
+                    conversation,
+                    summary,
+                )
+                if claimed:
+                    await asyncio.to_thread(
+                        idempotency.complete, user_id, key, assistant_message
+                    )
+                    claimed = False
+                return jsonify({"message": assistant_message}), 200, context_headers
+            # Use a streaming response. The model writes the reply into the
+            # shared stream buffer from a task and the response follows the
+            # buffer, so a client can resume it with /stream/<id>.
+            stream_id = await asyncio.to_thread(stream_buffer.create, user_id)
+            idempotent = claimed
+
+            async def persist(assistant_message, interrupted):
+                queue_update_database(
+                    supabase_client,
+                    updated_messages,
+                    message,
+                    assistant_message,
+                    conversation,
+                    summary,
+                    interrupted,
+                )
+                # Written before the stream ends: the client's history sync
+                # that follows may reach another worker
+                await write_behind.aflush_chat(chat.get("user_id"), chat["name"])
+                if idempotent:
+                    await asyncio.to_thread(
+                        idempotency.complete,
+                        user_id,
+                        key,
+                        assistant_message,
+                        interrupted,
+                    )
+
+            async def produce():
+                stream = chatbot.achat(conversation_history, stream=True)
+                try:
+                    # Cut short when nobody read the reply for the grace period
+                    await stream_buffer.apump(stream_id, stream, persist)
+                finally:
+                    await stream.aclose()  # Stops the model if cut short
+                    # The slot is free once the model is done
+                    await account(slot, chatbot, user_id, chat_name, context)
+
+            if claimed:
+                await asyncio.to_thread(idempotency.attach, user_id, key, stream_id)
+            producer = asyncio.ensure_future(produce())
+            producers.add(producer)
+            producer.add_done_callback(producers.discard)
+        except BaseException:
+            # Until account() runs (in the producer, for a stream) nothing
+            # else gives the slot back
+            await slot.arelease()
+            raise
+        claimed = False  # Completed by persist
+        return Response(
+            stream_buffer.afollow(stream_id),
+            content_type="text/plain;charset=utf-8",
+            headers={**context_headers, "X-Stream-Id": stream_id},
+        )
+
+    except jwt.ExpiredSignatureError:
+        return jsonify({"message": "Token expired"}), 401
+    except jwt.InvalidTokenError:
+        return jsonify({"message": "Invalid token"}), 401
+    except Overloaded as e:
+        return (
+            jsonify({"message": str(e)}),
+            e.status,
+            {"Retry-After": str(e.retry_after)},
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"message": str(e)}), 422
+    except IdempotencyPending as e:
+        return jsonify({"message": str(e)}), 409, {"Retry-After": "1"}
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 401
+    finally:
+        if claimed:
+            await asyncio.to_thread(idempotency.release, user_id, key)
+
+
+if __name__ == "__main__":
+    app.run(debug=True, port=5002)
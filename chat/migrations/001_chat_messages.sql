@@ -0,0 +1,41 @@
+-- Append-only message storage: one row per message instead of rewriting the
+-- whole 'messages' JSON document of chat_history on every turn.
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    chat_id   BIGINT      NOT NULL REFERENCES chat_history (id) ON DELETE CASCADE,
+    seq       INTEGER     NOT NULL,
+    role      TEXT        NOT NULL,
+    content   TEXT        NOT NULL,
+    timestamp TIMESTAMPTZ,
+    PRIMARY KEY (chat_id, seq)
+);
+
+-- NULL marks chats that still live in the legacy blob; db_utils migrates
+-- them lazily on first read, so this script can run while the service is up.
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS message_count INTEGER;
+
+-- Bulk copy of existing blobs, one transaction per run.
+BEGIN;
+
+INSERT INTO chat_messages (chat_id, seq, role, content, timestamp)
+SELECT
+    h.id,
+    (m.ordinality - 1)::INTEGER,
+    m.value ->> 'role',
+    COALESCE(m.value ->> 'content', ''),
+    (m.value ->> 'timestamp')::TIMESTAMPTZ
+FROM chat_history h
+CROSS JOIN LATERAL jsonb_array_elements(h.messages -> 'messages')
+    WITH ORDINALITY AS m (value, ordinality)
+WHERE h.message_count IS NULL
+ON CONFLICT (chat_id, seq) DO NOTHING;
+
+UPDATE chat_history
+SET message_count = COALESCE(jsonb_array_length(messages -> 'messages'), 0)
+WHERE message_count IS NULL;
+
+COMMIT;
+
+-- Once every service runs the append-only code, the legacy blobs can be
+-- emptied to reclaim space:
+-- UPDATE chat_history SET messages = '{"messages": []}'::jsonb;
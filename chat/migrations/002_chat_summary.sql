@@ -0,0 +1,5 @@
+-- Rolling summary of the turns dropped from the model's context window,
+-- covering the messages up to summary_seq.
+
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS summary_seq INTEGER;
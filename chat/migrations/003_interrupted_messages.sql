@@ -0,0 +1,4 @@
+-- Assistant replies cut short because the client disconnected are stored as
+-- far as they got, marked as interrupted.
+
+ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS interrupted BOOLEAN NOT NULL DEFAULT FALSE;
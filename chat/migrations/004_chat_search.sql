@@ -0,0 +1,25 @@
+-- Inverted index of message content for /search: one posting per distinct term
+-- of a message, with its frequency. Read by (user_id, term); see
+-- utils/search_utils.py for how terms are extracted.
+
+CREATE TABLE IF NOT EXISTS chat_search (
+    user_id BIGINT  NOT NULL,
+    term    TEXT    NOT NULL,
+    chat_id BIGINT  NOT NULL REFERENCES chat_history (id) ON DELETE CASCADE,
+    seq     INTEGER NOT NULL,
+    tf      INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, chat_id, seq)
+);
+
+-- Postings of the messages stored before the service indexed them, with the
+-- same terms as search_utils.TERM_PATTERN. Safe to re-run.
+INSERT INTO chat_search (user_id, term, chat_id, seq, tf)
+SELECT h.user_id, t.term[1], m.chat_id, m.seq, COUNT(*)
+FROM chat_messages m
+JOIN chat_history h ON h.id = m.chat_id
+CROSS JOIN LATERAL regexp_matches(
+    lower(m.content), '[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+', 'g'
+) AS t (term)
+WHERE length(t.term[1]) <= 64
+GROUP BY h.user_id, t.term[1], m.chat_id, m.seq
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,16 @@
+-- Ledger of LLM token usage: the totals of a user in a chat on a day, written
+-- in batches by db_utils.UsageLedger, so a (user, chat, day) may have several
+-- rows. GET /usage adds up the rows of a user since a day.
+
+CREATE TABLE IF NOT EXISTS chat_usage (
+    id                BIGSERIAL PRIMARY KEY,
+    user_id           BIGINT  NOT NULL,
+    chat_name         TEXT,
+    day               DATE    NOT NULL,
+    requests          INTEGER NOT NULL,
+    prompt_tokens     INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    created_at        TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS chat_usage_user_day ON chat_usage (user_id, day);
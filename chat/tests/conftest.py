@@ -1,4 +1,7 @@
 import os
+import tempfile
+
+import pytest
 
 # Set dummy environment variables before importing deepseek
 os.environ.setdefault("SUPABASE_URL", "http://dummy-supabase-url")
@@ -6,6 +9,19 @@ os.environ.setdefault("SUPABASE_KEY", "dummy_supabase_key")
 os.environ.setdefault("SECRET_KEY", "dummy_secret")
 os.environ.setdefault("CLIENT_XUNFEI_API_KEY", "dummy_xunfei_key")
 os.environ.setdefault("CLIENT_XUNFEI_BASE_URL", "http://dummy-xunfei-api")
+# Keep the admission state of the tests apart and skip the load sampler thread
+os.environ.setdefault(
+    "LOAD_STATE_PATH", os.path.join(tempfile.mkdtemp(), "chat-load-state.json")
+)
+os.environ.setdefault("LOAD_SAMPLE_INTERVAL", "0")
+os.environ.setdefault(
+    "STREAM_BUFFER_PATH", os.path.join(tempfile.mkdtemp(), "chat-streams.sqlite3")
+)
+
+from chat.tests.fake_supabase import (
+    DummySupabaseResponse,
+    InMemorySupabaseClient,
+)
 
 # Define dummy Supabase classes to simulate Supabase responses without making real API calls
 
@@ -40,11 +56,6 @@ class DummySupabaseTable:
         return self
 
 
-class DummySupabaseResponse:
-    def __init__(self, data):
-        self.data = data
-
-
 class DummySupabaseClient:
     def table(self, name):
         return DummySupabaseTable()
@@ -68,3 +79,20 @@ supabase.create_client = dummy_create_client
 
 # Now import deepseek so that it uses the dummy environment variables and dummy client
 from ..deepseek import *
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    # The caches are per process, keep tests independent
+    from utils.auth_utils import token_cache
+    from utils.db_utils import conversation_cache, usage_ledger, write_behind
+
+    conversation_cache.clear()
+    token_cache.clear()
+    write_behind.clear()
+    usage_ledger.clear()
+    yield
+    conversation_cache.clear()
+    token_cache.clear()
+    write_behind.clear()
+    usage_ledger.clear()
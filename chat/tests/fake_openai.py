@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIServer:
+    """
+    Local OpenAI-compatible /v1/chat/completions endpoint for tests.
+
+    It answers with `reply` split into `chunks`, after `ttft` seconds and then
+    `delay` seconds per chunk. The first `fail` requests get an HTTP 500. Usage
+    is reported with one completion token per chunk. `disconnects` counts the
+    streams the client closed before the end, `sent` the chunks written.
+    """
+
+    def __init__(self, chunks=("Hello", ", world"), ttft=0.0, delay=0.0, fail=0):
+        self.chunks = list(chunks)
+        self.ttft = ttft
+        self.delay = delay
+        self.fail = fail
+        self.requests = []
+        self.sent = 0
+        self.disconnects = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                server.requests.append(body)
+                if len(server.requests) <= server.fail:
+                    self._send_json(500, {"error": {"message": "boom"}})
+                    return
+                time.sleep(server.ttft)
+                if body.get("stream"):
+                    self._stream(body)
+                else:
+                    message = {"role": "assistant", "content": "".join(server.chunks)}
+                    choice = {"index": 0, "message": message, "finish_reason": "stop"}
+                    payload = server._completion("chat.completion", choice)
+                    payload["usage"] = server._usage(body)
+                    self._send_json(200, payload)
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                try:
+                    for index, chunk in enumerate(server.chunks):
+                        if index:
+                            time.sleep(server.delay)
+                        delta = {"content": chunk}
+                        choice = {"index": 0, "delta": delta, "finish_reason": None}
+                        self._event(server._completion("chat.completion.chunk", choice))
+                        server.sent += 1
+                    if (body.get("stream_options") or {}).get("include_usage"):
+                        payload = server._completion("chat.completion.chunk", None)
+                        payload["usage"] = server._usage(body)
+                        self._event(payload)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    server.disconnects += 1  # The client closed the stream
+
+            def _event(self, payload):
+                self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(
+            target=self.httpd.serve_forever, args=(0.05,), daemon=True
+        ).start()
+
+    @staticmethod
+    def _completion(kind, choice):
+        return {
+            "id": "chatcmpl-fake",
+            "object": kind,
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [choice] if choice else [],
+        }
+
+    def _usage(self, body):
+        prompt = sum(len(m.get("content") or "") // 4 + 4 for m in body["messages"])
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": len(self.chunks),
+            "total_tokens": prompt + len(self.chunks),
+        }
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
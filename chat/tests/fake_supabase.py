@@ -0,0 +1,140 @@
+import threading
+
+
+class DummySupabaseResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+# Stateful in-memory stand-in for the Supabase tables, supporting the query
+# builder calls used by utils/db_utils.py. Used by the tests and by the end to
+# end benchmark, where a threaded server shares one client.
+
+
+class InMemorySupabaseQuery:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.action = "select"
+        self.columns = None
+        self.count = None
+        self.payload = None
+        self.filters = []
+        self.ordering = []
+        self.start = 0
+        self.stop = None
+
+    def select(self, *columns, count=None):
+        self.columns = ",".join(columns)
+        self.count = count
+        return self
+
+    def insert(self, data):
+        self.action, self.payload = "insert", data
+        return self
+
+    def update(self, data):
+        self.action, self.payload = "update", data
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def _filter(self, key, test):
+        self.filters.append(lambda row: row.get(key) is not None and test(row[key]))
+        return self
+
+    def eq(self, key, value):
+        self.filters.append(lambda row: row.get(key) == value)
+        return self
+
+    def gt(self, key, value):
+        return self._filter(key, lambda v: v > value)
+
+    def gte(self, key, value):
+        return self._filter(key, lambda v: v >= value)
+
+    def lt(self, key, value):
+        return self._filter(key, lambda v: v < value)
+
+    def lte(self, key, value):
+        return self._filter(key, lambda v: v <= value)
+
+    def in_(self, key, values):
+        return self._filter(key, lambda v: v in values)
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, size):
+        self.stop = self.start + size
+        return self
+
+    def range(self, start, end):
+        self.start, self.stop = start, end + 1
+        return self
+
+    def _project(self, row):
+        if not self.columns or self.columns == "*":
+            return dict(row)
+        return {c.strip(): row.get(c.strip()) for c in self.columns.split(",")}
+
+    def execute(self):
+        with self.client.lock:
+            return self._execute()
+
+    def _execute(self):
+        self.client.calls.append((self.name, self.action))
+        if self.client.failures.get((self.name, self.action)):
+            self.client.failures[(self.name, self.action)] -= 1
+            raise Exception(f"Injected {self.action} failure on {self.name}")
+        rows = self.client.tables.setdefault(self.name, [])
+        if self.action == "insert":
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            inserted = []
+            for data in payload:
+                row = dict(data)
+                row.setdefault("id", self.client.next_id(self.name))
+                for key in self.client.unique.get(self.name, []):
+                    if any(all(r.get(k) == row.get(k) for k in key) for r in rows):
+                        raise ValueError(f"duplicate key {key} in {self.name}")
+                rows.append(row)
+                inserted.append(dict(row))
+            return DummySupabaseResponse(inserted)
+        matched = [row for row in rows if all(f(row) for f in self.filters)]
+        if self.action == "update":
+            for row in matched:
+                row.update(self.payload)
+            return DummySupabaseResponse([dict(row) for row in matched])
+        if self.action == "delete":
+            self.client.tables[self.name] = [r for r in rows if r not in matched]
+            return DummySupabaseResponse([dict(row) for row in matched])
+        for column, desc in reversed(self.ordering):
+            matched.sort(key=lambda row: row.get(column), reverse=desc)
+        count = len(matched) if self.count else None
+        window = matched[self.start : self.stop]
+        return DummySupabaseResponse([self._project(row) for row in window], count)
+
+
+class InMemorySupabaseClient:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.calls = []
+        self.ids = {}
+        # (table, action) -> number of upcoming calls that raise
+        self.failures = {}
+        self.unique = {
+            "chat_history": [("user_id", "name")],
+            "chat_messages": [("chat_id", "seq")],
+        }
+
+    def next_id(self, name):
+        self.ids[name] = self.ids.get(name, 0) + 1
+        return self.ids[name]
+
+    def table(self, name):
+        return InMemorySupabaseQuery(self, name)
@@ -0,0 +1,67 @@
+import time
+
+import jwt
+import pytest
+from utils import auth_utils
+
+SECRET = "test_secret"
+
+
+def make_token(**claims):
+    claims.setdefault("user_id", 1)
+    return jwt.encode(claims, SECRET, algorithm="HS256")
+
+
+def count_decodes(monkeypatch):
+    calls = []
+    real_decode = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        calls.append(args[0])
+        return real_decode(*args, **kwargs)
+
+    monkeypatch.setattr(auth_utils.jwt, "decode", counting_decode)
+    return calls
+
+
+def test_verified_token_is_cached(monkeypatch):
+    calls = count_decodes(monkeypatch)
+    token = make_token(exp=int(time.time()) + 60)
+    for _ in range(3):
+        assert auth_utils.decode_auth_header(f"Bearer {token}", SECRET)["user_id"] == 1
+    assert len(calls) == 1
+
+
+def test_cache_entry_expires_with_token(monkeypatch):
+    calls = count_decodes(monkeypatch)
+    token = make_token(exp=int(time.time()) + 60)
+    auth_utils.decode_token(token, SECRET)
+    # Once exp has passed the cached entry is gone and the token is verified again
+    now, monotonic = time.time(), time.monotonic()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    monkeypatch.setattr(time, "monotonic", lambda: monotonic + 120)
+    auth_utils.decode_token(token, SECRET)
+    assert len(calls) == 2
+
+
+def test_wrong_secret_is_not_served_from_cache():
+    token = make_token()
+    auth_utils.decode_token(token, SECRET)
+    with pytest.raises(jwt.InvalidSignatureError):
+        auth_utils.decode_token(token, "other_secret")
+
+
+@pytest.mark.parametrize(
+    "token", ["dummy_token", "a.b", "a.b.c.d", "a.b.c!", "a." * 3000 + "b.c"]
+)
+def test_malformed_token_rejected_before_decode(monkeypatch, token):
+    calls = count_decodes(monkeypatch)
+    with pytest.raises(jwt.InvalidTokenError):
+        auth_utils.decode_token(token, SECRET)
+    assert calls == []
+
+
+def test_claims_are_copied():
+    token = make_token()
+    auth_utils.decode_token(token, SECRET)["user_id"] = 2
+    assert auth_utils.decode_token(token, SECRET)["user_id"] == 1
@@ -0,0 +1,21 @@
+from benchmarks.bench_end_to_end import compare, latest_baseline, run_benchmark, save
+
+
+def test_end_to_end_benchmark_smoke(tmp_path):
+    result = run_benchmark(users=2, turns=2, ttft=0.0, token_rate=1000, reply_tokens=5)
+    assert result["errors"] == {}
+    assert result["ttft_ms"]["count"] == 4
+    assert result["latency_ms"]["send_message"]["count"] == 4
+    assert result["latency_ms"]["chat_history"]["count"] == 4
+    assert result["throughput"]["turns_per_second"] > 0
+
+    path = save(result, directory=str(tmp_path))
+    assert latest_baseline(result["config"], directory=str(tmp_path)) == (path, result)
+    assert latest_baseline({}, directory=str(tmp_path)) == (None, None)
+
+
+def test_compare_flags_regressions():
+    baseline = {"throughput": {"turns_per_second": 10.0}, "ttft_ms": {"p95": 100.0}}
+    result = {"throughput": {"turns_per_second": 9.5}, "ttft_ms": {"p95": 150.0}}
+    rows = {name: worse for name, _, _, _, worse in compare(baseline, result)}
+    assert rows == {"throughput.turns_per_second": False, "ttft_ms.p95": True}
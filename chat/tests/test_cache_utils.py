@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from utils import cache_utils
+from utils.cache_utils import LRUCache, SingleFlight, SQLiteLRUCache
+
+
+def test_lru_eviction_by_size():
+    cache = LRUCache(max_bytes=10, ttl=60)
+    cache.set("a", "aaaa")
+    cache.set("b", "bbbb")
+    assert cache.get("a") == "aaaa"  # "a" is now the most recently used
+    cache.set("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 8
+    assert (stats["hits"], stats["misses"]) == (3, 1)
+
+
+def test_oversized_value_is_not_cached():
+    cache = LRUCache(max_bytes=3, ttl=60)
+    cache.set("a", "aaaa")
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 0
+
+
+def test_ttl_expiry(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(cache_utils.time, "monotonic", lambda: clock[0])
+    cache = LRUCache(max_bytes=100, ttl=5)
+    cache.set("a", "aaaa")
+    clock[0] += 4
+    assert cache.get("a") == "aaaa"
+    clock[0] += 1
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_sqlite_lru_eviction_and_ttl(tmp_path, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: clock[0])
+    # '"aa"' is 4 bytes of JSON
+    cache = SQLiteLRUCache(str(tmp_path / "cache.sqlite3"), max_bytes=10, ttl=5)
+    cache.set("a", "aa")
+    clock[0] += 1
+    cache.set("b", "bb")
+    clock[0] += 1
+    assert cache.get("a") == "aa"  # "a" is now the most recently used
+    cache.set("c", "cc")
+    assert cache.get("b") is None
+    assert cache.get("c") == "cc"
+    clock[0] += 5
+    assert cache.get("c") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+    assert (stats["evictions"], stats["expirations"]) == (1, 1)
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    # Two instances stand for two worker processes on the same host
+    first = SQLiteLRUCache(path, max_bytes=1000, ttl=60)
+    second = SQLiteLRUCache(path, max_bytes=1000, ttl=60)
+    first.set("key", ["Hello", ", world"])
+    assert second.get("key") == ["Hello", ", world"]
+    assert first.stats()["hit_rate"] == 1.0
+    second.delete("key")
+    assert first.get("key") is None
+
+
+def concurrently(count, fn):
+    results, errors = [], []
+
+    def call():
+        try:
+            results.append(fn())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_single_flight_shares_one_call():
+    joined = []
+    flights = SingleFlight(on_coalesced=joined.append)
+    runs = []
+
+    def read():
+        runs.append(1)
+        time.sleep(0.1)
+        return {"rows": [1]}
+
+    results, _ = concurrently(5, lambda: flights.do("key", read))
+    assert len(runs) == 1
+    assert results == [{"rows": [1]}] * 5
+    # Every caller gets its own copy
+    assert len({id(result) for result in results}) == 5
+    assert joined == ["key"] * 4
+    assert (flights.calls, flights.coalesced) == (1, 4)
+    # Nothing is kept once the call returned
+    flights.do("key", read)
+    assert len(runs) == 2
+
+
+def test_single_flight_raises_to_every_waiter():
+    flights = SingleFlight()
+
+    def fail():
+        time.sleep(0.1)
+        raise ValueError("database down")
+
+    results, errors = concurrently(3, lambda: flights.do("key", fail))
+    assert results == []
+    assert [str(e) for e in errors] == ["database down"] * 3
+
+
+def test_single_flight_forget():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def slow():
+        started.set()
+        release.wait()
+        return "stale"
+
+    thread = threading.Thread(target=flights.do, args=(("user", 1), slow))
+    thread.start()
+    started.wait()
+    flights.forget(lambda key: key[1] == 1)
+    # A write happened: later reads do not join the stale one
+    assert flights.do(("user", 1), lambda: "fresh") == "fresh"
+    release.set()
+    thread.join()
+
+
+def test_single_flight_async():
+    flights = SingleFlight()
+    runs = []
+
+    async def read():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return ["row"]
+
+    async def main():
+        first = asyncio.ensure_future(flights.ado("key", read))
+        await asyncio.sleep(0)
+        # The caller that started the read goes away; the others still get it
+        first.cancel()
+        results = await asyncio.gather(*(flights.ado("key", read) for _ in range(3)))
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return results
+
+    assert asyncio.run(main()) == [["row"]] * 3
+    assert len(runs) == 1
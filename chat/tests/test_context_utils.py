@@ -0,0 +1,89 @@
+from utils.context_utils import (
+    SUMMARY_HEADER,
+    build_context,
+    estimate_tokens,
+    message_tokens,
+)
+
+
+def history(n, size=40):
+    roles = ("user", "assistant")
+    return {
+        "messages": [
+            {"seq": i, "role": roles[i % 2], "content": f"m{i} " + "x" * size}
+            for i in range(n)
+        ]
+    }
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert estimate_tokens("你好") == 2
+    assert message_tokens({"role": "user", "content": "abcd"}) == 5
+
+
+def test_history_within_budget_is_sent_whole():
+    context = build_context("Hi", history(4), "system", budget=10000)
+    assert [m["content"] for m in context.messages][-1] == "Hi"
+    assert len(context.messages) == 5
+    assert "seq" not in context.messages[0]
+    assert context.saved_tokens == 0
+    assert not context.summary_changed
+
+
+def test_old_turns_are_dropped_into_summary():
+    context = build_context("Hi", history(40), "system", budget=200, summary_budget=60)
+    assert context.prompt_tokens <= 200
+    assert context.saved_tokens == context.full_tokens - context.prompt_tokens > 0
+    summary, *kept, user = context.messages
+    assert summary["role"] == "system"
+    assert summary["content"].startswith(SUMMARY_HEADER)
+    assert kept[0]["role"] == "user"  # No turn is cut in half
+    assert kept[-1]["content"].startswith("m39 ")
+    assert user == {"role": "user", "content": "Hi"}
+    assert context.summary_changed
+    assert context.summary_seq == int(kept[0]["content"].split()[0][1:]) - 1
+    # The newest dropped messages survive the summary budget
+    assert f"m{context.summary_seq} " in context.summary
+
+
+def test_summary_is_extended_incrementally():
+    first = build_context("Hi", history(40), "system", budget=200, summary_budget=60)
+    # The stored summary is reused, only later messages are folded in
+    second = build_context(
+        "Again",
+        history(44),
+        "system",
+        summary=first.summary,
+        summary_seq=first.summary_seq,
+        budget=200,
+        summary_budget=60,
+    )
+    assert second.summary_seq > first.summary_seq
+    assert f"m{second.summary_seq} " in second.summary
+
+    # Nothing new dropped: the summary is unchanged and need not be saved
+    again = build_context(
+        "Hi",
+        history(40),
+        "system",
+        summary=first.summary,
+        summary_seq=first.summary_seq,
+        budget=200,
+        summary_budget=60,
+    )
+    assert not again.summary_changed
+    assert again.messages == first.messages
+
+
+def test_summary_is_sent_with_a_partial_history():
+    # Only the messages after the summary were read
+    partial = {"messages": history(10)["messages"][6:]}
+    context = build_context(
+        "Hi", partial, "system", summary="user: m0", summary_seq=5, budget=10000
+    )
+    assert context.messages[0]["content"] == SUMMARY_HEADER + "user: m0"
+    assert len(context.messages) == 6
+    assert not context.summary_changed
@@ -0,0 +1,457 @@
+import time
+
+import pytest
+from utils import db_utils
+from chat.tests.conftest import InMemorySupabaseClient
+
+
+def new_chat(client, user_id=1, chat_name="Test Chat"):
+    db_utils.create_chat(client, user_id, chat_name)
+    return db_utils.get_conversation(client, user_id, chat_name)
+
+
+def test_update_database_appends_message_rows():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    updated_messages = conversation.data[0]["messages"]
+    db_utils.update_database(client, updated_messages, "Hi", "Hello!", conversation)
+    db_utils.update_database(client, updated_messages, "Bye", "Goodbye!", conversation)
+
+    rows = client.tables["chat_messages"]
+    assert [(r["seq"], r["role"], r["content"]) for r in rows] == [
+        (0, "user", "Hi"),
+        (1, "assistant", "Hello!"),
+        (2, "user", "Bye"),
+        (3, "assistant", "Goodbye!"),
+    ]
+    chat = client.tables["chat_history"][0]
+    assert chat["message_count"] == 4
+    # The legacy blob is never rewritten
+    assert chat["messages"] == {"messages": []}
+    assert [m["seq"] for m in updated_messages["messages"]] == [0, 1, 2, 3]
+
+
+def test_get_conversation_reads_messages_in_order():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    updated_messages = conversation.data[0]["messages"]
+    db_utils.update_database(client, updated_messages, "Hi", "Hello!", conversation)
+
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    messages = conversation.data[0]["messages"]["messages"]
+    assert [(m["role"], m["content"]) for m in messages] == [
+        ("user", "Hi"),
+        ("assistant", "Hello!"),
+    ]
+
+
+def test_get_conversation_skips_message_query_for_empty_chat():
+    client = InMemorySupabaseClient()
+    new_chat(client)
+    assert ("chat_messages", "select") not in client.calls
+
+
+def test_legacy_blob_is_migrated_on_first_read():
+    client = InMemorySupabaseClient()
+    legacy = [
+        {"role": "user", "content": "Hi", "timestamp": "2025-01-01T00:00:00"},
+        {"role": "assistant", "content": "Hello!", "timestamp": "2025-01-01T00:00:01"},
+    ]
+    client.tables["chat_history"] = [
+        {"id": 7, "user_id": 1, "name": "Old Chat", "messages": {"messages": legacy}}
+    ]
+
+    conversation = db_utils.get_conversation(client, 1, "Old Chat")
+    messages = conversation.data[0]["messages"]["messages"]
+    assert [m["content"] for m in messages] == ["Hi", "Hello!"]
+    assert client.tables["chat_history"][0]["message_count"] == 2
+
+    # New turns continue the sequence after the migrated messages
+    db_utils.update_database(
+        client, conversation.data[0]["messages"], "Again", "Sure", conversation
+    )
+    assert [r["seq"] for r in client.tables["chat_messages"]] == [0, 1, 2, 3]
+
+
+def test_conversation_cache_serves_repeated_reads():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    db_utils.update_database(
+        client, conversation.data[0]["messages"], "Hi", "Hello!", conversation
+    )
+    client.calls.clear()
+
+    # Both reads are served from the write-through cache
+    for _ in range(2):
+        conversation = db_utils.get_conversation(client, 1, "Test Chat")
+        messages = conversation.data[0]["messages"]["messages"]
+        assert [m["content"] for m in messages] == ["Hi", "Hello!"]
+    assert db_utils.check_chat_exists(client, 1, "Test Chat").data
+    assert client.calls == []
+    assert db_utils.conversation_cache.stats()["hits"] >= 3
+
+
+def test_cached_conversation_is_not_shared_with_callers():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    conversation.data[0]["messages"]["messages"].append({"role": "user"})
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    assert conversation.data[0]["messages"]["messages"] == []
+
+
+def test_stale_cached_sequence_is_refreshed():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    # Another worker appends to the chat behind this worker's cache
+    other = db_utils.get_conversation(client, 1, "Test Chat")
+    db_utils.update_database(
+        client, other.data[0]["messages"], "From", "elsewhere", other
+    )
+    db_utils.update_database(
+        client, conversation.data[0]["messages"], "Hi", "Hello!", conversation
+    )
+    rows = client.tables["chat_messages"]
+    assert [(r["seq"], r["content"]) for r in rows][-2:] == [(2, "Hi"), (3, "Hello!")]
+    assert client.tables["chat_history"][0]["message_count"] == 4
+    # The next read goes back to the database and sees every message
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    assert len(conversation.data[0]["messages"]["messages"]) == 4
+
+
+def test_interleaved_appends_never_move_the_count_back():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    chat = conversation.data[0]
+    first = db_utils._append_messages_steps(
+        client, dict(chat), 0, db_utils._turn_messages("q0", "a0")
+    )
+    # The first writer inserts its rows, then stalls before its chat update
+    query = next(first)
+    while query.name != "chat_history":
+        query = first.send(query.execute())
+    # Meanwhile a second writer appends after those rows and updates the chat
+    db_utils._run(
+        db_utils._append_messages_steps(
+            client, dict(chat), 2, db_utils._turn_messages("q1", "a1")
+        )
+    )
+    with pytest.raises(StopIteration):
+        first.send(query.execute())
+    assert client.tables["chat_history"][0]["message_count"] == 4
+    # A writer with a stale count re-reads it and lands after both turns
+    db_utils.update_database(client, chat["messages"], "q2", "a2", conversation)
+    rows = client.tables["chat_messages"]
+    assert sorted(r["seq"] for r in rows) == list(range(6))
+    assert client.tables["chat_history"][0]["message_count"] == 6
+
+
+def chat_with_turns(client, turns):
+    conversation = new_chat(client)
+    for i in range(turns):
+        db_utils.update_database(
+            client, conversation.data[0]["messages"], f"q{i}", f"a{i}", conversation
+        )
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_messages_page_windows(cached):
+    client = InMemorySupabaseClient()
+    chat_with_turns(client, 5)  # seq 0..9
+    if not cached:
+        db_utils.conversation_cache.clear()
+
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=4)
+    assert [m["seq"] for m in page["messages"]] == [6, 7, 8, 9]
+    assert page["total"] == 10
+    assert page["has_more"] is True
+
+    page = db_utils.get_messages_page(
+        client, 1, "Test Chat", limit=4, before=page["next_before"]
+    )
+    assert [m["seq"] for m in page["messages"]] == [2, 3, 4, 5]
+
+    page = db_utils.get_messages_page(
+        client, 1, "Test Chat", limit=4, before=page["next_before"]
+    )
+    assert [m["seq"] for m in page["messages"]] == [0, 1]
+    assert page["has_more"] is False
+
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=3, after=6)
+    assert [m["seq"] for m in page["messages"]] == [7, 8, 9]
+    assert page["has_more"] is False
+
+
+def test_get_conversation_reads_only_recent_messages(monkeypatch):
+    client = InMemorySupabaseClient()
+    chat_with_turns(client, 5)  # seq 0..9
+    client.tables["chat_history"][0]["summary_seq"] = 3
+    monkeypatch.setattr(db_utils, "CONTEXT_MESSAGES", 4)
+    db_utils.conversation_cache.clear()
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    messages = conversation.data[0]["messages"]["messages"]
+    assert [m["seq"] for m in messages] == [6, 7, 8, 9]
+
+    # Pages the cached messages do not cover are read from the database
+    client.calls.clear()
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=3)
+    assert [m["seq"] for m in page["messages"]] == [7, 8, 9]
+    assert ("chat_messages", "select") not in client.calls
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=4, before=8)
+    assert [m["seq"] for m in page["messages"]] == [4, 5, 6, 7]
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=10, after=2)
+    assert [m["seq"] for m in page["messages"]] == [3, 4, 5, 6, 7, 8, 9]
+    assert client.calls.count(("chat_messages", "select")) == 2
+
+
+def test_messages_page_checks_the_cached_version():
+    client = InMemorySupabaseClient()
+    chat_with_turns(client, 1)
+    client.calls.clear()
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=10)
+    assert [m["seq"] for m in page["messages"]] == [0, 1]
+    # Only the chat row is read, the messages come from the cache
+    assert client.calls == [("chat_history", "select")]
+
+    # Another worker appends a turn
+    client.tables["chat_messages"].append(
+        {
+            **client.tables["chat_messages"][-1],
+            "seq": 2,
+            "content": "elsewhere",
+        }
+    )
+    client.tables["chat_history"][0]["message_count"] = 3
+    version = db_utils.get_chat_version(client, 1, "Test Chat")
+    assert version["message_count"] == 3
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=10, chat=version)
+    assert [m["content"] for m in page["messages"]][-1] == "elsewhere"
+    assert page["total"] == 3
+
+
+def test_search_reads_postings_per_term(monkeypatch):
+    monkeypatch.setattr(db_utils.search_utils, "MAX_POSTINGS", 3)
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    for question in ["common common common"] * 4 + ["common rare"]:
+        db_utils.update_database(
+            client, conversation.data[0]["messages"], question, "ok", conversation
+        )
+    # "common" has more postings than the limit, and does not hide "rare"
+    results = db_utils.search(client, 1, "common rare")
+    assert results[0]["seq"] == 8
+    assert results[0]["snippet"] == "common rare"
+
+
+def test_messages_page_projects_columns():
+    client = InMemorySupabaseClient()
+    chat_with_turns(client, 1)
+    db_utils.conversation_cache.clear()
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=10)
+    assert set(page["messages"][0]) == {
+        "seq",
+        "role",
+        "content",
+        "timestamp",
+        "interrupted",
+    }
+    assert db_utils.get_messages_page(client, 1, "Missing", limit=10) is None
+
+
+def test_parse_page_args():
+    assert db_utils.parse_page_args({}) == {
+        "limit": db_utils.DEFAULT_PAGE_SIZE,
+        "before": None,
+        "after": None,
+        "since": None,
+    }
+    page_args = db_utils.parse_page_args({"limit": "100000", "before": "7"})
+    assert (page_args["limit"], page_args["before"]) == (db_utils.MAX_PAGE_SIZE, 7)
+    # A numeric since is a sequence number, anything else a timestamp
+    assert db_utils.parse_page_args({"since": "12"})["after"] == 12
+    page_args = db_utils.parse_page_args({"since": "2025-03-07T16:10:28"})
+    assert page_args["since"] == "2025-03-07T16:10:28"
+    with pytest.raises(ValueError):
+        db_utils.parse_page_args({"before": "1", "after": "2"})
+    with pytest.raises(ValueError):
+        db_utils.parse_page_args({"limit": "ten"})
+    with pytest.raises(ValueError):
+        db_utils.parse_page_args({"since": "yesterday"})
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_messages_page_since_timestamp(cached):
+    client = InMemorySupabaseClient()
+    chat_with_turns(client, 2)
+    rows = client.tables["chat_messages"]
+    for seq, row in enumerate(rows):
+        row["timestamp"] = f"2025-03-07T16:10:0{seq}"
+    db_utils.conversation_cache.clear()
+    if cached:
+        db_utils.get_conversation(client, 1, "Test Chat")
+
+    page = db_utils.get_messages_page(
+        client, 1, "Test Chat", limit=10, since="2025-03-07T16:10:01"
+    )
+    assert [m["seq"] for m in page["messages"]] == [2, 3]
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    # A queue without a worker thread, flushed by the tests
+    queue = db_utils.WriteBehindQueue(retry_delay=0.01, max_attempts=3)
+    monkeypatch.setattr(queue, "_ensure_worker", lambda is_async: None)
+    monkeypatch.setattr(db_utils, "write_behind", queue)
+    return queue
+
+
+def test_write_behind_batches_and_reads_own_writes(queue):
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    for i in range(2):
+        db_utils.queue_update_database(
+            client, conversation.data[0]["messages"], f"q{i}", f"a{i}", conversation
+        )
+        conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    assert "chat_messages" not in client.tables
+    # Reads see the queued turns even when the cache lost them
+    db_utils.conversation_cache.clear()
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    messages = conversation.data[0]["messages"]["messages"]
+    assert [(m["seq"], m["content"]) for m in messages] == [
+        (0, "q0"),
+        (1, "a0"),
+        (2, "q1"),
+        (3, "a1"),
+    ]
+    assert db_utils.get_chat_version(client, 1, "Test Chat")["message_count"] == 4
+    page = db_utils.get_messages_page(client, 1, "Test Chat", limit=2)
+    assert [m["content"] for m in page["messages"]] == ["q1", "a1"]
+    updated_at = db_utils.get_chat_history_list(client, 1).data[0]["updated_at"]
+    assert updated_at == messages[-1]["timestamp"]
+
+    client.calls.clear()
+    assert queue.flush()
+    # Both turns go out in one insert (plus their search postings) and one
+    # chat update
+    assert client.calls == [
+        ("chat_messages", "insert"),
+        ("chat_search", "insert"),
+        ("chat_history", "update"),
+    ]
+    assert [r["seq"] for r in client.tables["chat_messages"]] == [0, 1, 2, 3]
+    assert client.tables["chat_history"][0]["message_count"] == 4
+    assert queue.stats()["pending_chats"] == 0
+    assert queue.stats()["written"] == 4
+
+
+def test_write_behind_retries_with_backoff(queue):
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    client.failures[("chat_messages", "insert")] = 1
+    db_utils.queue_update_database(
+        client, conversation.data[0]["messages"], "Hi", "Hello!", conversation
+    )
+    batches, _ = queue._take(0, is_async=False)
+    queue._write(*batches[0])
+    stats = queue.stats()
+    assert (stats["retried"], stats["pending_messages"]) == (1, 2)
+    # The retry waits for its backoff, flush on shutdown does not
+    assert queue._take(0, is_async=False)[0] == []
+    assert queue.flush()
+    assert [r["content"] for r in client.tables["chat_messages"]] == ["Hi", "Hello!"]
+
+
+def test_write_behind_gives_up_after_max_attempts(queue):
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    client.failures[("chat_messages", "insert")] = 10
+    db_utils.queue_update_database(
+        client, conversation.data[0]["messages"], "Hi", "Hello!", conversation
+    )
+    assert queue.flush()
+    assert queue.stats()["dropped"] == 2
+    # Reads go back to what the database holds
+    conversation = db_utils.get_conversation(client, 1, "Test Chat")
+    assert conversation.data[0]["messages"]["messages"] == []
+
+
+def test_write_behind_flush_chat_writes_one_chat(queue):
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    other = new_chat(client, chat_name="Other Chat")
+    for chat in (conversation, other):
+        db_utils.queue_update_database(
+            client, chat.data[0]["messages"], "Hi", "Hello!", chat
+        )
+    client.failures[("chat_messages", "insert")] = 1
+    # One attempt: a failed write is left to the worker, with its backoff
+    assert not queue.flush_chat(1, "Test Chat")
+    assert queue.flush_chat(1, "Test Chat")
+    assert [r["content"] for r in client.tables["chat_messages"]] == ["Hi", "Hello!"]
+    assert queue.stats()["pending_chats"] == 1
+    assert queue.flush_chat(1, "No Such Chat")
+
+
+def test_write_behind_worker_thread():
+    client = InMemorySupabaseClient()
+    conversation = new_chat(client)
+    db_utils.queue_update_database(
+        client, conversation.data[0]["messages"], "Hi", "Hello!", conversation
+    )
+    deadline = time.monotonic() + 5
+    while (
+        db_utils.write_behind.stats()["pending_chats"] and time.monotonic() < deadline
+    ):
+        time.sleep(0.01)
+    assert [r["content"] for r in client.tables["chat_messages"]] == ["Hi", "Hello!"]
+
+
+def test_concurrent_identical_reads_share_one_query(monkeypatch):
+    import threading
+
+    from prometheus_client import REGISTRY
+    from chat.tests.fake_supabase import InMemorySupabaseQuery
+
+    client = InMemorySupabaseClient()
+    db_utils.create_chat(client, 1, "Test Chat")
+    execute = InMemorySupabaseQuery._execute
+
+    def slow_execute(self):
+        time.sleep(0.05)
+        return execute(self)
+
+    monkeypatch.setattr(InMemorySupabaseQuery, "_execute", slow_execute)
+    labels = {"operation": "get_chat_history_list"}
+    coalesced = REGISTRY.get_sample_value("chat_db_coalesced_total", labels) or 0.0
+    client.calls.clear()
+    results = []
+
+    def read():
+        results.append(db_utils.get_chat_history_list(client, 1).data)
+
+    threads = [threading.Thread(target=read) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.calls == [("chat_history", "select")]
+    assert [[row["name"] for row in rows] for rows in results] == [["Test Chat"]] * 4
+    assert REGISTRY.get_sample_value("chat_db_coalesced_total", labels) == coalesced + 3
+
+    # Errors reach every caller that shared the query
+    client.failures[("chat_history", "select")] = 1
+    errors = []
+
+    def failing_read():
+        try:
+            db_utils.get_chat_history_list(client, 1)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=failing_read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
@@ -1,8 +1,12 @@
+import json
+import time
+
 import pytest
 from chat.deepseek import app as deepseek_app
 from chat.tests.conftest import (
     DummySupabaseClient,
-)  # Import the DummySupabaseClient defined in conftest
+    InMemorySupabaseClient,
+)  # Import the dummy Supabase clients defined in conftest
 
 
 # Define a fake jwt.decode function to bypass token verification
@@ -26,7 +30,7 @@ def patch_deepseek_dependencies(monkeypatch):
 
 
 def test_start_chat_success(client_deepseek):
-    token = "Bearer dummy_token"
+    token = "Bearer dummy.jwt.token"
     data = {"chat_name": "New Chat"}
     response = client_deepseek.post(
         "/start_chat", headers={"Authorization": token}, json=data
@@ -37,7 +41,7 @@ def test_start_chat_success(client_deepseek):
 
 
 def test_start_chat_invalid_payload(client_deepseek):
-    token = "Bearer dummy_token"
+    token = "Bearer dummy.jwt.token"
     data = {}  # Missing chat_name
     response = client_deepseek.post(
         "/start_chat", headers={"Authorization": token}, json=data
@@ -46,7 +50,7 @@ def test_start_chat_invalid_payload(client_deepseek):
 
 
 def test_chat_list_success(client_deepseek):
-    token = "Bearer dummy_token"
+    token = "Bearer dummy.jwt.token"
     response = client_deepseek.get("/chat_list", headers={"Authorization": token})
     result = response.get_json()
     assert response.status_code == 200
@@ -54,8 +58,556 @@ def test_chat_list_success(client_deepseek):
 
 
 def test_chat_history_missing_chat_name(client_deepseek):
-    token = "Bearer dummy_token"
+    token = "Bearer dummy.jwt.token"
     response = client_deepseek.get("/chat_history", headers={"Authorization": token})
     result = response.get_json()
     assert response.status_code == 400
     assert "message" in result
+
+
+def test_chatbot_stream_and_non_stream():
+    from types import SimpleNamespace
+    from utils.chatbot_utils import ChatBot
+
+    def create(stream=False, **kwargs):
+        if not stream:
+            message = SimpleNamespace(content="Hello!")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+        delta = SimpleNamespace(content="Hello!")
+        # The usage-only chunk at the end of the stream has no choices
+        return iter(
+            [
+                SimpleNamespace(choices=[SimpleNamespace(delta=delta)]),
+                SimpleNamespace(choices=[], usage=None),
+            ]
+        )
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace()))
+    client.chat.completions.create = create
+    history = [{"role": "user", "content": "Hi"}]
+    assert ChatBot(client).chat(history, stream=False) == "Hello!"
+    assert list(ChatBot(client).chat(history, stream=True)) == ["Hello!"]
+
+
+def test_chatbot_completion_cache(tmp_path):
+    from types import SimpleNamespace
+    from utils.cache_utils import SQLiteLRUCache
+    from utils.chatbot_utils import ChatBot
+
+    calls = []
+
+    def create(stream=False, **kwargs):
+        calls.append(stream)
+        if not stream:
+            message = SimpleNamespace(content="Hello, world")
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+        deltas = [SimpleNamespace(content=c) for c in ("Hello", ", world")]
+        return iter(
+            [SimpleNamespace(choices=[SimpleNamespace(delta=d)]) for d in deltas]
+        )
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace()))
+    client.chat.completions.create = create
+    cache = SQLiteLRUCache(str(tmp_path / "cache.sqlite3"), max_bytes=10000, ttl=60)
+    history = [{"role": "user", "content": "Hi"}]
+
+    # An abandoned stream is not cached
+    next(ChatBot(client, cache=cache).chat(history, stream=True))
+    assert cache.stats()["entries"] == 0
+    assert list(ChatBot(client, cache=cache).chat(history, stream=True)) == [
+        "Hello",
+        ", world",
+    ]
+    # The same request is answered from the cache, stream or not
+    assert list(ChatBot(client, cache=cache).chat(history, stream=True)) == [
+        "Hello",
+        ", world",
+    ]
+    assert ChatBot(client, cache=cache).chat(history, stream=False) == "Hello, world"
+    assert calls == [True, True]
+    # A different conversation misses
+    other = [{"role": "user", "content": "Hi!"}]
+    assert ChatBot(client, cache=cache).chat(other, stream=False) == "Hello, world"
+    assert calls == [True, True, False]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (2, 3)
+
+
+def fake_llm(reply):
+    from types import SimpleNamespace
+
+    def create(stream=False, **kwargs):
+        if stream:
+            delta = SimpleNamespace(content=reply)
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=delta)])])
+        message = SimpleNamespace(content=reply)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    completions = SimpleNamespace(create=create)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    db = InMemorySupabaseClient()
+    monkeypatch.setattr("chat.deepseek.supabase_client", db)
+    monkeypatch.setattr("chat.deepseek.client_xunfei", fake_llm("Hello!"))
+    return db
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_send_message_then_chat_history(client_deepseek, memory_db, stream):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    response = client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "Hi", "chat_name": "Chat", "stream": stream},
+    )
+    assert response.status_code == 200
+    assert "Hello!" in response.get_data(as_text=True)
+    assert int(response.headers["X-Prompt-Tokens"]) > 0
+    assert response.headers["X-Prompt-Tokens-Saved"] == "0"
+
+    response = client_deepseek.get(
+        "/chat_history?chat_name=Chat",
+        headers={"Authorization": "Bearer dummy.jwt.token"},
+    )
+    messages = response.get_json()["messages"]
+    assert [(m["role"], m["content"]) for m in messages] == [
+        ("user", "Hi"),
+        ("assistant", "Hello!"),
+    ]
+
+
+def test_sqlite_storage_backend(client_deepseek, monkeypatch, tmp_path):
+    from utils.db_utils import conversation_cache, write_behind
+    from utils.storage_utils import SQLiteClient
+
+    monkeypatch.setattr(
+        "chat.deepseek.supabase_client", SQLiteClient(str(tmp_path / "chat.sqlite3"))
+    )
+    monkeypatch.setattr("chat.deepseek.client_xunfei", fake_llm("Hello!"))
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    response = client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "Hi", "chat_name": "Chat", "stream": False},
+    )
+    assert response.status_code == 200
+    write_behind.flush()
+    conversation_cache.clear()
+    messages = client_deepseek.get(
+        "/chat_history?chat_name=Chat", headers=headers
+    ).get_json()["messages"]
+    assert [m["content"] for m in messages] == ["Hi", "Hello!"]
+    chats = client_deepseek.get("/chat_list", headers=headers).get_json()
+    assert chats == {"chats": ["Chat"]}
+
+
+def test_search_endpoint(client_deepseek, memory_db):
+    from utils.db_utils import write_behind
+
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "Tell me about otters", "chat_name": "Chat", "stream": False},
+    )
+    write_behind.flush()
+    response = client_deepseek.get("/search?q=Otters", headers=headers)
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [(r["chat_name"], r["seq"]) for r in results] == [("Chat", 0)]
+    assert results[0]["snippet"] == "Tell me about otters"
+    assert client_deepseek.get("/search?q=", headers=headers).status_code == 400
+    assert (
+        client_deepseek.get("/search?q=a&limit=x", headers=headers).status_code == 400
+    )
+
+
+def test_chat_history_etag_and_since(client_deepseek, memory_db):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "Hi", "chat_name": "Chat", "stream": False},
+    )
+
+    response = client_deepseek.get("/chat_history?chat_name=Chat", headers=headers)
+    etag = response.headers["ETag"]
+    response = client_deepseek.get(
+        "/chat_history?chat_name=Chat", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.get_data() == b""
+
+    client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "More", "chat_name": "Chat", "stream": False},
+    )
+    # A new turn changes the version, and since= returns only the new messages
+    response = client_deepseek.get(
+        "/chat_history?chat_name=Chat&since=1",
+        headers={**headers, "If-None-Match": etag},
+    )
+    assert response.status_code == 200
+    assert [m["content"] for m in response.get_json()["messages"]] == [
+        "More",
+        "Hello!",
+    ]
+
+
+def test_chat_list_etag(client_deepseek, memory_db):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    response = client_deepseek.get("/chat_list", headers=headers)
+    assert response.get_json() == {"chats": ["Chat"]}
+    etag = response.headers["ETag"]
+    response = client_deepseek.get(
+        "/chat_list", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Other"})
+    response = client_deepseek.get(
+        "/chat_list", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+
+
+def test_send_message_overloaded(client_deepseek, memory_db, monkeypatch, tmp_path):
+    from utils.load_utils import AdmissionController, LoadSampler, SharedState
+
+    state = SharedState(str(tmp_path / "load.json"))
+    full = AdmissionController(state, LoadSampler(state, 0), limit=0, queue_size=0)
+    monkeypatch.setattr("chat.deepseek.admission", full)
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    response = client_deepseek.post(
+        "/send_message", headers=headers, json={"message": "Hi", "chat_name": "Chat"}
+    )
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_failed_stream_setup_frees_the_slot(
+    client_deepseek, memory_db, monkeypatch, tmp_path
+):
+    from utils.load_utils import AdmissionController, LoadSampler, SharedState
+
+    state = SharedState(str(tmp_path / "load.json"))
+    admission = AdmissionController(state, LoadSampler(state, 0), limit=1)
+    monkeypatch.setattr("chat.deepseek.admission", admission)
+
+    def broken_create(user_id):
+        raise RuntimeError("stream buffer unavailable")
+
+    monkeypatch.setattr("chat.deepseek.stream_buffer.create", broken_create)
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    with pytest.raises(RuntimeError):
+        client_deepseek.post(
+            "/send_message",
+            headers=headers,
+            json={"message": "Hi", "chat_name": "Chat"},
+        )
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_send_message_through_llm_pool(client_deepseek, memory_db, monkeypatch):
+    from openai import OpenAI
+    from chat.tests.fake_openai import FakeOpenAIServer
+    from utils.llm_pool_utils import LLMPool
+
+    broken, healthy = FakeOpenAIServer(fail=100), FakeOpenAIServer()
+    try:
+        pool = LLMPool(
+            [
+                OpenAI(api_key="key", base_url=s.base_url, max_retries=0)
+                for s in (broken, healthy)
+            ]
+        )
+        monkeypatch.setattr("chat.deepseek.client_xunfei", pool)
+        headers = {"Authorization": "Bearer dummy.jwt.token"}
+        client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+        for _ in range(2):
+            response = client_deepseek.post(
+                "/send_message",
+                headers=headers,
+                json={"message": "Hi", "chat_name": "Chat"},
+            )
+            assert response.get_data(as_text=True) == "Hello, world"
+        health = client_deepseek.get("/health").get_json()
+        assert len(health["llm"]["endpoints"]) == 2
+    finally:
+        broken.close()
+        healthy.close()
+
+
+def test_metrics_endpoint(client_deepseek, memory_db):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    client_deepseek.post(
+        "/send_message", headers=headers, json={"message": "Hi", "chat_name": "Chat"}
+    )
+    response = client_deepseek.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    body = response.get_data(as_text=True)
+    assert "chat_llm_ttft_seconds_bucket" in body
+    assert 'chat_db_seconds_count{operation="create_chat"}' in body
+
+
+def test_client_disconnect_cancels_llm_stream(client_deepseek, memory_db, monkeypatch):
+    from openai import OpenAI
+    from prometheus_client import REGISTRY
+    from chat.tests.fake_openai import FakeOpenAIServer
+    from utils.db_utils import write_behind
+
+    # A slow model: 200 tokens, 20ms apart
+    llm = FakeOpenAIServer(chunks=["tok "] * 200, delay=0.02)
+    saved = REGISTRY.get_sample_value("chat_llm_tokens_saved_total") or 0.0
+    # The reply is kept going this long for a client to resume it
+    monkeypatch.setattr("chat.deepseek.stream_buffer.grace", 0.2)
+    try:
+        client = OpenAI(api_key="key", base_url=llm.base_url, max_retries=0)
+        monkeypatch.setattr("chat.deepseek.client_xunfei", client)
+        headers = {"Authorization": "Bearer dummy.jwt.token"}
+        client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+        response = client_deepseek.post(
+            "/send_message",
+            headers=headers,
+            json={"message": "Hi", "chat_name": "Chat"},
+        )
+        # The first delta reaches the client without waiting for a batch
+        assert next(response.iter_encoded()).startswith(b"tok ")
+        response.close()  # The client went away
+
+        deadline = time.monotonic() + 2
+        while not llm.disconnects and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert llm.disconnects == 1
+        assert llm.sent < 50
+    finally:
+        llm.close()
+
+    write_behind.flush()
+    assert (REGISTRY.get_sample_value("chat_llm_tokens_saved_total") or 0.0) > saved
+    messages = client_deepseek.get(
+        "/chat_history?chat_name=Chat", headers=headers
+    ).get_json()["messages"]
+    assert [m["role"] for m in messages] == ["user", "assistant"]
+    assert messages[1]["interrupted"] is True
+    assert messages[1]["content"].startswith("tok tok ")
+    assert len(messages[1]["content"]) < 200 * len("tok ")
+    rows = memory_db.tables["chat_messages"]
+    assert [r.get("interrupted") for r in rows] == [None, True]
+
+
+def test_resume_stream_after_a_dropped_connection(
+    client_deepseek, memory_db, monkeypatch
+):
+    from openai import OpenAI
+    from chat.tests.fake_openai import FakeOpenAIServer
+    from utils.db_utils import write_behind
+
+    reply = [f"{i} " for i in range(30)]
+    llm = FakeOpenAIServer(chunks=reply, delay=0.01)
+    try:
+        client = OpenAI(api_key="key", base_url=llm.base_url, max_retries=0)
+        monkeypatch.setattr("chat.deepseek.client_xunfei", client)
+        headers = {"Authorization": "Bearer dummy.jwt.token"}
+        client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+        response = client_deepseek.post(
+            "/send_message",
+            headers=headers,
+            json={"message": "Hi", "chat_name": "Chat"},
+        )
+        stream_id = response.headers["X-Stream-Id"]
+        received = next(response.iter_encoded())
+        response.close()  # The connection drops
+
+        resumed = client_deepseek.get(
+            f"/stream/{stream_id}?offset={len(received)}", headers=headers
+        )
+        assert resumed.status_code == 200
+        assert (received + resumed.get_data()).decode() == "".join(reply)
+        assert len(llm.requests) == 1  # Not generated again
+    finally:
+        llm.close()
+
+    write_behind.flush()
+    messages = client_deepseek.get(
+        "/chat_history?chat_name=Chat", headers=headers
+    ).get_json()["messages"]
+    assert messages[1]["content"] == "".join(reply)
+    assert not messages[1].get("interrupted")
+
+    assert (
+        client_deepseek.get(
+            f"/stream/{stream_id}?offset=x", headers=headers
+        ).status_code
+        == 400
+    )
+    assert client_deepseek.get("/stream/unknown", headers=headers).status_code == 404
+    monkeypatch.setattr(
+        "chat.deepseek.jwt.decode", lambda token, secret, algorithms: {"user_id": 2}
+    )
+    from utils.auth_utils import token_cache
+
+    token_cache.clear()
+    # Another user's reply is not found
+    assert (
+        client_deepseek.get(f"/stream/{stream_id}", headers=headers).status_code == 404
+    )
+
+
+def test_export_then_import(client_deepseek, memory_db, monkeypatch):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    client_deepseek.post(
+        "/send_message",
+        headers=headers,
+        json={"message": "Hi", "chat_name": "Chat", "stream": False},
+    )
+    response = client_deepseek.get("/export", headers=headers)
+    assert response.mimetype == "application/x-ndjson"
+    body = response.get_data()
+    # Turns still queued are exported
+    assert [json.loads(line).get("content") for line in body.splitlines()][2:] == [
+        "Hi",
+        "Hello!",
+    ]
+
+    monkeypatch.setattr("chat.deepseek.supabase_client", InMemorySupabaseClient())
+    response = client_deepseek.post("/import", headers=headers, data=body)
+    assert response.get_json() == {
+        "chats": 1,
+        "messages": 2,
+        "skipped_chats": 0,
+        "skipped_messages": 0,
+        "last_chat": "Chat",
+    }
+    # Imported again after a bad record: the messages there are skipped
+    response = client_deepseek.post(
+        "/import", headers=headers, data=body + b'\n{"type": "chat"}\n'
+    )
+    assert response.status_code == 400
+    assert response.get_json()["skipped_messages"] == 2
+
+
+def test_send_message_idempotency_key(
+    client_deepseek, memory_db, monkeypatch, tmp_path
+):
+    from openai import OpenAI
+    from chat.tests.fake_openai import FakeOpenAIServer
+    from utils.db_utils import write_behind
+    from utils.idempotency_utils import IdempotencyStore
+
+    monkeypatch.setattr(
+        "chat.deepseek.idempotency",
+        IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), poll_interval=0.01),
+    )
+    reply = [f"{i} " for i in range(30)]
+    llm = FakeOpenAIServer(chunks=reply, delay=0.01)
+    headers = {"Authorization": "Bearer dummy.jwt.token", "Idempotency-Key": "k1"}
+    payload = {"message": "Hi", "chat_name": "Chat"}
+    try:
+        client = OpenAI(api_key="key", base_url=llm.base_url, max_retries=0)
+        monkeypatch.setattr("chat.deepseek.client_xunfei", client)
+        client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+        first = client_deepseek.post("/send_message", headers=headers, json=payload)
+        # A retry while the reply is generated follows it from the start
+        retry = client_deepseek.post("/send_message", headers=headers, json=payload)
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.headers["X-Stream-Id"] == first.headers["X-Stream-Id"]
+        assert retry.get_data(as_text=True) == "".join(reply)
+        assert first.get_data(as_text=True) == "".join(reply)
+
+        # A retry after it completed replays it
+        retry = client_deepseek.post("/send_message", headers=headers, json=payload)
+        assert retry.get_data(as_text=True) == "".join(reply)
+        response = client_deepseek.post(
+            "/send_message", headers=headers, json={**payload, "message": "Other"}
+        )
+        assert response.status_code == 422
+        assert len(llm.requests) == 1
+    finally:
+        llm.close()
+
+    write_behind.flush()
+    messages = client_deepseek.get(
+        "/chat_history?chat_name=Chat", headers=headers
+    ).get_json()["messages"]
+    assert [m["role"] for m in messages] == ["user", "assistant"]
+
+
+def test_failed_request_releases_its_idempotency_key(
+    client_deepseek, memory_db, monkeypatch, tmp_path
+):
+    from utils.idempotency_utils import IdempotencyStore
+
+    store = IdempotencyStore(str(tmp_path / "idempotency.sqlite3"))
+    monkeypatch.setattr("chat.deepseek.idempotency", store)
+    headers = {"Authorization": "Bearer dummy.jwt.token", "Idempotency-Key": "k1"}
+    payload = {"message": "Hi", "chat_name": "Chat", "stream": False}
+    response = client_deepseek.post("/send_message", headers=headers, json=payload)
+    assert response.status_code == 404
+    assert store.get(1, "k1") is None
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    response = client_deepseek.post("/send_message", headers=headers, json=payload)
+    assert response.get_json() == {"message": "Hello!"}
+    retry = client_deepseek.post("/send_message", headers=headers, json=payload)
+    assert retry.get_json() == {"message": "Hello!"}
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    headers["Idempotency-Key"] = "x" * 300
+    response = client_deepseek.post("/send_message", headers=headers, json=payload)
+    assert response.status_code == 400
+
+
+def test_tokens_used():
+    from types import SimpleNamespace
+
+    from utils.chatbot_utils import ChatBot
+
+    chatbot = ChatBot(None)
+    assert chatbot.tokens_used(50) == (0, 0)  # Nothing generated
+    chatbot.usage = SimpleNamespace(prompt_tokens=40, completion_tokens=7)
+    assert chatbot.tokens_used(50) == (40, 7)
+    # A stream cut short has no usage: estimated from the prompt and chunks
+    chatbot.usage, chatbot.generated = None, 12
+    assert chatbot.tokens_used(50) == (50, 12)
+    chatbot.cached = True
+    assert chatbot.tokens_used(50) == (0, 0)
+
+
+def test_usage_endpoint(client_deepseek, memory_db):
+    headers = {"Authorization": "Bearer dummy.jwt.token"}
+    client_deepseek.post("/start_chat", headers=headers, json={"chat_name": "Chat"})
+    for stream in (True, False):
+        response = client_deepseek.post(
+            "/send_message",
+            headers=headers,
+            json={"message": "Hi", "chat_name": "Chat", "stream": stream},
+        )
+        response.get_data()
+    # A streamed reply is accounted by its producer once the model is done
+    deadline = time.monotonic() + 2
+    while True:
+        response = client_deepseek.get("/usage?days=7", headers=headers)
+        assert response.status_code == 200
+        usage = response.get_json()
+        if usage["total"]["requests"] == 2 or time.monotonic() > deadline:
+            break
+        time.sleep(0.01)
+    assert usage["total"]["requests"] == 2
+    assert usage["total"]["prompt_tokens"] > 0
+    assert usage["total"]["completion_tokens"] > 0
+    assert [c["chat_name"] for c in usage["chats"]] == ["Chat"]
+    assert usage["limits"]["heavy"] is False
+    assert usage["limits"]["recent_tokens"] >= usage["total"]["total_tokens"]
+    assert client_deepseek.get("/usage?days=x", headers=headers).status_code == 400
@@ -0,0 +1,293 @@
+import json
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from chat import deepseek_async
+from chat.tests.conftest import DummySupabaseResponse
+
+
+# Fake AsyncOpenAI client streaming a fixed reply with a delay per token
+class FakeAsyncCompletions:
+    def __init__(self, chunks, delay):
+        self.chunks = chunks
+        self.delay = delay
+
+    async def create(self, stream=False, **kwargs):
+        if not stream:
+            await asyncio.sleep(self.delay * len(self.chunks))
+            message = SimpleNamespace(content="".join(self.chunks))
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+        return self._stream()
+
+    async def _stream(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            delta = SimpleNamespace(content=chunk)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+        # Final usage-only chunk, as requested by include_usage
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(total_tokens=1))
+
+
+def fake_async_llm(chunks, delay):
+    completions = FakeAsyncCompletions(chunks, delay)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+
+# Async Supabase stand-in where every chat exists and has no messages
+class DummyAsyncSupabaseTable:
+    def __init__(self):
+        self.filters = {}
+
+    def select(self, columns="*"):
+        return self
+
+    def eq(self, key, value):
+        self.filters[key] = value
+        return self
+
+    def lt(self, key, value):
+        return self
+
+    def insert(self, data):
+        return self
+
+    def update(self, data):
+        return self
+
+    async def execute(self):
+        await asyncio.sleep(0)
+        return DummySupabaseResponse(
+            [{"id": 1, "name": "Test Chat", "messages": {"messages": []}}]
+        )
+
+
+class DummyAsyncSupabaseClient:
+    def table(self, name):
+        return DummyAsyncSupabaseTable()
+
+
+@pytest.fixture(autouse=True)
+def patch_async_dependencies(monkeypatch):
+    monkeypatch.setattr(
+        "chat.deepseek_async.jwt.decode",
+        lambda token, secret, algorithms: {"user_id": 1},
+    )
+    monkeypatch.setattr(deepseek_async, "supabase_client", DummyAsyncSupabaseClient())
+
+
+HEADERS = {"Authorization": "Bearer dummy.jwt.token"}
+
+
+async def send_messages(count):
+    client = deepseek_async.app.test_client()
+
+    async def one():
+        response = await client.post(
+            "/send_message",
+            headers=HEADERS,
+            json={"message": "Hi", "chat_name": "Test Chat"},
+        )
+        return await response.get_data(as_text=True)
+
+    return await asyncio.gather(*(one() for _ in range(count)))
+
+
+def test_chat_list_async():
+    async def run():
+        client = deepseek_async.app.test_client()
+        response = await client.get("/chat_list", headers=HEADERS)
+        return response.status_code, await response.get_json()
+
+    status, result = asyncio.run(run())
+    assert status == 200
+    assert result == {"chats": ["Test Chat"]}
+
+
+def test_chat_history_missing_chat_name_async():
+    async def run():
+        client = deepseek_async.app.test_client()
+        response = await client.get("/chat_history", headers=HEADERS)
+        return response.status_code
+
+    assert asyncio.run(run()) == 400
+
+
+def test_send_message_non_streaming_async(monkeypatch):
+    monkeypatch.setattr(deepseek_async, "client_xunfei", fake_async_llm(["Hi!"], 0))
+
+    async def run():
+        client = deepseek_async.app.test_client()
+        response = await client.post(
+            "/send_message",
+            headers=HEADERS,
+            json={"message": "Hi", "chat_name": "Test Chat", "stream": False},
+        )
+        return response.status_code, await response.get_json()
+
+    assert asyncio.run(run()) == (200, {"message": "Hi!"})
+
+
+def test_concurrent_streams_scale(monkeypatch):
+    """
+    Load test: one process serves N concurrent streams against a fake LLM.
+    Sync workers would need N * stream_time, the event loop stays close to one.
+    """
+    chunks, delay = ["Hello", ", ", "world", "!"] * 5, 0.01
+    monkeypatch.setattr(deepseek_async, "client_xunfei", fake_async_llm(chunks, delay))
+    # All the streams are of one user, who may otherwise only hold a few slots
+    monkeypatch.setattr(deepseek_async.admission, "user_limit", 1000)
+    stream_time = len(chunks) * delay
+
+    results = {}
+    for concurrency in (1, 50, 200):
+        started = time.perf_counter()
+        replies = asyncio.run(send_messages(concurrency))
+        results[concurrency] = time.perf_counter() - started
+        assert replies == ["".join(chunks)] * concurrency
+
+    for concurrency, elapsed in results.items():
+        print(
+            f"{concurrency:>4} concurrent streams: {elapsed:.2f}s "
+            f"(sequential {concurrency * stream_time:.2f}s)"
+        )
+    assert results[200] < 200 * stream_time / 5
+
+
+def test_failed_stream_setup_frees_the_slot(monkeypatch, tmp_path):
+    from utils.load_utils import AdmissionController, LoadSampler, SharedState
+
+    state = SharedState(str(tmp_path / "load.json"))
+    admission = AdmissionController(state, LoadSampler(state, 0), limit=1)
+    monkeypatch.setattr(deepseek_async, "admission", admission)
+    monkeypatch.setattr(deepseek_async, "client_xunfei", fake_async_llm(["Hi"], 0))
+
+    def broken_create(user_id):
+        raise RuntimeError("stream buffer unavailable")
+
+    monkeypatch.setattr(deepseek_async.stream_buffer, "create", broken_create)
+
+    async def run():
+        client = deepseek_async.app.test_client()
+        response = await client.post(
+            "/send_message",
+            headers=HEADERS,
+            json={"message": "Hi", "chat_name": "Test Chat"},
+        )
+        return response.status_code
+
+    assert asyncio.run(run()) == 500
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_achat_completion_cache(tmp_path):
+    from utils.cache_utils import SQLiteLRUCache
+    from utils.chatbot_utils import ChatBot
+
+    client = fake_async_llm(["Hello", ", world"], 0)
+    cache = SQLiteLRUCache(str(tmp_path / "cache.sqlite3"), max_bytes=10000, ttl=60)
+    history = [{"role": "user", "content": "Hi"}]
+
+    async def stream():
+        chatbot = ChatBot(client, cache=cache)
+        return [chunk async for chunk in chatbot.achat(history, stream=True)]
+
+    assert asyncio.run(stream()) == ["Hello", ", world"]
+    client.chat.completions.chunks = ["changed"]
+    # Replayed from the cache, stream or not
+    assert asyncio.run(stream()) == ["Hello", ", world"]
+    reply = asyncio.run(ChatBot(client, cache=cache).achat(history, stream=False))
+    assert reply == "Hello, world"
+    assert cache.stats()["hits"] == 2
+
+
+def test_astream_close_stops_the_model():
+    from utils.chatbot_utils import ChatBot
+
+    client = fake_async_llm(["Hello", ", ", "world"], 0.01)
+    closed = []
+    stream_llm = client.chat.completions._stream
+
+    async def tracked_stream():
+        try:
+            async for chunk in stream_llm():
+                yield chunk
+        finally:
+            closed.append(True)
+
+    client.chat.completions._stream = tracked_stream
+
+    async def run():
+        stream = ChatBot(client).achat([{"role": "user", "content": "Hi"}], stream=True)
+        first = await stream.__anext__()
+        await stream.aclose()  # The client went away
+        return first
+
+    assert asyncio.run(run()) == "Hello"
+    assert closed == [True]
+
+
+def test_import_then_export_async(monkeypatch, tmp_path):
+    from utils.storage_utils import AsyncSQLiteClient
+
+    monkeypatch.setattr(
+        deepseek_async,
+        "supabase_client",
+        AsyncSQLiteClient(str(tmp_path / "chat.sqlite3")),
+    )
+    lines = [
+        b'{"type": "export", "version": 1}',
+        b'{"type": "chat", "name": "Chat"}',
+        b'{"type": "message", "chat": "Chat", "role": "user", "content": "Hi"}',
+        b'{"type": "message", "chat": "Chat", "role": "assistant", "content": "Yo"}',
+    ]
+
+    async def main():
+        client = deepseek_async.app.test_client()
+        response = await client.post("/import", headers=HEADERS, data=b"\n".join(lines))
+        assert response.status_code == 200
+        assert (await response.get_json())["messages"] == 2
+        response = await client.post("/import", headers=HEADERS, data=b"{oops")
+        assert response.status_code == 400
+        response = await client.get("/export", headers=HEADERS)
+        assert response.mimetype == "application/x-ndjson"
+        return await response.get_data(as_text=True)
+
+    records = [json.loads(line) for line in asyncio.run(main()).splitlines()]
+    assert [r.get("content") for r in records[2:]] == ["Hi", "Yo"]
+
+
+def test_idempotency_key_replays_async(monkeypatch, tmp_path):
+    from utils.idempotency_utils import IdempotencyStore
+
+    llm = fake_async_llm(["Hi!"], 0)
+    calls = []
+    create = llm.chat.completions.create
+
+    async def counted_create(**kwargs):
+        calls.append(kwargs)
+        return await create(**kwargs)
+
+    llm.chat.completions.create = counted_create
+    monkeypatch.setattr(deepseek_async, "client_xunfei", llm)
+    monkeypatch.setattr(
+        deepseek_async,
+        "idempotency",
+        IdempotencyStore(str(tmp_path / "idempotency.sqlite3")),
+    )
+    headers = {**HEADERS, "Idempotency-Key": "k1"}
+    payload = {"message": "Hi", "chat_name": "Test Chat", "stream": False}
+
+    async def run():
+        client = deepseek_async.app.test_client()
+        replies = []
+        for message in ("Hi", "Hi", "Other"):
+            response = await client.post(
+                "/send_message", headers=headers, json={**payload, "message": message}
+            )
+            replies.append((response.status_code, await response.get_json()))
+        return replies
+
+    assert [status for status, _ in asyncio.run(run())] == [200, 200, 422]
+    assert len(calls) == 1
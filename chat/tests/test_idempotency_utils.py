@@ -0,0 +1,112 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+from utils.idempotency_utils import (
+    IdempotencyConflict,
+    IdempotencyPending,
+    IdempotencyStore,
+    fingerprint,
+)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), poll_interval=0.01)
+
+
+def test_fingerprint_ignores_key_order():
+    assert fingerprint({"a": 1, "b": [2]}) == fingerprint({"b": [2], "a": 1})
+    assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+
+
+def test_first_request_claims_the_key(store):
+    assert store.begin(1, "k", "digest") is None
+    record = store.begin(1, "k", "digest")
+    assert record["done"] is False and record["stream_id"] is None
+    # Keys are per user
+    assert store.begin(2, "k", "other") is None
+    with pytest.raises(IdempotencyConflict):
+        store.begin(1, "k", "other")
+
+    store.attach(1, "k", "stream")
+    store.complete(1, "k", "Hello!", interrupted=True)
+    # Shared with the other workers of the host
+    other = IdempotencyStore(store.path)
+    assert other.begin(1, "k", "digest") == {
+        "fingerprint": "digest",
+        "stream_id": "stream",
+        "done": True,
+        "reply": "Hello!",
+        "interrupted": True,
+    }
+
+
+def test_claim_waits_for_the_request_holding_the_key(store):
+    assert store.claim(1, "k", "digest") is None
+
+    def original():
+        time.sleep(0.05)
+        store.attach(1, "k", "stream")
+
+    threading.Thread(target=original).start()
+    assert store.claim(1, "k", "digest", timeout=2)["stream_id"] == "stream"
+
+    assert store.claim(1, "slow", "digest") is None
+    with pytest.raises(IdempotencyPending):
+        store.claim(1, "slow", "digest", timeout=0.05)
+    # A retry runs the request again once the original failed
+    store.release(1, "slow")
+    assert asyncio.run(store.aclaim(1, "slow", "digest")) is None
+
+
+def test_records_expire(store):
+    store.ttl, store.pending_ttl = 0.05, 0.1
+    store.begin(1, "done", "digest")
+    store.complete(1, "done", "Hello!")
+    store.begin(1, "lost", "digest")
+    time.sleep(0.06)
+    assert store.begin(1, "other", "digest") is None  # Drops expired records
+    assert store.get(1, "done") is None
+    assert store.begin(1, "lost", "digest") is not None  # Still running
+    time.sleep(0.1)
+    assert store.begin(1, "lost", "digest") is None  # Taken as lost
+
+
+def test_aclaim_does_not_block_the_event_loop(store):
+    store.get(1, "k")  # Creates the table
+    # Another worker holds the write lock of the file for a while
+    other = sqlite3.connect(store.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+
+    async def run():
+        ticks = []
+
+        async def tick():
+            while len(ticks) < 5:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.ensure_future(tick())
+        claiming = asyncio.ensure_future(store.aclaim(1, "k", "digest"))
+        cancelled = asyncio.ensure_future(store.aclaim(1, "gone", "digest"))
+        await asyncio.sleep(0.2)
+        assert len(ticks) == 5
+        assert not claiming.done()
+        cancelled.cancel()
+        other.execute("COMMIT")
+        await ticker
+        assert await claiming is None
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        # The key claimed meanwhile is given up
+        for _ in range(100):
+            if store.get(1, "gone") is None:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert store.get(1, "k")["done"] is False
+    assert store.get(1, "gone") is None
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI, OpenAI
+
+from chat.tests.fake_openai import FakeOpenAIServer
+from utils import llm_pool_utils
+from utils.chatbot_utils import ChatBot
+from utils.llm_pool_utils import AsyncLLMPool, LLMPool, llm_endpoints
+
+MESSAGES = [{"role": "user", "content": "Hi"}]
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(**kwargs):
+        server = FakeOpenAIServer(**kwargs)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.close()
+
+
+def clients(*servers, client_class=OpenAI):
+    return [
+        client_class(api_key="key", base_url=s.base_url, max_retries=0) for s in servers
+    ]
+
+
+def stream(pool):
+    chunks = pool.chat.completions.create(model="m", messages=MESSAGES, stream=True)
+    return [c.choices[0].delta.content for c in chunks if c.choices]
+
+
+def test_llm_endpoints():
+    assert llm_endpoints("http://a", "k", "http://b|k2, http://c") == [
+        ("http://a", "k"),
+        ("http://b", "k2"),
+        ("http://c", "k"),
+    ]
+
+
+def test_failover_before_first_token(servers):
+    broken, healthy = servers(fail=100), servers()
+    pool = LLMPool(clients(broken, healthy), failure_threshold=1)
+    pool.endpoints[0].ttft_ewma = 0.001  # Make the broken endpoint look fastest
+    pool.endpoints[1].ttft_ewma = 1.0
+    assert stream(pool) == ["Hello", ", world"]
+    broken_state, healthy_state = pool.snapshot()["endpoints"]
+    assert (broken_state["state"], broken_state["total_failures"]) == ("open", 1)
+    assert healthy_state["total_requests"] == 1
+    # The ejected endpoint is skipped, non-streaming calls fail over as well
+    response = pool.chat.completions.create(model="m", messages=MESSAGES)
+    assert response.choices[0].message.content == "Hello, world"
+    assert len(broken.requests) == 1
+
+
+def test_routes_to_fastest_endpoint(servers):
+    slow, fast = servers(ttft=0.1), servers()
+    pool = LLMPool(clients(slow, fast))
+    for _ in range(2):  # Each endpoint gets measured once
+        stream(pool)
+    for _ in range(3):
+        stream(pool)
+    assert (len(slow.requests), len(fast.requests)) == (1, 4)
+
+
+def test_hedged_request_keeps_faster_reply(servers):
+    slow, fast = servers(ttft=1.0), servers()
+    pool = LLMPool(clients(slow, fast), hedge=True, hedge_delay=0.05)
+    pool.endpoints[0].ttft_ewma = 0.001
+    pool.endpoints[1].ttft_ewma = 1.0
+    started = time.monotonic()
+    assert stream(pool) == ["Hello", ", world"]
+    assert time.monotonic() - started < 0.8
+    assert (pool.hedges, pool.hedges_won) == (1, 1)
+    assert len(slow.requests) == 1
+
+
+def test_chatbot_reports_error_when_every_endpoint_fails(servers):
+    pool = LLMPool(clients(servers(fail=100), servers(fail=100)))
+    assert ChatBot(pool).chat(MESSAGES).startswith("Error: ")
+    # Both endpoints were tried, then one retried, up to max_attempts
+    assert sorted(e.total_failures for e in pool.endpoints) == [1, 2]
+
+
+def test_hedge_delay_follows_p95():
+    pool = LLMPool([], hedge=True, hedge_delay=2.0, min_hedge_delay=0.01)
+    assert pool.hedge_delay() == 2.0
+    endpoint = llm_pool_utils.Endpoint(None, name="e")
+    endpoint.ttfts.extend([0.1] * 19 + [0.5])
+    pool.endpoints = [endpoint]
+    assert pool.hedge_delay() == 0.5
+    # Calls that do not stream hedge on their own latencies
+    assert pool.hedge_delay(stream=False) == 2.0
+    endpoint.latencies.extend([3.0] * 20)
+    assert pool.hedge_delay(stream=False) == 3.0
+    assert LLMPool([]).hedge_delay() is None
+
+
+def test_whole_replies_are_not_ttft_samples(servers):
+    pool = LLMPool(clients(servers(ttft=0.05)))
+    pool.chat.completions.create(model="m", messages=MESSAGES)
+    endpoint = pool.endpoints[0]
+    assert (len(endpoint.ttfts), endpoint.ttft_ewma) == (0, None)
+    assert len(endpoint.latencies) == 1 and endpoint.latency_ewma >= 0.05
+    stream(pool)
+    assert len(endpoint.ttfts) == 1 and len(endpoint.latencies) == 1
+
+
+def test_async_pool_failover_and_hedging(servers):
+    broken, slow, fast = servers(fail=100), servers(ttft=1.0), servers()
+
+    async def run():
+        pool = AsyncLLMPool(
+            clients(broken, slow, fast, client_class=AsyncOpenAI),
+            hedge=True,
+            hedge_delay=0.05,
+        )
+        pool.endpoints[0].ttft_ewma = 0.001
+        pool.endpoints[1].ttft_ewma = 0.002
+        pool.endpoints[2].ttft_ewma = 1.0
+        started = time.monotonic()
+        chunks = await pool.chat.completions.create(
+            model="m", messages=MESSAGES, stream=True
+        )
+        replies = [c.choices[0].delta.content async for c in chunks if c.choices]
+        return pool, replies, time.monotonic() - started
+
+    pool, replies, elapsed = asyncio.run(run())
+    assert replies == ["Hello", ", world"]
+    assert elapsed < 0.8
+    assert pool.endpoints[0].total_failures == 1
+    assert pool.hedges == 1
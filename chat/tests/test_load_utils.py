@@ -0,0 +1,266 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils import load_utils
+from utils.load_utils import AdmissionController, LoadSampler, Overloaded, SharedState
+
+
+@pytest.fixture
+def state(tmp_path):
+    return SharedState(str(tmp_path / "load.json"))
+
+
+def controller(state, **kwargs):
+    sampler = LoadSampler(state, interval=0)
+    kwargs.setdefault("timeout", 5)
+    return AdmissionController(state, sampler, poll_interval=0.005, **kwargs)
+
+
+def test_limit_queue_and_release(state):
+    admission = controller(state, limit=2, queue_size=1)
+    first, second = admission.acquire(), admission.acquire()
+    assert admission.snapshot()["in_flight"] == 2
+
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(admission.acquire()))
+    waiter.start()
+    while admission.snapshot()["queued"] == 0:
+        pass
+    # The queue is full: further requests are turned away right away
+    with pytest.raises(Overloaded) as e:
+        admission.acquire()
+    assert e.value.status == 429
+    assert e.value.retry_after >= 1
+
+    first.release()
+    first.release()  # Releasing twice frees one slot only
+    waiter.join(timeout=5)
+    assert len(admitted) == 1
+    snapshot = admission.snapshot()
+    assert (snapshot["in_flight"], snapshot["queued"]) == (2, 0)
+    assert (snapshot["admitted"], snapshot["rejected"]) == (3, 1)
+    second.release()
+    admitted[0].release()
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_wait_deadline(state):
+    admission = controller(state, limit=1, queue_size=5)
+    with admission.acquire():
+        with pytest.raises(Overloaded) as e:
+            admission.acquire(timeout=0.05)
+    assert e.value.status == 503
+    snapshot = admission.snapshot()
+    assert (snapshot["queued"], snapshot["timed_out"]) == (0, 1)
+
+
+def _hold_slot(path, held, done):
+    slot = controller(SharedState(path), limit=1, queue_size=0).acquire()
+    held.set()
+    done.wait(5)
+    slot.release()
+
+
+def test_slots_are_shared_across_processes(state):
+    context = multiprocessing.get_context("fork")
+    held, done = context.Event(), context.Event()
+    worker = context.Process(target=_hold_slot, args=(state.path, held, done))
+    worker.start()
+    try:
+        assert held.wait(5)
+        admission = controller(state, limit=1, queue_size=0)
+        with pytest.raises(Overloaded):
+            admission.acquire()
+    finally:
+        done.set()
+        worker.join(5)
+    admission.acquire().release()
+
+
+def test_slots_of_dead_workers_are_dropped(state):
+    context = multiprocessing.get_context("fork")
+    worker = context.Process(target=lambda: None)
+    worker.start()
+    worker.join()
+    with state.update() as shared:
+        shared["workers"] = {str(worker.pid): 1}
+    admission = controller(state, limit=1, queue_size=0)
+    admission.acquire().release()
+
+
+class CpuTimes(tuple):
+    # psutil's named tuple: fields sum to the total, idle and iowait by name
+    idle = property(lambda self: self[0])
+    iowait = 0.0
+
+
+def test_sampler_smooths_and_sheds(state, monkeypatch):
+    samples = iter([(0.0, 100.0, 50.0), (10.0, 110.0, 99.0)])
+    current = [next(samples)]
+    monkeypatch.setattr(
+        load_utils.psutil, "cpu_times", lambda: CpuTimes(current[0][:2])
+    )
+    monkeypatch.setattr(
+        load_utils.psutil,
+        "virtual_memory",
+        lambda: SimpleNamespace(percent=current[0][2]),
+    )
+    sampler = LoadSampler(state, interval=1, smoothing=0.5)
+    sampler.sample(now=1000.0)
+    current[0] = next(samples)
+    sampler.sample(now=1000.5)  # Another worker sampled too recently
+    sampler.sample(now=1001.0)
+    load = state.read()["load"]
+    # 10s busy out of 20s since the last sample
+    assert load["cpu_percent"] == pytest.approx(50.0)
+    assert load["memory_percent"] == pytest.approx(74.5)
+
+    monkeypatch.setattr(load_utils.time, "time", lambda: 1001.5)
+    monkeypatch.setattr(load_utils, "SHED_MEMORY_PERCENT", 70)
+    admission = AdmissionController(state, sampler, limit=5, queue_size=5)
+    monkeypatch.setattr(sampler, "ensure_started", lambda: None)
+    with pytest.raises(Overloaded) as e:
+        admission.acquire()
+    assert e.value.status == 503
+    assert admission.snapshot()["shed"] == 1
+
+
+def wait_for_queue(state, size):
+    while len(state.read().get("queue") or []) < size:
+        time.sleep(0.005)
+
+
+def test_light_users_get_free_slots_first(state):
+    admission = controller(state, limit=1, heavy_tokens=1000)
+    admission.acquire("heavy").release(tokens=5000)
+    held = admission.acquire("other")
+    admitted = []
+
+    def request(user):
+        slot = admission.acquire(user)
+        admitted.append(user)
+        slot.release()
+
+    threads = []
+    for size, user in enumerate(["heavy", "light"], 1):
+        threads.append(threading.Thread(target=request, args=(user,)))
+        threads[-1].start()
+        wait_for_queue(state, size)
+    held.release()
+    for thread in threads:
+        thread.join()
+    # The heavy user asked first
+    assert admitted == ["light", "heavy"]
+
+
+def test_user_concurrency_and_max_tokens(state):
+    admission = controller(
+        state,
+        limit=10,
+        user_limit=2,
+        heavy_tokens=1000,
+        heavy_user_limit=1,
+        heavy_max_tokens=64,
+        weights={"vip": 10.0},
+    )
+    slots = [admission.acquire(1), admission.acquire(1)]
+    assert slots[0].max_tokens is None
+    with pytest.raises(Overloaded):
+        admission.acquire(1, timeout=0.05)
+    admission.acquire(2).release()  # Other users are not held up
+    for slot in slots:
+        slot.release(tokens=800)
+
+    limits = admission.limits(1)
+    assert limits["heavy"] and limits["recent_tokens"] == pytest.approx(1600, rel=0.01)
+    assert (limits["concurrency_limit"], limits["max_tokens"]) == (1, 64)
+    slot = admission.acquire(1)
+    assert slot.max_tokens == 64
+    with pytest.raises(Overloaded):
+        admission.acquire(1, timeout=0.05)
+    slot.release()
+    # A weight scales the usage a user may have before being heavy
+    admission.acquire("vip").release(tokens=1600)
+    assert not admission.limits("vip")["heavy"]
+
+
+def test_usage_decays(state):
+    admission = controller(state, half_life=0.05, heavy_tokens=1000)
+    admission.acquire(1).release(tokens=5000)
+    assert admission.limits(1)["heavy"]
+    time.sleep(0.3)
+    assert not admission.limits(1)["heavy"]
+
+
+def test_lowered_limit_admits_nobody(state):
+    admission = controller(state, limit=3, queue_size=5)
+    slots = [admission.acquire() for _ in range(3)]
+    admission.limit = 1  # More slots in use than the limit allows
+    admitted = []
+    waiters = [
+        threading.Thread(target=lambda: admitted.append(admission.acquire()))
+        for _ in range(2)
+    ]
+    for waiter in waiters:
+        waiter.start()
+    wait_for_queue(state, 2)
+    slots.pop().release()
+    time.sleep(0.1)
+    assert admitted == []  # Still one slot over the limit
+    for slot in slots:
+        slot.release()
+    for waiter in waiters:
+        waiter.join(5)
+        admitted.pop().release()
+
+
+def test_aacquire_does_not_block_the_event_loop(state):
+    admission = controller(state, limit=1)
+
+    async def run():
+        ticks = []
+
+        async def tick():
+            while len(ticks) < 5:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        # Another worker holds the state's lock for a while
+        with state.update():
+            ticker = asyncio.ensure_future(tick())
+            acquiring = asyncio.ensure_future(admission.aacquire())
+            await asyncio.sleep(0.2)
+            assert len(ticks) == 5
+            assert not acquiring.done()
+        slot = await acquiring
+        await slot.arelease(10)
+        await ticker
+
+    asyncio.run(run())
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_cancelled_aacquire_leaves_no_slot(state):
+    admission = controller(state, limit=1)
+
+    async def run():
+        with state.update():
+            acquiring = asyncio.ensure_future(admission.aacquire())
+            await asyncio.sleep(0.05)
+            acquiring.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await acquiring
+        # The step finishes in its thread and is undone there
+        for _ in range(100):
+            if admission.snapshot()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    snapshot = admission.snapshot()
+    assert (snapshot["in_flight"], snapshot["queued"]) == (0, 0)
@@ -0,0 +1,106 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from openai import OpenAI
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+from utils import db_utils
+from utils.chatbot_utils import ChatBot
+from chat.tests.conftest import InMemorySupabaseClient
+from chat.tests.fake_openai import FakeOpenAIServer
+
+CHAT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HISTORY = [{"role": "user", "content": "Hi"}]
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.fixture
+def llm():
+    server = FakeOpenAIServer(chunks=["a", "b", "c", "d"], ttft=0.05, delay=0.01)
+    yield OpenAI(api_key="key", base_url=server.base_url, max_retries=0)
+    server.close()
+
+
+def test_stream_records_ttft_rate_and_usage(llm):
+    ttft_count = sample("chat_llm_ttft_seconds_count")
+    ttft_sum = sample("chat_llm_ttft_seconds_sum")
+    rates = sample("chat_llm_tokens_per_second_count")
+    completion = sample("chat_llm_tokens_total", kind="completion")
+    ok = sample("chat_llm_requests_total", stream="true", outcome="ok")
+
+    chatbot = ChatBot(llm)
+    assert "".join(chatbot.chat(HISTORY, stream=True)) == "abcd"
+
+    assert sample("chat_llm_ttft_seconds_count") == ttft_count + 1
+    assert sample("chat_llm_ttft_seconds_sum") - ttft_sum >= 0.05
+    assert sample("chat_llm_tokens_per_second_count") == rates + 1
+    assert sample("chat_llm_tokens_total", kind="completion") == completion + 4
+    assert sample("chat_llm_requests_total", stream="true", outcome="ok") == ok + 1
+    assert sample("chat_llm_streams_in_flight") == 0
+    assert chatbot.usage.completion_tokens == 4
+
+
+def test_abandoned_stream_leaves_no_stream_in_flight(llm):
+    cancelled = sample("chat_llm_requests_total", stream="true", outcome="cancelled")
+    stream = ChatBot(llm).chat(HISTORY, stream=True)
+    assert next(stream) == "a"
+    assert sample("chat_llm_streams_in_flight") == 1
+    stream.close()  # The client went away
+    assert sample("chat_llm_streams_in_flight") == 0
+    assert (
+        sample("chat_llm_requests_total", stream="true", outcome="cancelled")
+        == cancelled + 1
+    )
+
+
+def test_non_stream_usage(llm):
+    prompt = sample("chat_llm_tokens_total", kind="prompt")
+    assert ChatBot(llm).chat(HISTORY) == "abcd"
+    assert sample("chat_llm_tokens_total", kind="prompt") > prompt
+
+
+def test_db_latency_and_errors_by_operation():
+    client = InMemorySupabaseClient()
+    count = sample("chat_db_seconds_count", operation="get_conversation")
+    errors = sample("chat_db_errors_total", operation="get_chat_history_list")
+
+    db_utils.create_chat(client, 1, "Chat")
+    db_utils.get_conversation(client, 1, "Chat")
+    client.failures[("chat_history", "select")] = 1
+    with pytest.raises(Exception):
+        db_utils.get_chat_history_list(client, 1)
+
+    assert sample("chat_db_seconds_count", operation="get_conversation") == count + 1
+    assert (
+        sample("chat_db_errors_total", operation="get_chat_history_list") == errors + 1
+    )
+
+
+WORKER = """
+from types import SimpleNamespace
+from utils import metrics_utils
+
+metrics_utils.record_usage(SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+metrics_utils.db_seconds.labels("get_conversation").observe(0.01)
+metrics_utils.llm_streams_in_flight.inc()
+"""
+
+
+def test_metrics_are_summed_over_worker_processes(tmp_path):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path), PYTHONPATH=CHAT_DIR)
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", WORKER], env=env, check=True)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=str(tmp_path))
+    assert registry.get_sample_value("chat_llm_tokens_total", {"kind": "prompt"}) == 20
+    assert (
+        registry.get_sample_value(
+            "chat_db_seconds_count", {"operation": "get_conversation"}
+        )
+        == 2
+    )
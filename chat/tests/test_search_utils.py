@@ -0,0 +1,40 @@
+from utils.search_utils import postings, query_terms, rank, snippet, tokenize
+
+
+def test_tokenize():
+    assert tokenize("Hello, World! hello") == ["hello", "world", "hello"]
+    # Chinese has no spaces: every ideograph is a term
+    assert tokenize("我喜欢Python") == ["我", "喜", "欢", "python"]
+    assert query_terms("the THE cat") == ["the", "cat"]
+
+
+def test_postings_count_terms():
+    rows = postings(1, 7, 3, "to be or not to be")
+    assert {row["term"]: row["tf"] for row in rows} == {
+        "to": 2,
+        "be": 2,
+        "or": 1,
+        "not": 1,
+    }
+    assert {(row["user_id"], row["chat_id"], row["seq"]) for row in rows} == {(1, 7, 3)}
+
+
+def test_rank_prefers_rare_and_all_terms():
+    rows = [
+        {"term": "python", "chat_id": 1, "seq": 0, "tf": 1},
+        {"term": "python", "chat_id": 1, "seq": 1, "tf": 1},
+        {"term": "python", "chat_id": 2, "seq": 0, "tf": 1},
+        {"term": "asyncio", "chat_id": 2, "seq": 0, "tf": 1},
+        {"term": "asyncio", "chat_id": 2, "seq": 5, "tf": 3},
+    ]
+    best = rank(["python", "asyncio"], rows, documents=100, limit=3)
+    # The only message with both terms comes first
+    assert [key for key, _ in best] == [(2, 0), (2, 5), (1, 1)]
+
+
+def test_snippet_is_centred_on_the_match():
+    content = "x" * 300 + " needle " + "y" * 300
+    text = snippet(content, ["needle"], size=60)
+    assert "needle" in text
+    assert text.startswith("...") and text.endswith("...")
+    assert snippet("short text", ["missing"]) == "short text"
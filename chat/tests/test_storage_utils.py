@@ -0,0 +1,284 @@
+import asyncio
+import sqlite3
+
+import pytest
+from utils import db_utils
+from utils.storage_utils import AsyncSQLiteClient, SQLiteClient
+
+
+@pytest.fixture
+def db(tmp_path):
+    return SQLiteClient(str(tmp_path / "chat.sqlite3"))
+
+
+def conversation(db, user_id=1, chat_name="Chat"):
+    db_utils.conversation_cache.clear()  # Read from the database
+    return db_utils.get_conversation(db, user_id, chat_name)
+
+
+def test_db_utils_on_sqlite(db):
+    db_utils.create_chat(db, 1, "Chat")
+    for turn in range(3):
+        chat = conversation(db)
+        db_utils.update_database(
+            db, chat.data[0]["messages"], f"Q{turn}", f"A{turn}", chat
+        )
+
+    chat = conversation(db).data[0]
+    assert chat["message_count"] == 6
+    messages = chat["messages"]["messages"]
+    assert [m["content"] for m in messages] == ["Q0", "A0", "Q1", "A1", "Q2", "A2"]
+    assert [m["seq"] for m in messages] == list(range(6))
+    assert messages[0]["interrupted"] is False
+    assert db_utils.check_chat_exists(db, 1, "Chat").data
+    assert [row["name"] for row in db_utils.get_chat_history_list(db, 1).data] == [
+        "Chat"
+    ]
+
+    db_utils.conversation_cache.clear()
+    page = db_utils.get_messages_page(db, 1, "Chat", limit=2, before=4)
+    assert [m["seq"] for m in page["messages"]] == [2, 3]
+    assert page["has_more"] and page["total"] == 6
+    # The legacy column is JSON
+    row = db.table("chat_history").select("messages").eq("id", chat["id"]).execute()
+    assert row.data == [{"messages": {"messages": []}}]
+
+
+def test_constraints_and_atomic_batches(db):
+    db_utils.create_chat(db, 1, "Chat")
+    with pytest.raises(sqlite3.IntegrityError):
+        db_utils.create_chat(db, 1, "Chat")
+    chat_id = conversation(db).data[0]["id"]
+
+    def row(seq):
+        return {"chat_id": chat_id, "seq": seq, "role": "user", "content": "x"}
+
+    db.table("chat_messages").insert([row(0)]).execute()
+    # A stale sequence number fails the whole batch
+    with pytest.raises(sqlite3.IntegrityError):
+        db.table("chat_messages").insert([row(1), row(0)]).execute()
+    response = db.table("chat_messages").select("seq", count="exact").execute()
+    assert (response.data, response.count) == ([{"seq": 0}], 1)
+    with pytest.raises(ValueError):
+        db.table("chat_messages").select("seq; DROP TABLE chat_messages").execute()
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_search_across_chats(db, backend):
+    from chat.tests.fake_supabase import InMemorySupabaseClient
+
+    if backend == "memory":
+        db = InMemorySupabaseClient()
+    turns = {
+        "Trip": [("Plan a trip to Kyoto", "Visit Kyoto temples in autumn")],
+        "Code": [
+            ("How do I profile Python code?", "Use cProfile to profile Python"),
+            ("And asyncio?", "asyncio has a debug mode"),
+        ],
+    }
+    for chat_name, chat_turns in turns.items():
+        db_utils.create_chat(db, 1, chat_name)
+        for question, answer in chat_turns:
+            chat = conversation(db, 1, chat_name)
+            db_utils.update_database(
+                db, chat.data[0]["messages"], question, answer, chat
+            )
+    db_utils.create_chat(db, 2, "Other user")
+    chat = conversation(db, 2, "Other user")
+    db_utils.update_database(db, chat.data[0]["messages"], "Kyoto", "Kyoto!", chat)
+
+    results = db_utils.search(db, 1, "profile python")
+    assert [(r["chat_name"], r["seq"], r["role"]) for r in results][:2] == [
+        ("Code", 1, "assistant"),
+        ("Code", 0, "user"),
+    ]
+    assert results[0]["snippet"] == "Use cProfile to profile Python"
+    # Scoped to the user
+    kyoto = db_utils.search(db, 1, "kyoto")
+    assert {r["chat_name"] for r in kyoto} == {"Trip"}
+    assert db_utils.search(db, 1, "kyoto", limit=1)[0]["seq"] in (0, 1)
+    assert db_utils.search(db, 1, "nothing matches") == []
+    assert db_utils.search(db, 1, "  ") == []
+
+
+def populate(db, user_id, chats):
+    for chat_name, chat_turns in chats.items():
+        db_utils.create_chat(db, user_id, chat_name)
+        for question, answer in chat_turns:
+            chat = conversation(db, user_id, chat_name)
+            db_utils.update_database(
+                db, chat.data[0]["messages"], question, answer, chat
+            )
+
+
+def exported(db, user_id):
+    records = list(db_utils.export_chats(db, user_id, page_size=2))
+    assert records[0]["type"] == "export"
+    return records[1:]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_export_and_import_chats(db, backend, tmp_path):
+    from chat.tests.fake_supabase import InMemorySupabaseClient
+
+    if backend == "memory":
+        db = InMemorySupabaseClient()
+    turns = [(f"Q{i}", f"A{i}") for i in range(3)]
+    populate(db, 1, {"A": turns, "B": [], "C": turns[:1]})
+    records = exported(db, 1)
+    assert [(r["type"], r.get("name") or r["content"]) for r in records] == [
+        ("chat", "A"),
+        *[("message", m) for turn in turns for m in turn],
+        ("chat", "B"),
+        ("chat", "C"),
+        ("message", "Q0"),
+        ("message", "A0"),
+    ]
+    assert [r["seq"] for r in records[1:7]] == list(range(6))
+
+    # An import cut short after two messages of A is resumed by running it again
+    target = SQLiteClient(str(tmp_path / "target.sqlite3"))
+    importer = db_utils.ChatImporter(2, batch_size=2)
+    db_utils.import_chats(target, importer, iter(records[:3]))
+    assert conversation(target, 2, "A").data[0]["message_count"] == 2
+    progress = db_utils.import_chats(
+        target, db_utils.ChatImporter(2, batch_size=2), iter(records)
+    )
+    assert progress == {
+        "chats": 2,
+        "messages": 6,
+        "skipped_chats": 0,
+        "skipped_messages": 2,
+        "last_chat": "C",
+    }
+    assert exported(target, 2) == records
+    assert [r["chat_name"] for r in db_utils.search(target, 2, "q2")] == ["A"]
+
+    # resume_from skips the chats before it; nothing is written twice
+    progress = db_utils.import_chats(
+        target, db_utils.ChatImporter(2, resume_from="C"), iter(records)
+    )
+    assert progress["skipped_chats"] == 2 and progress["messages"] == 0
+    assert exported(target, 2) == records
+
+
+def test_import_rejects_malformed_records(db):
+    importer = db_utils.ChatImporter(1)
+    with pytest.raises(ValueError):
+        db_utils.import_chats(db, importer, iter([{"type": "message"}]))
+    records = [{"type": "chat", "name": "Chat"}, {"type": "message", "role": "user"}]
+    with pytest.raises(ValueError):
+        db_utils.import_chats(db, db_utils.ChatImporter(1), iter(records))
+    # The chat before the bad record was written
+    assert conversation(db).data[0]["message_count"] == 0
+
+
+def test_lookups_use_the_indexes(db):
+    def plan(sql, *params):
+        rows = db.connection().execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return " ".join(row[3] for row in rows)
+
+    chat = plan("SELECT * FROM chat_history WHERE user_id = ? AND name = ?", 1, "a")
+    assert "USING INDEX chat_history_user_name" in chat
+    chats = plan(
+        "SELECT name FROM chat_history WHERE user_id = ? ORDER BY updated_at", 1
+    )
+    assert "USING INDEX chat_history_user_updated_at" in chats
+    assert "TEMP B-TREE" not in chats  # Sorted by the index
+    messages = plan(
+        "SELECT * FROM chat_messages WHERE chat_id = ? AND seq > ? ORDER BY seq", 1, 0
+    )
+    assert "SCAN" not in messages
+    postings = plan(
+        "SELECT * FROM chat_search WHERE user_id = ? AND term IN (?, ?)", 1, "a", "b"
+    )
+    assert "SCAN" not in postings
+
+
+def test_async_client(tmp_path):
+    db = AsyncSQLiteClient(str(tmp_path / "chat.sqlite3"))
+
+    async def main():
+        await db_utils.acreate_chat(db, 1, "Chat")
+        chat = await db_utils.aget_conversation(db, 1, "Chat")
+        await db_utils.aupdate_database(
+            db, chat.data[0]["messages"], "Hi", "Hello!", chat
+        )
+        db_utils.conversation_cache.clear()
+        return await db_utils.aget_conversation(db, 1, "Chat")
+
+    chat = asyncio.run(main()).data[0]
+    assert [m["content"] for m in chat["messages"]["messages"]] == ["Hi", "Hello!"]
+
+
+def test_async_export_and_import(tmp_path):
+    source_path, target_path = tmp_path / "source.sqlite3", tmp_path / "target.sqlite3"
+    populate(SQLiteClient(str(source_path)), 1, {"Chat": [("Hi", "Hello!")]})
+    source = AsyncSQLiteClient(str(source_path))
+    target = AsyncSQLiteClient(str(target_path))
+
+    async def records():
+        async for record in db_utils.aexport_chats(source, 1, page_size=1):
+            yield record
+
+    async def main():
+        importer = db_utils.ChatImporter(1)
+        return await db_utils.aimport_chats(target, importer, records())
+
+    assert asyncio.run(main())["messages"] == 2
+    assert exported(SQLiteClient(str(target_path)), 1) == exported(
+        SQLiteClient(str(source_path)), 1
+    )
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "memory"])
+def test_usage_ledger(db, backend):
+    from chat.tests.fake_supabase import InMemorySupabaseClient
+
+    if backend == "memory":
+        db = InMemorySupabaseClient()
+    ledger = db_utils.UsageLedger(flush_interval=60)
+    ledger.record(db, 1, "A", 100, 20)
+    ledger.record(db, 1, "A", 50, 10)
+    ledger.record(db, 1, "B", 10, 1)
+    ledger.record(db, 2, "A", 1000, 100)
+    assert ledger.stats()["pending_rows"] == 3
+
+    def summary():
+        rows = db.table("chat_usage").select("*").eq("user_id", 1).execute().data
+        rows += ledger.pending(1)
+        return db_utils._usage_summary(rows, db_utils._usage_since(None))
+
+    before = summary()
+    assert before["total"] == {
+        "requests": 3,
+        "prompt_tokens": 160,
+        "completion_tokens": 31,
+        "total_tokens": 191,
+    }
+    assert [(c["chat_name"], c["requests"]) for c in before["chats"]] == [
+        ("A", 2),
+        ("B", 1),
+    ]
+    ledger.flush()
+    assert ledger.stats() == {"pending_rows": 0, "written": 3, "failed": 0}
+    rows = db.table("chat_usage").select("*").execute().data
+    assert len(rows) == 3  # Summed per user, chat and day
+    assert summary() == before
+    assert db_utils.get_usage_summary(db, 2)["total"]["total_tokens"] == 1100
+
+
+def test_usage_ledger_keeps_usage_of_a_failed_flush():
+    from chat.tests.fake_supabase import InMemorySupabaseClient
+
+    db = InMemorySupabaseClient()
+    db.failures[("chat_usage", "insert")] = 1
+    ledger = db_utils.UsageLedger(flush_interval=60)
+    ledger.record(db, 1, "A", 100, 20)
+    ledger.flush()
+    ledger.record(db, 1, "A", 1, 1)
+    assert ledger.stats()["failed"] == 1
+    assert ledger.pending(1)[0]["requests"] == 2
+    ledger.flush()
+    rows = db.table("chat_usage").select("*").execute().data
+    assert [(r["requests"], r["prompt_tokens"]) for r in rows] == [(2, 101)]
@@ -0,0 +1,234 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from utils.stream_utils import StreamBuffer, StreamGone, acoalesce, coalesce
+
+
+@pytest.fixture
+def buffer(tmp_path):
+    return StreamBuffer(str(tmp_path / "streams.sqlite3"), max_bytes=1000, ttl=60)
+
+
+def test_read_from_any_byte_offset(buffer):
+    stream_id = buffer.create(1)
+    for chunk in ["Hello", ", ", "wörld"]:
+        buffer.append(stream_id, chunk)
+    assert buffer.read(stream_id, 0) == ("Hello, wörld".encode("utf-8"), False)
+    # Offsets are in bytes and may split a chunk or a character
+    assert buffer.read(stream_id, 3) == ("lo, wörld".encode("utf-8"), False)
+    assert buffer.read(stream_id, 10) == ("wörld".encode("utf-8")[3:], False)
+    buffer.finish(stream_id)
+    assert buffer.read(stream_id, 14) == (b"", True)
+    assert buffer.info(stream_id)["user_id"] == "1"
+    with pytest.raises(KeyError):
+        buffer.read("missing", 0)
+
+
+def test_old_bytes_are_dropped_beyond_max_bytes(buffer):
+    stream_id = buffer.create(1)
+    for _ in range(30):
+        buffer.append(stream_id, "x" * 100)
+    info = buffer.info(stream_id)
+    assert info["total"] == 3000
+    assert info["start"] == 2000
+    with pytest.raises(StreamGone):
+        buffer.read(stream_id, 1999)
+    assert len(buffer.read(stream_id, 2500)[0]) == 500
+
+
+def test_follow_waits_for_the_producer(buffer):
+    stream_id = buffer.create(1)
+
+    def produce():
+        for chunk in ["a", "b", "c"]:
+            time.sleep(0.02)
+            buffer.append(stream_id, chunk)
+        buffer.finish(stream_id)
+
+    threading.Thread(target=produce).start()
+    assert b"".join(buffer.follow(stream_id)) == b"abc"
+    assert b"".join(buffer.follow(stream_id, 1)) == b"bc"
+
+
+def test_workers_share_the_buffer(buffer):
+    # Another worker opens the same file
+    other = StreamBuffer(buffer.path)
+    stream_id = buffer.create(1)
+    buffer.append(stream_id, "shared")
+    buffer.finish(stream_id)
+    assert b"".join(other.follow(stream_id, 0)) == b"shared"
+
+
+def test_finished_streams_expire(buffer):
+    buffer.ttl = 0
+    stream_id = buffer.create(1)
+    buffer.finish(stream_id)
+    buffer.create(2)  # Expires the finished one
+    assert buffer.info(stream_id) is None
+
+
+def test_pump_stops_an_unread_reply(buffer):
+    buffer.grace = 0.05
+    stream_id = buffer.create(1)
+    done = []
+
+    def chunks():
+        for _ in range(1000):
+            time.sleep(0.005)
+            yield "x"
+
+    buffer.pump(stream_id, chunks(), lambda text, interrupted: done.append(interrupted))
+    info = buffer.info(stream_id)
+    assert done == [True]
+    assert info["done"] and info["interrupted"]
+    assert info["total"] < 1000
+
+
+def test_pump_completes_a_read_reply(buffer):
+    stream_id = buffer.create(1)
+    done = []
+    reader = threading.Thread(target=lambda: list(buffer.follow(stream_id)))
+    reader.start()
+    buffer.pump(stream_id, iter(["a", "b"]), lambda *args: done.append(args))
+    reader.join()
+    assert done == [("ab", False)]
+    assert not buffer.info(stream_id)["interrupted"]
+
+
+def test_coalesce_by_size_and_delay():
+    # The first chunk goes out at once, the others in batches
+    assert list(coalesce(["a", "bc", "", "de", "f"], min_bytes=4, max_delay=60)) == [
+        "a",
+        "bcde",
+        "f",
+    ]
+    # Sizes are counted in bytes
+    assert list(coalesce(["x", "é", "é", "y"], min_bytes=4, max_delay=60)) == [
+        "x",
+        "éé",
+        "y",
+    ]
+
+
+def test_coalesce_flushes_while_the_model_stalls():
+    def stalling():
+        yield "a"
+        yield "b"
+        time.sleep(0.3)
+        yield "c"
+
+    started, batches = time.monotonic(), []
+    for batch in coalesce(stalling(), min_bytes=100, max_delay=0.02):
+        batches.append((batch, time.monotonic() - started))
+    assert [batch for batch, _ in batches] == ["a", "b", "c"]
+    # "b" is not held back until the next chunk arrives
+    assert batches[0][1] < 0.1 and batches[1][1] < 0.2
+
+
+def test_coalesce_close_stops_reading():
+    read, closed = [], threading.Event()
+
+    def chunks():
+        try:
+            for chunk in "abcdef":
+                read.append(chunk)
+                yield chunk
+                time.sleep(0.3)  # The model stalls
+        finally:
+            closed.set()
+
+    batches = coalesce(chunks(), min_bytes=1, max_delay=60)
+    assert next(batches) == "a"
+    started = time.perf_counter()
+    batches.close()
+    # Closing does not wait for the next chunk
+    assert time.perf_counter() - started < 0.2
+    # The reader closes the chunks once that chunk arrives
+    assert closed.wait(1)
+    assert read == ["a", "b"]
+
+
+def test_acoalesce():
+    async def chunks():
+        for chunk in ["a", "b", "c"]:
+            yield chunk
+
+    async def collect():
+        return [batch async for batch in acoalesce(chunks(), 2, 60)]
+
+    assert asyncio.run(collect()) == ["a", "bc"]
+
+
+def test_acoalesce_flushes_while_the_model_stalls():
+    closed = []
+
+    async def stalling():
+        try:
+            yield "a"
+            yield "b"
+            await asyncio.sleep(0.3)
+            yield "c"
+        finally:
+            closed.append(True)
+
+    async def collect():
+        started, batches = time.monotonic(), []
+        async for batch in acoalesce(stalling(), 100, 0.02):
+            batches.append((batch, time.monotonic() - started))
+            if batch == "b":
+                break
+        return batches
+
+    batches = asyncio.run(collect())
+    assert [batch for batch, _ in batches] == ["a", "b"]
+    assert batches[1][1] < 0.2
+    # Closing stops the wait for the next chunk
+    assert closed == [True]
+
+
+def test_pump_appends_batches(buffer, monkeypatch):
+    buffer.flush_bytes, buffer.flush_interval = 8, 60
+    appends = []
+    append = buffer.append
+    monkeypatch.setattr(
+        buffer, "append", lambda *args: appends.append(args) or append(*args)
+    )
+    stream_id = buffer.create(1)
+    reader = threading.Thread(target=lambda: list(buffer.follow(stream_id)))
+    reader.start()
+    buffer.pump(stream_id, iter(["tok "] * 10))
+    reader.join()
+    # The first delta, then batches of 8 bytes
+    assert [text for _, text in appends] == ["tok "] + ["tok tok "] * 4 + ["tok "]
+    assert buffer.read(stream_id, 0) == (b"tok " * 10, True)
+
+
+def test_read_is_consistent_while_chunks_are_dropped(tmp_path):
+    buffer = StreamBuffer(str(tmp_path / "streams.sqlite3"), max_bytes=100, ttl=60)
+    stream_id = buffer.create(1)
+    stop = threading.Event()
+
+    def append():
+        # Every chunk is its own offset, so a read shows where it started
+        offset = 0
+        while not stop.is_set():
+            buffer.append(stream_id, f"{offset:010d}")
+            offset += 10
+
+    writer = threading.Thread(target=append)
+    writer.start()
+    try:
+        deadline = time.monotonic() + 0.5
+        while time.monotonic() < deadline:
+            start = buffer.info(stream_id)["start"]
+            try:
+                data, _ = buffer.read(stream_id, start)
+            except StreamGone:
+                continue
+            if data:
+                assert data[:10] == f"{start:010d}".encode()
+    finally:
+        stop.set()
+        writer.join()
@@ -1,11 +1,58 @@
 # utils/auth_utils.py
+import hashlib
+import os
+import re
+import time
+
 import jwt
 from flask import request, jsonify
 
+from utils.cache_utils import LRUCache
 
-def get_decoded_token(secret_key):
+# A compact JWS is three base64url segments; anything else is rejected before
+# any signature work.
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+")
+MAX_TOKEN_LENGTH = 4096
+
+# Verified tokens, keyed by a hash of (secret, token). Each entry expires at the
+# token's exp claim, or after TOKEN_CACHE_TTL seconds if that comes first.
+token_cache = LRUCache(
+    max_bytes=int(os.environ.get("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("TOKEN_CACHE_TTL", "300")),
+    sizeof=lambda decoded_token: 1,
+)
+
+
+def _token_key(token, secret_key):
+    return hashlib.sha256(f"{secret_key}\0{token}".encode("utf-8")).digest()
+
+
+def decode_token(token, secret_key):
     """
-    Extract and decode JWT token from the Authorization header.
+    Verify and decode a JWT token, reusing the result of an earlier verification
+    of the same token while it is valid.
+
+    Raises:
+        jwt.ExpiredSignatureError: If the token has expired.
+        jwt.InvalidTokenError: If the token is malformed or invalid.
+    """
+    if len(token) > MAX_TOKEN_LENGTH or not TOKEN_PATTERN.fullmatch(token):
+        raise jwt.InvalidTokenError("Malformed token")
+
+    key = _token_key(token, secret_key)
+    decoded_token = token_cache.get(key)
+    if decoded_token is None:
+        decoded_token = jwt.decode(token, secret_key, algorithms=["HS256"])
+        exp = decoded_token.get("exp")
+        ttl = None if exp is None else float(exp) - time.time()
+        token_cache.set(key, decoded_token, ttl=ttl)
+    # Callers get their own copy of the claims
+    return dict(decoded_token)
+
+
+def decode_auth_header(auth_header, secret_key):
+    """
+    Decode the JWT token carried by an Authorization header value.
 
     Returns:
         dict: The decoded token.
@@ -15,15 +62,28 @@ def get_decoded_token(secret_key):
         jwt.ExpiredSignatureError: If the token has expired.
         jwt.InvalidTokenError: If the token is invalid.
     """
-    auth_header = request.headers.get("Authorization")
     # Expected format: "Bearer <token>"
     try:
         token = auth_header.split(" ")[1]
-    except IndexError:
+    except (AttributeError, IndexError):
         raise ValueError("Invalid Authorization header format")
 
-    decoded_token = jwt.decode(token, secret_key, algorithms=["HS256"])
-    return decoded_token
+    return decode_token(token, secret_key)
+
+
+def get_decoded_token(secret_key):
+    """
+    Extract and decode JWT token from the Authorization header.
+
+    Returns:
+        dict: The decoded token.
+
+    Raises:
+        ValueError: If the token is missing.
+        jwt.ExpiredSignatureError: If the token has expired.
+        jwt.InvalidTokenError: If the token is invalid.
+    """
+    return decode_auth_header(request.headers.get("Authorization"), secret_key)
 
 
 def get_user_id_from_token(secret_key):
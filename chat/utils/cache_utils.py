@@ -0,0 +1,325 @@
+# utils/cache_utils.py
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache bounded by an estimated size in bytes.
+
+    Entries also expire `ttl` seconds after they were written, or earlier when
+    `set` is given a shorter per-entry ttl. `sizeof` estimates the size of a
+    value; the cache evicts least recently used entries until the total fits in
+    `max_bytes` (with `sizeof=lambda value: 1` it bounds the number of entries).
+    """
+
+    def __init__(self, max_bytes, ttl, sizeof=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        size = self.sizeof(value)
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes or ttl <= 0:
+                return
+            self._entries[key] = (value, size, time.monotonic() + ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteLRUCache:
+    """
+    LRU cache with the interface of LRUCache, kept in a SQLite file so that every
+    worker process on the host shares the entries and the counters.
+
+    Values must be JSON serialisable; their size is the length of the encoded
+    JSON. Expired entries are dropped when read and whenever a new entry is
+    written. Expiry uses wall-clock time because it is compared across
+    processes.
+    """
+
+    COUNTERS = ("hits", "misses", "evictions", "expirations")
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, reopened in a forked worker
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+                "value TEXT, size INTEGER, expires_at REAL, used_at REAL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, "
+                "value INTEGER)"
+            )
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    @staticmethod
+    def _count(connection, name, amount=1):
+        if amount:
+            connection.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT value, expires_at FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[1] <= now:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count(connection, "expirations")
+                row = None
+            if row is None:
+                self._count(connection, "misses")
+                return None
+            connection.execute(
+                "UPDATE entries SET used_at = ? WHERE key = ?", (now, key)
+            )
+            self._count(connection, "hits")
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        data = json.dumps(value, separators=(",", ":"))
+        size = len(data.encode("utf-8"))
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if size > self.max_bytes or ttl <= 0:
+                return
+            expired = connection.execute(
+                "DELETE FROM entries WHERE expires_at <= ?", (now,)
+            ).rowcount
+            self._count(connection, "expirations", expired)
+            connection.execute(
+                "INSERT INTO entries (key, value, size, expires_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now + ttl, now),
+            )
+            total = connection.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = []
+                for old_key, old_size in connection.execute(
+                    "SELECT key, size FROM entries ORDER BY used_at"
+                ):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+                self._count(connection, "evictions", len(evicted))
+
+    def delete(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries")
+
+    def stats(self):
+        connection = self._connection()
+        entries, total = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        counters = dict.fromkeys(self.COUNTERS, 0)
+        counters.update(connection.execute("SELECT name, value FROM counters"))
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            **counters,
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+        }
+
+
+class _Flight:
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.task = None  # Runs the call of an `ado` flight
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical calls share one execution: the first call for a
+    key runs, calls with the same key made meanwhile wait for it and get a copy
+    of its result, or its exception. Nothing is kept once the call returns.
+
+    `on_coalesced(key)` is called for every call that waited on another one.
+    """
+
+    def __init__(self, on_coalesced=None, copy=copy.deepcopy):
+        self.on_coalesced = on_coalesced
+        self.copy = copy
+        self._flights = {}  # key, or (event loop, key) for `ado` -> _Flight
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def _join(self, flight_key, key):
+        # The flight of the key, and whether this call has to run it
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            if flight is None:
+                flight = self._flights[flight_key] = _Flight(key)
+                self.calls += 1
+                return flight, True
+            flight.waiters += 1
+            self.coalesced += 1
+        if self.on_coalesced is not None:
+            self.on_coalesced(key)
+        return flight, False
+
+    def _land(self, flight_key, flight, result):
+        # No call joins the flight after this. The waiters copy a snapshot taken
+        # before the call that ran it can modify the result.
+        with self._lock:
+            if self._flights.get(flight_key) is flight:
+                del self._flights[flight_key]
+            waiters = flight.waiters
+        if waiters:
+            flight.result = self.copy(result)
+
+    def forget(self, predicate):
+        """
+        Let the next calls of the keys matching `predicate` run anew instead of
+        joining a call in flight, e.g. because a write made its result stale.
+        """
+        with self._lock:
+            for flight_key, flight in list(self._flights.items()):
+                if predicate(flight.key):
+                    del self._flights[flight_key]
+
+    def do(self, key, fn):
+        """Return `fn()`, shared with the identical calls in flight."""
+        flight, leader = self._join(key, key)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return self.copy(flight.result)
+        result = None
+        try:
+            result = fn()
+            return result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight, result)
+            flight.done.set()
+
+    async def ado(self, key, fn):
+        """
+        Async version of `do`, for a coroutine function `fn`. The call runs in
+        a task, so cancelling the caller that started it does not cancel it for
+        the others.
+        """
+        flight_key = (asyncio.get_running_loop(), key)
+        flight, leader = self._join(flight_key, key)
+        if not leader:
+            await asyncio.shield(flight.task)
+            return self.copy(flight.result)
+
+        async def run():
+            result = None
+            try:
+                result = await fn()
+                return result
+            finally:
+                self._land(flight_key, flight, result)
+
+        flight.task = asyncio.ensure_future(run())
+        return await asyncio.shield(flight.task)
@@ -1,74 +1,266 @@
 # utils/chatbot_utils.py
-import psutil
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+
+from utils import metrics_utils
+from utils.cache_utils import SQLiteLRUCache
+from utils.context_utils import estimate_tokens
+
+SYSTEM_PROMPT = "Use English to reply."
+MAX_TOKENS = 16384
+
+# Optional cache of completed replies, shared by the workers of a host through a
+# SQLite file. Disabled unless COMPLETION_CACHE_BYTES is set.
+COMPLETION_CACHE_BYTES = int(os.environ.get("COMPLETION_CACHE_BYTES", "0"))
+completion_cache = (
+    SQLiteLRUCache(
+        os.environ.get(
+            "COMPLETION_CACHE_PATH",
+            os.path.join(tempfile.gettempdir(), "chat-completions.sqlite3"),
+        ),
+        max_bytes=COMPLETION_CACHE_BYTES,
+        ttl=float(os.environ.get("COMPLETION_CACHE_TTL", "3600")),
+    )
+    if COMPLETION_CACHE_BYTES > 0
+    else None
+)
+
+
+def completion_key(request_kwargs):
+    """
+    Canonical hash of a completion request: the model parameters and the
+    role/content of every message, independent of dict order and stream options.
+    """
+    request = {
+        key: value
+        for key, value in request_kwargs.items()
+        if key not in ("stream", "stream_options")
+    }
+    request["messages"] = [
+        {"role": m["role"], "content": m["content"]} for m in request["messages"]
+    ]
+    canonical = json.dumps(
+        request, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 
 class ChatBot:
-    def __init__(self, client):
+    def __init__(self, client, cache=None, max_tokens=None):
         self.client = client
-        self.conversation_history = [
-            {"role": "system", "content": "Use English to reply."}
-        ]
+        self.cache = cache  # Completion cache, e.g. completion_cache
+        self.max_tokens = max_tokens or MAX_TOKENS  # Lower for heavy users
+        self.conversation_history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.usage = None  # Token usage of the last completion, if reported
+        self.cached = False  # Whether the last reply came from the cache
+        self.generated = 0  # Estimated tokens of the last reply
 
     # store new message in conversation_history
     def add_message(self, message):
         self.conversation_history.extend(message)
 
+    def _request_kwargs(self, model, stream):
+        kwargs = {
+            "model": model,
+            "messages": self.conversation_history,
+            "temperature": 0.7,
+            "max_tokens": self.max_tokens,
+            "extra_headers": {"lora_id": "0"},
+        }
+        if stream:
+            kwargs["stream"] = True
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
+
+    # the last chunk of a stream only carries usage and has no choices
+    @staticmethod
+    def _chunk_content(chunk):
+        if chunk.choices and getattr(chunk.choices[0].delta, "content", None):
+            return chunk.choices[0].delta.content
+        return None
+
     # return response
     # if stream is False, don't return until deepseek generate whole sentences
-    # if stream is True, return while deepseek generate sentences
-    # streaming is disabled when underload
+    # if stream is True, return a generator that yields while deepseek generate sentences
+    # with a cache, an identical request is answered from it, a stream replays
+    # the cached chunks
     def chat(self, message, model="xdeepseekv3", stream=False):
         self.add_message(message)
+        key, cached = self._cached(model, stream)
+        if stream:  # Streaming response
+            if cached is not None:
+                return self._replay(cached)
+            return self._stream_chat(model, key)
+        if cached is not None:
+            return self._reply("".join(cached))
+        try:  # Normal response
+            response = self.client.chat.completions.create(
+                **self._request_kwargs(model, stream=False)
+            )
+            assistant_message = response.choices[0].message.content
+        except Exception as e:
+            metrics_utils.llm_requests.labels("false", "error").inc()
+            return f"Error: {e}"
+        return self._completed(key, response, assistant_message)
+
+    def _cached(self, model, stream):
+        if self.cache is None:
+            return None, None
+        key = completion_key(self._request_kwargs(model, stream=False))
+        try:
+            cached = self.cache.get(key)
+        except Exception as e:  # The cache never fails a request
+            print(f"Completion cache lookup failed: {e}")
+            return key, None
+        if cached is not None:
+            metrics_utils.llm_requests.labels(str(stream).lower(), "cached").inc()
+            self.cached = True
+        return key, cached
+
+    def tokens_used(self, prompt_tokens):
+        """
+        (prompt, completion) tokens of the last completion, as reported by the
+        provider. A stream cut short reports no usage: then the prompt counts as
+        the estimate `prompt_tokens` and the reply as the chunks received. A
+        cached reply or a failed request used none.
+        """
+        prompt = getattr(self.usage, "prompt_tokens", None)
+        completion = getattr(self.usage, "completion_tokens", None)
+        if isinstance(prompt, int) and isinstance(completion, int):
+            return prompt, completion
+        if self.cached or not self.generated:
+            return 0, 0
+        return prompt_tokens, self.generated
+
+    def _completed(self, key, response, assistant_message):
+        self.usage = getattr(response, "usage", None)
+        self.generated = estimate_tokens(assistant_message)
+        metrics_utils.record_usage(self.usage)
+        metrics_utils.llm_requests.labels("false", "ok").inc()
+        self._store(key, [assistant_message])
+        return self._reply(assistant_message)
+
+    # only complete replies are cached, never errors or abandoned streams
+    def _store(self, key, chunks):
+        if key is None or not chunks or not all(chunks):
+            return
+        try:
+            self.cache.set(key, chunks)
+        except Exception as e:
+            print(f"Completion cache write failed: {e}")
+
+    def _reply(self, assistant_message):
+        self.conversation_history.append(
+            {"role": "assistant", "content": assistant_message}
+        )
+        return assistant_message
+
+    @staticmethod
+    def _replay(chunks):
+        yield from chunks
+
+    # the timer sees every chunk, for the TTFT, token rate and usage metrics
+    # closing the generator (the client went away) closes the upstream stream
+    # at once, so the model stops generating
+    def _stream_chat(self, model, key=None):
+        chunks = []
+        timer = metrics_utils.StreamTimer(self.max_tokens)
+        outcome = "cancelled"
+        response = None
+        try:
+            response = self.client.chat.completions.create(
+                **self._request_kwargs(model, stream=True)
+            )
+            for chunk in response:
+                chunk_content = self._chunk_content(chunk)
+                timer.chunk(chunk, chunk_content)
+                # Known while streaming, for a caller that stops reading
+                self.generated = timer.chunks
+                if chunk_content:
+                    chunks.append(chunk_content)
+                    yield chunk_content
+            outcome = "ok"
+        except Exception as e:
+            outcome = "error"
+            yield f"Error: {e}"
+            return
+        finally:
+            _close(response)
+            self.usage, self.generated = timer.usage, timer.chunks
+            timer.finish(outcome)
+        self._store(key, chunks)
+
+    # async counterpart of chat() for an AsyncOpenAI client
+    # if stream is True, return an async generator, otherwise a coroutine
+    # the cache is a local SQLite file, fast enough to use from the event loop
+    def achat(self, message, model="xdeepseekv3", stream=False):
+        self.add_message(message)
+        key, cached = self._cached(model, stream)
+        if stream:
+            if cached is not None:
+                return self._areplay(cached)
+            return self._astream_chat(model, key)
+        return self._achat(model, key, cached)
+
+    async def _achat(self, model, key=None, cached=None):
+        if cached is not None:
+            return self._reply("".join(cached))
         try:
-            if stream:  # Streaming response
-                response = self.client.chat.completions.create(
-                    model=model,
-                    messages=self.conversation_history,
-                    temperature=0.7,
-                    max_tokens=16384,
-                    extra_headers={"lora_id": "0"},
-                    stream=True,
-                    stream_options={"include_usage": True},
-                )
-                for chunk in response:
-                    if (
-                        hasattr(chunk.choices[0].delta, "content")
-                        and chunk.choices[0].delta.content
-                    ):
-                        chunk_content = chunk.choices[0].delta.content
-                        yield chunk_content
-
-            else:  # Normal response
-                response = self.client.chat.completions.create(
-                    model=model,
-                    messages=self.conversation_history,
-                    temperature=0.7,
-                    max_tokens=16384,
-                    extra_headers={"lora_id": "0"},
-                )
-
-                assistant_message = response.choices[0].message.content
-                self.conversation_history.append(
-                    {"role": "assistant", "content": assistant_message}
-                )
-                return assistant_message
+            response = await self.client.chat.completions.create(
+                **self._request_kwargs(model, stream=False)
+            )
+            assistant_message = response.choices[0].message.content
         except Exception as e:
+            metrics_utils.llm_requests.labels("false", "error").inc()
             return f"Error: {e}"
+        return self._completed(key, response, assistant_message)
 
+    @staticmethod
+    async def _areplay(chunks):
+        for chunk in chunks:
+            yield chunk
 
-# Determine whether the server is under high load by evaluating CPU or memory usage
-def is_system_under_high_load():
-    cpu_usage = psutil.cpu_percent()
-    memory_usage = psutil.virtual_memory().percent
-    return cpu_usage > 80 or memory_usage > 80
+    async def _astream_chat(self, model, key=None):
+        chunks = []
+        timer = metrics_utils.StreamTimer(self.max_tokens)
+        outcome = "cancelled"
+        response = None
+        try:
+            response = await self.client.chat.completions.create(
+                **self._request_kwargs(model, stream=True)
+            )
+            async for chunk in response:
+                chunk_content = self._chunk_content(chunk)
+                timer.chunk(chunk, chunk_content)
+                if chunk_content:
+                    chunks.append(chunk_content)
+                    yield chunk_content
+            outcome = "ok"
+        except Exception as e:
+            outcome = "error"
+            yield f"Error: {e}"
+            return
+        finally:
+            await _aclose(response)
+            self.usage, self.generated = timer.usage, timer.chunks
+            timer.finish(outcome)
+        self._store(key, chunks)
 
 
-# Reduce token consumption
-# by removing unnecessary information (such as timestamps) from the chat history.
-def combine_message(message, updated_messages):
-    conversation_history = [
-        {"role": msg["role"], "content": msg["content"]}
-        for msg in updated_messages["messages"]
-    ]
-    conversation_history.append({"role": "user", "content": message})
-    return conversation_history
+def _close(stream):
+    # OpenAI streams and generators have close(), plain iterators nothing to close
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+async def _aclose(stream):
+    # Async generators have aclose(), an OpenAI AsyncStream an async close()
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close is not None:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
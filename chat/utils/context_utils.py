@@ -0,0 +1,144 @@
+# utils/context_utils.py
+import os
+import re
+
+# Prompt size sent to the model per turn, including the system prompt
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "6000"))
+# Part of the budget reserved for the rolling summary of dropped turns
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "600"))
+# Characters of each dropped message kept in the summary
+SUMMARY_CHARS_PER_MESSAGE = 200
+# Role/formatting overhead of one chat message
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+# CJK characters are roughly one token each, other text about four characters
+WIDE_CHARS = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+def estimate_tokens(text):
+    """
+    Fast local estimate of the number of tokens in a text.
+    """
+    if not text:
+        return 0
+    wide = len(WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def message_tokens(message):
+    return MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message.get("content"))
+
+
+class ContextWindow:
+    """
+    Messages to send for one turn, the rolling summary they rely on and how
+    many prompt tokens were saved compared with sending the whole history.
+    """
+
+    def __init__(self, messages, summary, summary_seq, summary_changed, full, prompt):
+        self.messages = messages
+        self.summary = summary
+        self.summary_seq = summary_seq
+        self.summary_changed = summary_changed
+        self.full_tokens = full
+        self.prompt_tokens = prompt
+        self.saved_tokens = full - prompt
+
+
+def _summary_line(message):
+    content = " ".join((message.get("content") or "").split())
+    if len(content) > SUMMARY_CHARS_PER_MESSAGE:
+        content = content[:SUMMARY_CHARS_PER_MESSAGE] + "..."
+    return f"{message['role']}: {content}"
+
+
+def _compress(summary, dropped, budget):
+    # Fold the newly dropped messages into the summary; when it outgrows its
+    # budget the oldest lines go first
+    lines = (summary.splitlines() if summary else []) + [
+        _summary_line(m) for m in dropped
+    ]
+    while lines and estimate_tokens("\n".join(lines)) > budget:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def build_context(
+    message,
+    updated_messages,
+    system_prompt,
+    summary=None,
+    summary_seq=None,
+    budget=PROMPT_TOKEN_BUDGET,
+    summary_budget=SUMMARY_TOKEN_BUDGET,
+):
+    """
+    Build the messages for a turn within a prompt token budget.
+
+    The system prompt, the new user message and the most recent turns are sent
+    intact. Older turns are dropped and folded into a rolling summary, which is
+    maintained incrementally: `summary` covers messages up to `summary_seq` and
+    only messages after it are added. The history may start after the summary
+    (the older messages are not read), and then the summary is always sent.
+    """
+    history = updated_messages["messages"]
+    user_message = {"role": "user", "content": message}
+    fixed = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    fixed += message_tokens(user_message)
+    costs = [message_tokens(m) for m in history]
+    full = fixed + sum(costs)
+    # Messages before the history are only known through the summary
+    carried = bool(summary) and bool(history) and history[0].get("seq", 0) > 0
+
+    def window(messages):
+        return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+    def with_summary(messages, text):
+        return [{"role": "system", "content": SUMMARY_HEADER + text}] + messages
+
+    if carried:
+        full += message_tokens(with_summary([], summary)[0])
+    if full <= budget:
+        messages = window(history) + [user_message]
+        if carried:
+            messages = with_summary(messages, summary)
+        return ContextWindow(messages, summary, summary_seq, False, full, full)
+
+    # Keep the most recent messages that fit next to the summary
+    available = budget - fixed - summary_budget - MESSAGE_OVERHEAD_TOKENS
+    start, used = len(history), 0
+    while start > 0 and used + costs[start - 1] <= available:
+        start -= 1
+        used += costs[start]
+    # Start at a user message so no turn is cut in half
+    while start < len(history) and history[start]["role"] != "user":
+        used -= costs[start]
+        start += 1
+
+    dropped = history[:start]
+    first_kept_seq = history[start].get("seq", start) if start < len(history) else None
+    if not dropped:
+        new_summary, new_summary_seq = (
+            (summary, summary_seq) if carried else (None, None)
+        )
+    elif (
+        summary
+        and summary_seq is not None
+        and (first_kept_seq is None or summary_seq < first_kept_seq)
+    ):
+        # Only messages the stored summary does not cover yet are added
+        new = [m for i, m in enumerate(dropped) if m.get("seq", i) > summary_seq]
+        new_summary = _compress(summary, new, summary_budget) if new else summary
+        new_summary_seq = max(summary_seq, dropped[-1].get("seq", start - 1))
+    else:
+        new_summary = _compress(None, dropped, summary_budget)
+        new_summary_seq = dropped[-1].get("seq", start - 1)
+    changed = new_summary != summary or new_summary_seq != summary_seq
+
+    messages = window(history[start:]) + [user_message]
+    prompt = fixed + used
+    if new_summary:
+        messages = with_summary(messages, new_summary)
+        prompt += message_tokens(messages[0])
+    return ContextWindow(messages, new_summary, new_summary_seq, changed, full, prompt)
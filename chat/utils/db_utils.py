@@ -1,93 +1,1720 @@
 # utils/db_utils.py
 
+import asyncio
+import atexit
 import datetime
+import os
+import random
+import threading
+import time
 
+from utils import metrics_utils, search_utils
+from utils.cache_utils import LRUCache, SingleFlight
 
-def check_chat_exists(supabase_client, user_id, chat_name):
-    """
-    Check if a chat with the same name already exists for a user.
-    """
+# Messages are stored append-only, one row per message in 'chat_messages' keyed by
+# (chat_id, seq). 'chat_history' keeps one row per chat with its 'message_count'.
+# Rows written before the migration still hold the whole conversation in the
+# legacy 'messages' JSON column and have no 'message_count'; they are migrated
+# lazily on first read (see migrations/001_chat_messages.sql for the bulk path).
+# An assistant reply cut short by a client disconnect is stored as far as it got,
+# with 'interrupted' set (migrations/003_interrupted_messages.sql). Stored
+# messages are indexed for search in 'chat_search' (see utils/search_utils.py).
+CHAT_COLUMNS = "id,user_id,name,message_count,summary,summary_seq,created_at,updated_at"
+MESSAGE_COLUMNS = "seq,role,content,timestamp,interrupted"
+# Changes with every write to a chat, see get_chat_version
+VERSION_COLUMNS = "id,message_count,updated_at"
+
+# Messages read for the context of a turn, see _get_conversation_steps
+CONTEXT_MESSAGES = int(os.environ.get("CONTEXT_MESSAGES", "500"))
+
+# Page size of /chat_history
+DEFAULT_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = int(os.environ.get("CHAT_HISTORY_MAX_PAGE_SIZE", "500"))
+
+# Every function is written once as a generator of query steps: it yields a
+# Supabase query builder and receives its executed response (or the exception
+# it raised). `_run` drives it with the sync supabase Client, `_arun` with the
+# AsyncClient. Both record the latency of the function in the chat_db_seconds
+# metric, labelled by its name (`_get_conversation_steps` -> get_conversation).
+
+
+def _operation(steps):
+    return steps.__name__.lstrip("_").removesuffix("_steps")
+
+
+def _run(steps):
+    started = time.perf_counter()
+    try:
+        query = next(steps)
+        while True:
+            try:
+                result = query.execute()
+            except Exception as e:
+                query = steps.throw(e)
+            else:
+                query = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+    except Exception:
+        metrics_utils.db_errors.labels(_operation(steps)).inc()
+        raise
+    finally:
+        metrics_utils.db_seconds.labels(_operation(steps)).observe(
+            time.perf_counter() - started
+        )
+
+
+async def _arun(steps):
+    started = time.perf_counter()
+    try:
+        query = next(steps)
+        while True:
+            try:
+                result = await query.execute()
+            except Exception as e:
+                query = steps.throw(e)
+            else:
+                query = steps.send(result)
+    except StopIteration as stop:
+        return stop.value
+    except Exception:
+        metrics_utils.db_errors.labels(_operation(steps)).inc()
+        raise
+    finally:
+        metrics_utils.db_seconds.labels(_operation(steps)).observe(
+            time.perf_counter() - started
+        )
+
+
+# Concurrent identical reads (several tabs, both gateway replicas) share one run
+# of the read. Keys are (operation, client, user_id, ...arguments); writes of a
+# user make the reads in flight for that user stale, so later reads run anew.
+reads = SingleFlight(
+    on_coalesced=lambda key: metrics_utils.db_coalesced.labels(key[0]).inc()
+)
+
+
+def _read(steps, client, *args):
+    return reads.do((_operation(steps), id(client), *args), lambda: _run(steps))
+
+
+async def _aread(steps, client, *args):
+    return await reads.ado((_operation(steps), id(client), *args), lambda: _arun(steps))
+
+
+def _forget_reads(user_id):
+    reads.forget(lambda key: key[2] == user_id)
+
+
+def _version(chat):
+    # Hashable stand-in for the chat passed to get_messages_page
+    if chat is None:
+        return None
+    return chat.get("id"), chat.get("message_count"), chat.get("updated_at")
+
+
+class CachedResponse:
+    """Response served from the conversation cache, shaped like a Supabase response."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+def _conversation_size(chat):
+    # Rough estimate of the memory held by a cached conversation
+    messages = chat["messages"]["messages"]
+    return 256 + sum(len(m.get("content") or "") + 128 for m in messages)
+
+
+# Write-through cache of conversations keyed by (user_id, chat_name). Another
+# worker writing the same chat can leave an entry stale for up to the TTL; writes
+# detect that through the (chat_id, seq) key and refresh the sequence number.
+conversation_cache = LRUCache(
+    max_bytes=int(os.environ.get("CONVERSATION_CACHE_BYTES", str(64 * 1024 * 1024))),
+    ttl=float(os.environ.get("CONVERSATION_CACHE_TTL", "60")),
+    sizeof=_conversation_size,
+)
+
+
+def _copy_chat(chat):
+    # Callers append to the message list, so never hand out the cached one
+    return {**chat, "messages": {"messages": list(chat["messages"]["messages"])}}
+
+
+def _cache_conversation(user_id, chat_name, chat):
+    conversation_cache.set((user_id, chat_name), _copy_chat(chat))
+
+
+def _chat_row_query(supabase_client, user_id, chat_name, columns=CHAT_COLUMNS):
     return (
         supabase_client.table("chat_history")
-        .select("*")
+        .select(columns)
         .eq("user_id", user_id)
         .eq("name", chat_name)
-        .execute()
     )
 
 
-def create_chat(supabase_client, user_id, chat_name):
+def _message_rows(chat_id, start_seq, messages):
+    return [
+        {
+            "chat_id": chat_id,
+            "seq": start_seq + offset,
+            "role": msg["role"],
+            "content": msg["content"],
+            "timestamp": msg.get("timestamp"),
+            **({"interrupted": True} if msg.get("interrupted") else {}),
+        }
+        for offset, msg in enumerate(messages)
+    ]
+
+
+def _index_steps(client, user_id, chat_id, start_seq, messages):
     """
-    Create a new chat with no initial messages for the user.
+    Add the search postings of messages stored from `start_seq` on. Indexing is
+    best effort: a failure is logged and never fails the write of the messages.
     """
-    now = datetime.datetime.now().isoformat()
-    return (
-        supabase_client.table("chat_history")
-        .insert(
-            {
-                "user_id": user_id,
-                "name": chat_name,
-                "messages": {"messages": []},  # Empty chat history
-                "created_at": now,
-                "updated_at": now,
-            }
+    rows = [
+        posting
+        for offset, msg in enumerate(messages)
+        for posting in search_utils.postings(
+            user_id, chat_id, start_seq + offset, msg.get("content")
         )
-        .execute()
-    )
+    ]
+    if user_id is None or not rows:
+        return
+    try:
+        yield client.table("chat_search").insert(rows)
+    except Exception as e:
+        print(f"Search indexing of {len(messages)} messages failed: {e}")
 
 
-def get_chat_history_list(supabase_client, user_id):
+def _migrate_chat_steps(supabase_client, chat, user_id):
     """
-    Retrieve the list of chat names for a given user.
+    Copy the legacy 'messages' blob of a chat into 'chat_messages'.
     """
-    return (
+    legacy = yield (
+        supabase_client.table("chat_history").select("messages").eq("id", chat["id"])
+    )
+    blob = legacy.data[0].get("messages") if legacy.data else None
+    messages = (blob or {}).get("messages", [])
+    if messages:
+        yield supabase_client.table("chat_messages").insert(
+            _message_rows(chat["id"], 0, messages)
+        )
+        yield from _index_steps(supabase_client, user_id, chat["id"], 0, messages)
+    yield (
+        supabase_client.table("chat_history")
+        .update({"message_count": len(messages)})
+        .eq("id", chat["id"])
+    )
+    chat["message_count"] = len(messages)
+
+
+def _check_chat_exists_steps(supabase_client, user_id, chat_name):
+    cached = _cached_chat(user_id, chat_name)
+    if cached is not None:
+        return CachedResponse([{"id": cached["id"]}])
+    return (yield _chat_row_query(supabase_client, user_id, chat_name, "id"))
+
+
+def _create_chat_steps(supabase_client, user_id, chat_name):
+    now = datetime.datetime.now().isoformat()
+    response = yield supabase_client.table("chat_history").insert(
+        {
+            "user_id": user_id,
+            "name": chat_name,
+            "messages": {"messages": []},  # Legacy column, no longer written
+            "message_count": 0,
+            "created_at": now,
+            "updated_at": now,
+        }
+    )
+    if response.data:
+        row = response.data[0]
+        chat = {column: row.get(column) for column in CHAT_COLUMNS.split(",")}
+        chat["messages"] = {"messages": []}
+        _cache_conversation(user_id, chat_name, chat)
+    return response
+
+
+def _get_chat_history_list_steps(supabase_client, user_id):
+    response = yield (
         supabase_client.table("chat_history")
-        .select("name")
+        .select("name,updated_at")
         .eq("user_id", user_id)
-        .execute()
     )
+    for row in response.data:
+        pending = write_behind.pending_chat(user_id, row["name"])
+        if pending is not None:
+            row["updated_at"] = pending["updated_at"]
+    return response
 
 
-def get_conversation(supabase_client, user_id, chat_name):
-    """
-    Query the database for the specific conversation of a user by chat name.
-    """
-    return (
+def _get_conversation_steps(supabase_client, user_id, chat_name):
+    cached = _cached_chat(user_id, chat_name)
+    if cached is not None:
+        return CachedResponse([_copy_chat(cached)])
+    conversation = yield _chat_row_query(supabase_client, user_id, chat_name)
+    if not conversation.data:
+        return conversation
+    chat = conversation.data[0]
+    if chat.get("message_count") is None:
+        yield from _migrate_chat_steps(supabase_client, chat, user_id)
+    messages = []
+    if chat["message_count"]:
+        # Only what a prompt can use: the messages after the rolling summary,
+        # at most CONTEXT_MESSAGES of them. get_messages_page reads the rest.
+        query = (
+            supabase_client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("chat_id", chat["id"])
+        )
+        if chat.get("summary_seq") is not None:
+            query = query.gt("seq", chat["summary_seq"])
+        response = yield query.order("seq", desc=True).limit(CONTEXT_MESSAGES)
+        messages = response.data[::-1]
+    # Same shape as the legacy row, so callers can keep using ["messages"]["messages"]
+    chat["messages"] = {"messages": messages}
+    _cache_conversation(user_id, chat_name, chat)
+    return conversation
+
+
+def _search_steps(supabase_client, user_id, query, limit):
+    terms = search_utils.query_terms(query)
+    if not terms:
+        return []
+    # One query per term, so a common term cannot crowd out the postings of a
+    # rare one: each reads its most frequent postings and its exact count
+    postings, df = [], {}
+    for term in terms:
+        response = yield (
+            supabase_client.table("chat_search")
+            .select("term,chat_id,seq,tf", count="exact")
+            .eq("user_id", user_id)
+            .eq("term", term)
+            .order("tf", desc=True)
+            .limit(search_utils.MAX_POSTINGS)
+        )
+        postings.extend(response.data)
+        df[term] = response.count or len(response.data)
+    if not postings:
+        return []
+    chats = yield (
         supabase_client.table("chat_history")
-        .select("*")
+        .select("id,name,message_count")
         .eq("user_id", user_id)
-        .eq("name", chat_name)
-        .execute()
     )
+    names = {chat["id"]: chat["name"] for chat in chats.data}
+    documents = sum(chat.get("message_count") or 0 for chat in chats.data)
+    best = [
+        (key, score)
+        for key, score in search_utils.rank(terms, postings, documents, limit, df)
+        if key[0] in names
+    ]
+    # Only the messages of the results are read, one query per chat
+    seqs = {}
+    for (chat_id, seq), _ in best:
+        seqs.setdefault(chat_id, []).append(seq)
+    messages = {}
+    for chat_id, chat_seqs in seqs.items():
+        response = yield (
+            supabase_client.table("chat_messages")
+            .select(MESSAGE_COLUMNS)
+            .eq("chat_id", chat_id)
+            .in_("seq", chat_seqs)
+        )
+        for msg in response.data:
+            messages[(chat_id, msg["seq"])] = msg
+    return [
+        {
+            "chat_name": names[key[0]],
+            "seq": key[1],
+            "role": messages[key]["role"],
+            "timestamp": messages[key].get("timestamp"),
+            "score": round(score, 4),
+            "snippet": search_utils.snippet(messages[key]["content"], terms),
+        }
+        for key, score in best
+        if key in messages
+    ]
 
 
-def update_database(client, updated_messages, message, assistant_message, conversation):
+def parse_page_args(args):
     """
-    Update the database with new chat messages and update the conversation timestamp.
+    Read `limit`, `before`, `after` and `since` from request query parameters.
+    `since` is either a message seq (same as `after`) or an ISO timestamp.
+
+    Raises:
+        ValueError: If a parameter is malformed or more than one cursor is given.
     """
-    # Append the user message with a timestamp.
-    updated_messages["messages"].append(
+    limit = min(max(int(args.get("limit", DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    cursors = [key for key in ("before", "after", "since") if args.get(key)]
+    if len(cursors) > 1:
+        raise ValueError("Use only one of 'before', 'after' or 'since'")
+    page_args = {"limit": limit, "before": None, "after": None, "since": None}
+    if not cursors:
+        return page_args
+    key, value = cursors[0], args.get(cursors[0])
+    if key == "since" and not value.isdigit():
+        datetime.datetime.fromisoformat(value)  # Raises ValueError if malformed
+        page_args["since"] = value
+    else:
+        page_args["after" if key == "since" else key] = int(value)
+    return page_args
+
+
+def _utc(timestamp):
+    # Compare naive (written here) and aware (read from Postgres) timestamps
+    value = datetime.datetime.fromisoformat(timestamp)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def empty_page():
+    return {
+        "messages": [],
+        "total": 0,
+        "has_more": False,
+        "next_before": None,
+        "next_after": None,
+    }
+
+
+def _page(messages, total, limit, before=None, after=None, since=None):
+    """
+    Build a page of messages. Without `after`/`since`, the window is the newest
+    `limit` messages (older than `before` if given); with `after`/`since`, it is
+    the oldest `limit` messages newer than the cursor. Messages in a page are in
+    chronological order.
+    """
+    has_more = len(messages) > limit
+    if after is None and since is None:
+        messages = messages[:limit][::-1]  # Fetched newest first
+    else:
+        messages = messages[:limit]
+    return {
+        "messages": messages,
+        "total": total,
+        "has_more": has_more,
+        "next_before": messages[0]["seq"] if messages else before,
+        "next_after": messages[-1]["seq"] if messages else after,
+    }
+
+
+def _cached_window(chat, limit, before, after, since):
+    # The page of a cached chat, or None if it needs messages older than those
+    # cached (only the recent ones are, see _get_conversation_steps)
+    messages = chat["messages"]["messages"]
+    first = messages[0]["seq"] if messages else chat.get("message_count") or 0
+    complete = first == 0
+    if after is not None:
+        if after < first - 1:
+            return None
+        return [m for m in messages if m["seq"] > after][: limit + 1]
+    if since is not None:
+        since_utc = _utc(since)
+        if not complete and (
+            not messages or _utc(messages[0]["timestamp"]) > since_utc
+        ):
+            return None
+        return [m for m in messages if _utc(m["timestamp"]) > since_utc][: limit + 1]
+    older = [m for m in messages if before is None or m["seq"] < before]
+    if not complete and len(older) <= limit:
+        return None
+    return older[::-1][: limit + 1]
+
+
+def _get_chat_version_steps(supabase_client, user_id, chat_name):
+    # Always read from the database (unless this worker has unwritten turns),
+    # as another worker may have written the chat since it was cached
+    pending = write_behind.pending_chat(user_id, chat_name)
+    if pending is not None:
+        return {key: pending.get(key) for key in VERSION_COLUMNS.split(",")}
+    chat = yield _chat_row_query(supabase_client, user_id, chat_name, VERSION_COLUMNS)
+    if not chat.data:
+        return None
+    chat = chat.data[0]
+    if chat.get("message_count") is None:
+        yield from _migrate_chat_steps(supabase_client, chat, user_id)
+    return chat
+
+
+def _get_messages_page_steps(
+    supabase_client,
+    user_id,
+    chat_name,
+    limit,
+    before=None,
+    after=None,
+    since=None,
+    chat=None,
+):
+    if chat is None:
+        chat = yield from _get_chat_version_steps(supabase_client, user_id, chat_name)
+        if chat is None:
+            return None
+    cached = _current_chat(user_id, chat_name, chat)
+    window = None
+    if cached is not None:
+        window = _cached_window(cached, limit, before, after, since)
+    if window is not None:
+        return _page(window, cached["message_count"], limit, before, after, since)
+
+    query = (
+        supabase_client.table("chat_messages")
+        .select(MESSAGE_COLUMNS)
+        .eq("chat_id", chat["id"])
+    )
+    if after is not None:
+        query = query.gt("seq", after).order("seq")
+    elif since is not None:
+        query = query.gt("timestamp", since).order("seq")
+    else:
+        if before is not None:
+            query = query.lt("seq", before)
+        query = query.order("seq", desc=True)
+    # One extra row tells whether there is another page
+    response = yield query.limit(limit + 1)
+    return _page(response.data, chat["message_count"], limit, before, after, since)
+
+
+def _turn_messages(message, assistant_message, interrupted=False):
+    messages = [
+        # The user message with a timestamp.
         {
             "role": "user",
             "content": message,
             "timestamp": datetime.datetime.now().isoformat(),
-        }
-    )
-    # Append the assistant message with a timestamp.
-    updated_messages["messages"].append(
+        },
+        # The assistant message with a timestamp.
         {
             "role": "assistant",
             "content": assistant_message,
             "timestamp": datetime.datetime.now().isoformat(),
-        }
+        },
+    ]
+    if interrupted:
+        messages[1]["interrupted"] = True
+    return messages
+
+
+def _append_messages_steps(client, chat, start_seq, new_messages, summary=None):
+    """
+    Insert `new_messages` from `start_seq` on and update the chat row. Returns
+    the first seq actually written, which moves when another writer appended to
+    the chat first, and the update applied to the chat row.
+    """
+    # Only the new messages are written, never the whole conversation.
+    try:
+        yield client.table("chat_messages").insert(
+            _message_rows(chat["id"], start_seq, new_messages)
+        )
+    except Exception:
+        # The sequence number was stale (another worker or tab appended to this
+        # chat): drop the cached copy, re-read the count and retry once.
+        conversation_cache.delete((chat.get("user_id"), chat.get("name")))
+        latest = yield (
+            client.table("chat_history").select("message_count").eq("id", chat["id"])
+        )
+        if not latest.data or latest.data[0]["message_count"] == start_seq:
+            raise
+        start_seq = latest.data[0]["message_count"]
+        yield client.table("chat_messages").insert(
+            _message_rows(chat["id"], start_seq, new_messages)
+        )
+    yield from _index_steps(
+        client, chat.get("user_id"), chat["id"], start_seq, new_messages
     )
+    updated_at = datetime.datetime.now().isoformat()
+    message_count = start_seq + len(new_messages)
+    chat_update = {"message_count": message_count, "updated_at": updated_at}
+    if summary is not None:
+        # Rolling summary of the turns dropped from the context window
+        chat_update["summary"], chat_update["summary_seq"] = summary
+    # The count only moves forward: a writer that overtook this one already
+    # counted these rows, and its update (and summary) is the newer one
+    yield (
+        client.table("chat_history")
+        .update(chat_update)
+        .eq("id", chat["id"])
+        .lt("message_count", message_count)
+    )
+    return start_seq, chat_update
 
-    # Update the 'chat_history' table with the new messages and updated timestamp.
-    client.table("chat_history").update(
-        {
-            "messages": updated_messages,
-            "updated_at": datetime.datetime.now().isoformat(),
+
+def _update_database_steps(
+    client,
+    updated_messages,
+    message,
+    assistant_message,
+    conversation,
+    summary=None,
+    interrupted=False,
+):
+    chat = conversation.data[0]
+    start_seq = chat.get("message_count") or 0
+    new_messages = _turn_messages(message, assistant_message, interrupted)
+    written_seq, chat_update = yield from _append_messages_steps(
+        client, chat, start_seq, new_messages, summary
+    )
+    # Keep the in-memory conversation in step with the database
+    for offset, msg in enumerate(new_messages):
+        updated_messages["messages"].append({"seq": written_seq + offset, **msg})
+    chat.update(chat_update)
+    if written_seq == start_seq and "user_id" in chat:
+        _cache_conversation(
+            chat["user_id"], chat["name"], {**chat, "messages": updated_messages}
+        )
+
+
+# Bulk export and import of a user's chats as a stream of records: a header,
+# then every chat followed by its messages in seq order. Chats and messages are
+# read and written in pages, so memory does not grow with the history.
+EXPORT_VERSION = 1
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "500"))
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "500"))
+EXPORT_CHAT_FIELDS = ("name", "created_at", "updated_at", "summary", "summary_seq")
+
+
+def _export_header():
+    return {
+        "type": "export",
+        "version": EXPORT_VERSION,
+        "exported_at": datetime.datetime.now().isoformat(),
+    }
+
+
+def _export_chats_steps(client, user_id, after_id, size):
+    response = yield (
+        client.table("chat_history")
+        .select(CHAT_COLUMNS)
+        .eq("user_id", user_id)
+        .gt("id", after_id)
+        .order("id")
+        .limit(size)
+    )
+    for chat in response.data:
+        if chat.get("message_count") is None:
+            yield from _migrate_chat_steps(client, chat, user_id)
+    return response.data
+
+
+def _export_messages_steps(client, chat_id, after_seq, size):
+    response = yield (
+        client.table("chat_messages")
+        .select(MESSAGE_COLUMNS)
+        .eq("chat_id", chat_id)
+        .gt("seq", after_seq)
+        .order("seq")
+        .limit(size)
+    )
+    return response.data
+
+
+def _chat_record(chat):
+    return {
+        "type": "chat",
+        **{field: chat.get(field) for field in EXPORT_CHAT_FIELDS},
+        "message_count": chat.get("message_count") or 0,
+    }
+
+
+def _message_record(chat_name, msg):
+    return {
+        "type": "message",
+        "chat": chat_name,
+        "seq": msg["seq"],
+        "role": msg["role"],
+        "content": msg["content"],
+        "timestamp": msg.get("timestamp"),
+        **({"interrupted": True} if msg.get("interrupted") else {}),
+    }
+
+
+class ChatImporter:
+    """
+    Turns the records of an export into batched writes for one user. `add` and
+    `finish` return the query steps to run, in order, with `_run` or `_arun`.
+
+    A chat that already exists is taken as partly imported: its first
+    `message_count` messages in the stream are skipped and the rest appended,
+    so running the same import again resumes it. `resume_from` skips the
+    chats before the one of that name.
+    """
+
+    def __init__(self, user_id, resume_from=None, batch_size=IMPORT_BATCH_SIZE):
+        self.user_id = user_id
+        self.resume_from = resume_from
+        self.batch_size = batch_size
+        self.chat = None  # Row of the chat being imported
+        self.chat_name = None
+        self.skip = 0  # Messages of the chat already imported
+        self.pending = []
+        self.chats = 0
+        self.messages = 0
+        self.skipped_chats = 0
+        self.skipped_messages = 0
+
+    def add(self, client, record):
+        kind = record.get("type")
+        if kind == "export":
+            if record.get("version") != EXPORT_VERSION:
+                raise ValueError(f"Unsupported export version {record.get('version')}")
+            return []
+        if kind == "chat":
+            return self._start_chat(client, record)
+        if kind != "message":
+            raise ValueError(f"Unknown record type {kind!r}")
+        if self.chat_name is None:
+            if self.resume_from is not None:
+                return []  # A chat skipped by resume_from
+            raise ValueError("Message before any chat")
+        if record.get("chat", self.chat_name) != self.chat_name:
+            raise ValueError(f"Message of {record.get('chat')!r} in {self.chat_name!r}")
+        if not isinstance(record.get("role"), str) or not isinstance(
+            record.get("content"), str
+        ):
+            raise ValueError("A message needs a 'role' and a 'content'")
+        if self.skip:
+            self.skip -= 1
+            self.skipped_messages += 1
+            return []
+        self.pending.append(
+            {
+                "role": record["role"],
+                "content": record["content"],
+                "timestamp": record.get("timestamp"),
+                "interrupted": record.get("interrupted", False),
+            }
+        )
+        if len(self.pending) >= self.batch_size:
+            return self._flush(client)
+        return []
+
+    def finish(self, client):
+        return self._flush(client)
+
+    def progress(self):
+        return {
+            "chats": self.chats,
+            "messages": self.messages,
+            "skipped_chats": self.skipped_chats,
+            "skipped_messages": self.skipped_messages,
+            # Pass as resume_from to continue an interrupted import
+            "last_chat": self.chat_name,
+        }
+
+    def _start_chat(self, client, record):
+        steps = self._flush(client)
+        name = record.get("name")
+        if not isinstance(name, str) or not name:
+            raise ValueError("A chat needs a 'name'")
+        if self.resume_from is not None and name != self.resume_from:
+            self.skipped_chats += 1
+            self.chat_name = None
+            return steps
+        self.resume_from = None
+        self.chat_name = name
+        return steps + [self._open_chat_steps(client, record)]
+
+    def _open_chat_steps(self, client, record):
+        existing = yield _chat_row_query(
+            client, self.user_id, record["name"], CHAT_COLUMNS
+        )
+        if existing.data:
+            chat = existing.data[0]
+            if chat.get("message_count") is None:
+                yield from _migrate_chat_steps(client, chat, self.user_id)
+            self.skip = chat["message_count"]
+        else:
+            now = datetime.datetime.now().isoformat()
+            response = yield client.table("chat_history").insert(
+                {
+                    "user_id": self.user_id,
+                    "name": record["name"],
+                    "messages": {"messages": []},  # Legacy column, no longer written
+                    "message_count": 0,
+                    "summary": record.get("summary"),
+                    "summary_seq": record.get("summary_seq"),
+                    "created_at": record.get("created_at") or now,
+                    "updated_at": record.get("updated_at") or now,
+                }
+            )
+            chat = response.data[0]
+            self.skip = 0
+            self.chats += 1
+        self.chat = {
+            **chat,
+            "updated_at": record.get("updated_at") or chat["updated_at"],
         }
-    ).eq("id", conversation.data[0]["id"]).execute()
+        self._forget()
+
+    def _flush(self, client):
+        if not self.pending:
+            return []
+        batch, self.pending = self.pending, []
+        return [self._write_steps(client, batch)]
+
+    def _write_steps(self, client, batch):
+        chat = self.chat
+        start_seq = chat["message_count"]
+        yield client.table("chat_messages").insert(
+            _message_rows(chat["id"], start_seq, batch)
+        )
+        yield from _index_steps(client, self.user_id, chat["id"], start_seq, batch)
+        chat["message_count"] = start_seq + len(batch)
+        yield (
+            client.table("chat_history")
+            .update(
+                {
+                    "message_count": chat["message_count"],
+                    "updated_at": chat["updated_at"],
+                }
+            )
+            .eq("id", chat["id"])
+            .lt("message_count", chat["message_count"])
+        )
+        self.messages += len(batch)
+        self._forget()
+
+    def _forget(self):
+        # Cached copies and reads in flight miss the imported messages
+        conversation_cache.delete((self.user_id, self.chat["name"]))
+        _forget_reads(self.user_id)
+
+
+# Write-behind retries: exponential backoff from WRITE_BEHIND_RETRY_DELAY seconds
+# up to WRITE_BEHIND_MAX_DELAY, giving up after WRITE_BEHIND_MAX_ATTEMPTS
+WRITE_BEHIND_RETRY_DELAY = float(os.environ.get("WRITE_BEHIND_RETRY_DELAY", "0.5"))
+WRITE_BEHIND_MAX_DELAY = float(os.environ.get("WRITE_BEHIND_MAX_DELAY", "30"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.environ.get("WRITE_BEHIND_MAX_ATTEMPTS", "10"))
+# Seconds a reply waits for its chat's queued turns to be written before the
+# stream ends (see WriteBehindQueue.flush_chat)
+WRITE_BEHIND_FLUSH_TIMEOUT = float(os.environ.get("WRITE_BEHIND_FLUSH_TIMEOUT", "5"))
+
+
+def _in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class PendingChat:
+    """Turns of one chat waiting to be written, and the chat as readers see it."""
+
+    def __init__(self, key, client, chat, is_async):
+        self.key = key
+        self.client = client
+        self.chat = chat  # Includes the messages that are not written yet
+        self.is_async = is_async
+        self.messages = []
+        self.summary = None
+        self.attempts = 0
+        self.not_before = 0.0
+        self.writing = False
+        self.resequenced = False
+
+
+class WriteBehindQueue:
+    """
+    Completed turns are queued in memory and written by a background worker, so
+    responses do not wait for the database. The worker is a thread, or a task in
+    the serving event loop for the async Supabase client.
+
+    All pending turns of a chat go out as one insert and one chat update. Failed
+    writes are retried with exponential backoff and jitter. Until its writes
+    land, reads of a chat in this process are served from the queue. Other
+    workers see the turn once it is written; `flush_chat` writes one chat's
+    turns at once, for a reply whose client is about to read the history.
+    """
+
+    def __init__(
+        self,
+        retry_delay=WRITE_BEHIND_RETRY_DELAY,
+        max_delay=WRITE_BEHIND_MAX_DELAY,
+        max_attempts=WRITE_BEHIND_MAX_ATTEMPTS,
+    ):
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._pending = {}  # (user_id, chat_name) -> PendingChat
+        self._cond = threading.Condition()
+        self._thread_pid = None
+        self._task = None
+        self._event = None
+        self.written = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def enqueue(
+        self,
+        client,
+        updated_messages,
+        message,
+        assistant_message,
+        conversation,
+        summary=None,
+        interrupted=False,
+    ):
+        chat = conversation.data[0]
+        key = (chat.get("user_id"), chat.get("name"))
+        is_async = _in_event_loop()
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is None:
+                snapshot = _copy_chat({**chat, "messages": updated_messages})
+                entry = PendingChat(key, client, snapshot, is_async)
+                self._pending[key] = entry
+            start_seq = entry.chat.get("message_count") or 0
+            new_messages = [
+                {"seq": start_seq + offset, **msg}
+                for offset, msg in enumerate(
+                    _turn_messages(message, assistant_message, interrupted)
+                )
+            ]
+            chat_update = {
+                "message_count": start_seq + len(new_messages),
+                "updated_at": new_messages[-1]["timestamp"],
+            }
+            if summary is not None:
+                chat_update["summary"], chat_update["summary_seq"] = summary
+                entry.summary = summary
+            entry.messages.extend(new_messages)
+            entry.chat["messages"]["messages"].extend(new_messages)
+            entry.chat.update(chat_update)
+            if "user_id" in chat:
+                _cache_conversation(chat["user_id"], chat["name"], entry.chat)
+            self._cond.notify_all()
+        _forget_reads(key[0])
+        # Keep the caller's conversation in step, as update_database does
+        if updated_messages is not entry.chat["messages"]:
+            updated_messages["messages"].extend(new_messages)
+        chat.update(chat_update)
+        self._ensure_worker(is_async)
+
+    def pending_chat(self, user_id, chat_name):
+        """A copy of the chat including its unwritten turns, or None."""
+        with self._cond:
+            entry = self._pending.get((user_id, chat_name))
+            return None if entry is None else _copy_chat(entry.chat)
+
+    def _take(self, now, is_async):
+        # Claim the pending turns of every chat that is due for a write
+        batches, wait = [], None
+        for entry in self._pending.values():
+            if entry.writing or not entry.messages or entry.is_async != is_async:
+                continue
+            if entry.not_before > now:
+                delay = entry.not_before - now
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            batches.append(self._claim(entry))
+        return batches, wait
+
+    @staticmethod
+    def _claim(entry):
+        entry.writing = True
+        batch = (entry, entry.messages, entry.summary)
+        entry.messages, entry.summary = [], None
+        return batch
+
+    def _take_chat(self, key, is_async):
+        # The pending turns of one chat, unless they are being written; the
+        # caller then waits. Returns (batch or None, whether to wait).
+        entry = self._pending.get(key)
+        if entry is None or (not entry.messages and not entry.writing):
+            return None, False
+        if entry.writing or entry.is_async != is_async:
+            return None, True
+        return self._claim(entry), False
+
+    @staticmethod
+    def _write_behind_steps(entry, batch, summary):
+        start_seq = batch[0]["seq"]
+        rows = [{k: v for k, v in msg.items() if k != "seq"} for msg in batch]
+        written_seq, _ = yield from _append_messages_steps(
+            entry.client, entry.chat, start_seq, rows, summary
+        )
+        return written_seq != start_seq
+
+    def _done(self, entry, batch, summary, error=None, resequenced=False):
+        with self._cond:
+            entry.writing = False
+            if error is None:
+                self.written += len(batch)
+                entry.attempts = 0
+                entry.resequenced = entry.resequenced or resequenced
+            elif entry.attempts + 1 >= self.max_attempts:
+                self.dropped += len(batch) + len(entry.messages)
+                print(f"Dropping {len(batch)} unwritten messages of a chat: {error}")
+                entry.messages = []
+                entry.resequenced = True
+            else:
+                entry.attempts += 1
+                self.retried += 1
+                entry.messages = batch + entry.messages
+                if entry.summary is None:
+                    entry.summary = summary
+                delay = self.retry_delay * 2 ** (entry.attempts - 1)
+                delay = min(self.max_delay, delay) * random.uniform(0.5, 1.0)
+                entry.not_before = time.monotonic() + delay
+            if not entry.messages:
+                del self._pending[entry.key]
+                if entry.resequenced:
+                    # The queued copy no longer matches the database
+                    conversation_cache.delete(entry.key)
+            self._cond.notify_all()
+
+    def _write(self, entry, batch, summary):
+        try:
+            resequenced = _run(self._write_behind_steps(entry, batch, summary))
+        except Exception as e:
+            print(f"Write-behind of {len(batch)} messages failed: {e}")
+            self._done(entry, batch, summary, error=e)
+        else:
+            self._done(entry, batch, summary, resequenced=resequenced)
+
+    async def _awrite(self, entry, batch, summary):
+        try:
+            resequenced = await _arun(self._write_behind_steps(entry, batch, summary))
+        except Exception as e:
+            print(f"Write-behind of {len(batch)} messages failed: {e}")
+            self._done(entry, batch, summary, error=e)
+        else:
+            self._done(entry, batch, summary, resequenced=resequenced)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                batches, wait = self._take(time.monotonic(), is_async=False)
+                if not batches:
+                    self._cond.wait(wait)
+                    continue
+            for batch in batches:
+                self._write(*batch)
+
+    async def _aworker(self):
+        while True:
+            with self._cond:
+                batches, wait = self._take(time.monotonic(), is_async=True)
+            if not batches:
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for batch in batches:
+                await self._awrite(*batch)
+
+    def _ensure_worker(self, is_async):
+        if is_async:
+            loop = asyncio.get_running_loop()
+            if self._task is None or self._task.done() or self._task.get_loop() != loop:
+                self._event = asyncio.Event()
+                self._task = loop.create_task(self._aworker())
+            self._event.set()
+            return
+        if self._thread_pid == os.getpid():
+            return
+        with self._cond:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def flush(self, timeout=10.0):
+        """
+        Write every pending turn now, ignoring backoff. Returns False if some are
+        still pending after `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._cond:
+                if not any(not e.is_async for e in self._pending.values()):
+                    return True
+                batches, _ = self._take(float("inf"), is_async=False)
+                if not batches:  # The worker is writing them
+                    self._cond.wait(0.05)
+                    continue
+            for batch in batches:
+                self._write(*batch)
+        return False
+
+    def flush_chat(self, user_id, chat_name, timeout=WRITE_BEHIND_FLUSH_TIMEOUT):
+        """
+        Write the pending turns of a chat now, so that other workers see them.
+        One attempt, ignoring backoff; a failed write is left to the worker.
+        Returns False if turns of the chat are still pending.
+        """
+        key, deadline = (user_id, chat_name), time.monotonic() + timeout
+        with self._cond:
+            batch, wait = self._take_chat(key, is_async=False)
+            while wait and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+                batch, wait = self._take_chat(key, is_async=False)
+        if batch is not None:
+            self._write(*batch)
+        with self._cond:
+            return key not in self._pending
+
+    async def aflush_chat(self, user_id, chat_name, timeout=WRITE_BEHIND_FLUSH_TIMEOUT):
+        """Async version of flush_chat, for turns queued from the event loop."""
+        key, deadline = (user_id, chat_name), time.monotonic() + timeout
+        while True:
+            with self._cond:
+                batch, wait = self._take_chat(key, is_async=True)
+            if not wait or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.05)
+        if batch is not None:
+            await self._awrite(*batch)
+        with self._cond:
+            return key not in self._pending
+
+    async def aflush(self, timeout=10.0):
+        """Async version of flush, for turns queued from the event loop."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._cond:
+                if not any(e.is_async for e in self._pending.values()):
+                    return True
+                batches, _ = self._take(float("inf"), is_async=True)
+            if not batches:
+                await asyncio.sleep(0.05)
+                continue
+            for batch in batches:
+                await self._awrite(*batch)
+        return False
+
+    def clear(self):
+        """Forget every pending write."""
+        with self._cond:
+            self._pending.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending_chats": len(self._pending),
+                "pending_messages": sum(
+                    len(e.messages) for e in self._pending.values()
+                ),
+                "written": self.written,
+                "retried": self.retried,
+                "dropped": self.dropped,
+            }
+
+
+write_behind = WriteBehindQueue()
+# Turns still queued when a worker shuts down are written before it exits
+atexit.register(write_behind.flush)
+
+
+# Token usage of LLM calls is summed in memory per (user, chat, day) and written
+# as one batch of 'chat_usage' rows every USAGE_FLUSH_INTERVAL seconds
+# (migrations/005_chat_usage.sql); a summary adds the rows of a user up.
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "10"))
+USAGE_SUMMARY_DAYS = 30
+MAX_USAGE_SUMMARY_DAYS = 366
+USAGE_FIELDS = ("requests", "prompt_tokens", "completion_tokens")
+
+
+def _record_usage_steps(client, rows):
+    yield client.table("chat_usage").insert(rows)
+
+
+class UsageLedger:
+    """
+    Token usage per user, chat and day, aggregated in memory and written in
+    batches: one insert per storage client and flush, from a background thread
+    (or a task in the serving event loop for an async client). The totals of a
+    failed flush are merged back for the next one.
+    """
+
+    def __init__(self, flush_interval=USAGE_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # (client, is_async) -> {(user_id, chat_name, day):
+        #                         [requests, prompt_tokens, completion_tokens]}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._task = None
+        self.written = 0
+        self.failed = 0
+
+    def record(self, client, user_id, chat_name, prompt_tokens, completion_tokens):
+        """Add the tokens of one LLM call of a user in a chat."""
+        key = (user_id, chat_name, datetime.date.today().isoformat())
+        is_async = _in_event_loop()
+        with self._lock:
+            totals = self._pending.setdefault((client, is_async), {})
+            self._add(totals, key, [1, prompt_tokens, completion_tokens])
+        self._ensure_worker(is_async)
+
+    @staticmethod
+    def _add(totals, key, counts):
+        current = totals.setdefault(key, [0, 0, 0])
+        for i, count in enumerate(counts):
+            current[i] += count
+
+    def _take(self, is_async):
+        with self._lock:
+            taken = [
+                (client, totals)
+                for (client, flag), totals in self._pending.items()
+                if flag == is_async
+            ]
+            for client, _ in taken:
+                del self._pending[(client, is_async)]
+        return taken
+
+    def _failed(self, client, is_async, totals, error):
+        print(f"Usage ledger flush of {len(totals)} rows failed: {error}")
+        with self._lock:
+            self.failed += 1
+            pending = self._pending.setdefault((client, is_async), {})
+            for key, counts in totals.items():
+                self._add(pending, key, counts)
+
+    @staticmethod
+    def _rows(totals):
+        now = datetime.datetime.now().isoformat()
+        return [
+            {
+                "user_id": user_id,
+                "chat_name": chat_name,
+                "day": day,
+                **dict(zip(USAGE_FIELDS, counts)),
+                "created_at": now,
+            }
+            for (user_id, chat_name, day), counts in totals.items()
+        ]
+
+    def flush(self):
+        """Write the usage recorded outside the event loop."""
+        for client, totals in self._take(is_async=False):
+            try:
+                _run(_record_usage_steps(client, self._rows(totals)))
+            except Exception as e:
+                self._failed(client, False, totals, e)
+            else:
+                self.written += len(totals)
+
+    async def aflush(self):
+        """Write the usage recorded from the event loop."""
+        for client, totals in self._take(is_async=True):
+            try:
+                await _arun(_record_usage_steps(client, self._rows(totals)))
+            except Exception as e:
+                self._failed(client, True, totals, e)
+            else:
+                self.written += len(totals)
+
+    def _worker(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    async def _aworker(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.aflush()
+
+    def _ensure_worker(self, is_async):
+        if is_async:
+            loop = asyncio.get_running_loop()
+            if self._task is None or self._task.done() or self._task.get_loop() != loop:
+                self._task = loop.create_task(self._aworker())
+            return
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def pending(self, user_id):
+        """Ledger rows of a user recorded in this process and not written yet."""
+        with self._lock:
+            totals = {}
+            for pending in self._pending.values():
+                for key, counts in pending.items():
+                    if key[0] == user_id:
+                        self._add(totals, key, counts)
+        return self._rows(totals)
+
+    def clear(self):
+        """Forget the usage not written yet."""
+        with self._lock:
+            self._pending.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending_rows": sum(len(t) for t in self._pending.values()),
+                "written": self.written,
+                "failed": self.failed,
+            }
+
+
+usage_ledger = UsageLedger()
+atexit.register(usage_ledger.flush)
+
+
+def _usage_rows_steps(client, user_id, since):
+    response = yield (
+        client.table("chat_usage")
+        .select("chat_name,day,requests,prompt_tokens,completion_tokens")
+        .eq("user_id", user_id)
+        .gte("day", since)
+    )
+    return response.data
+
+
+def _usage_summary(rows, since):
+    def totals(group):
+        counts = {field: sum(row[field] for row in group) for field in USAGE_FIELDS}
+        counts["total_tokens"] = counts["prompt_tokens"] + counts["completion_tokens"]
+        return counts
+
+    def grouped(column):
+        groups = {}
+        for row in rows:
+            groups.setdefault(row[column], []).append(row)
+        return [{column: key, **totals(group)} for key, group in groups.items()]
+
+    chats = sorted(grouped("chat_name"), key=lambda c: -c["total_tokens"])
+    return {
+        "since": since,
+        "total": totals(rows),
+        "days": sorted(grouped("day"), key=lambda d: d["day"]),
+        "chats": chats,
+    }
+
+
+def _usage_since(days):
+    days = min(max(1, days or USAGE_SUMMARY_DAYS), MAX_USAGE_SUMMARY_DAYS)
+    return (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+
+
+def _cached_chat(user_id, chat_name):
+    # A chat with unwritten turns is read from the write-behind queue
+    pending = write_behind.pending_chat(user_id, chat_name)
+    if pending is not None:
+        return pending
+    return conversation_cache.get((user_id, chat_name))
+
+
+def _current_chat(user_id, chat_name, version):
+    # Like _cached_chat, but a cached chat is only used while it matches the
+    # `version` read from the database
+    pending = write_behind.pending_chat(user_id, chat_name)
+    if pending is not None:
+        return pending
+    key = (user_id, chat_name)
+    cached = conversation_cache.get(key)
+    if cached is not None and not _same_version(cached, version):
+        conversation_cache.delete(key)
+        return None
+    return cached
+
+
+def _same_version(chat, version):
+    if (chat.get("id"), chat.get("message_count")) != (
+        version.get("id"),
+        version.get("message_count"),
+    ):
+        return False
+    a, b = chat.get("updated_at"), version.get("updated_at")
+    return a == b or bool(a and b) and _utc(a) == _utc(b)
+
+
+def check_chat_exists(supabase_client, user_id, chat_name):
+    """
+    Check if a chat with the same name already exists for a user.
+    """
+    return _read(
+        _check_chat_exists_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+def create_chat(supabase_client, user_id, chat_name):
+    """
+    Create a new chat with no initial messages for the user.
+    """
+    try:
+        return _run(_create_chat_steps(supabase_client, user_id, chat_name))
+    finally:
+        _forget_reads(user_id)
+
+
+def get_chat_history_list(supabase_client, user_id):
+    """
+    Retrieve the list of chat names for a given user.
+    """
+    return _read(
+        _get_chat_history_list_steps(supabase_client, user_id),
+        supabase_client,
+        user_id,
+    )
+
+
+def get_conversation(supabase_client, user_id, chat_name):
+    """
+    Query the database for the specific conversation of a user by chat name.
+    The messages are read from 'chat_messages' in sequence order.
+    """
+    return _read(
+        _get_conversation_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+def get_chat_version(supabase_client, user_id, chat_name):
+    """
+    Read the id, message count and last update time of a chat, without its
+    messages. Returns None if the chat does not exist.
+    """
+    return _read(
+        _get_chat_version_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+def get_messages_page(supabase_client, user_id, chat_name, limit, **cursor):
+    """
+    Read one page of a chat's messages by cursor (`before`, `after` or `since`),
+    plus the total count. Pass `chat` from get_chat_version to skip the chat
+    lookup. Returns None if the chat does not exist.
+    """
+    return _read(
+        _get_messages_page_steps(supabase_client, user_id, chat_name, limit, **cursor),
+        supabase_client,
+        user_id,
+        chat_name,
+        limit,
+        *(cursor.get(key) for key in ("before", "after", "since")),
+        _version(cursor.get("chat")),
+    )
+
+
+def search(supabase_client, user_id, query, limit=None):
+    """
+    Search the messages of all the chats of a user. Returns the best `limit`
+    matches (search_utils.DEFAULT_RESULTS by default), each with its chat name,
+    message seq, role, timestamp, score and a snippet of the message.
+    """
+    if limit is None:
+        limit = search_utils.DEFAULT_RESULTS
+    limit = min(max(limit, 1), search_utils.MAX_RESULTS)
+    return _read(
+        _search_steps(supabase_client, user_id, query, limit),
+        supabase_client,
+        user_id,
+        query,
+        limit,
+    )
+
+
+def update_database(
+    client,
+    updated_messages,
+    message,
+    assistant_message,
+    conversation,
+    summary=None,
+    interrupted=False,
+):
+    """
+    Append the new user and assistant messages and update the conversation timestamp.
+    `summary` is an optional (text, seq) rolling summary to store with the chat.
+    `interrupted` marks a partial reply whose client went away.
+    """
+    try:
+        _run(
+            _update_database_steps(
+                client,
+                updated_messages,
+                message,
+                assistant_message,
+                conversation,
+                summary,
+                interrupted,
+            )
+        )
+    finally:
+        _forget_reads(conversation.data[0].get("user_id"))
+
+    print("Database updated successfully")
+
+
+def queue_update_database(
+    client,
+    updated_messages,
+    message,
+    assistant_message,
+    conversation,
+    summary=None,
+    interrupted=False,
+):
+    """
+    Like update_database, but only queue the write: it returns at once and the
+    write-behind worker persists the turn. Works from sync and async code.
+    """
+    write_behind.enqueue(
+        client,
+        updated_messages,
+        message,
+        assistant_message,
+        conversation,
+        summary,
+        interrupted,
+    )
+
+
+def get_usage_summary(supabase_client, user_id, days=None):
+    """
+    Token usage of a user over the last `days` days (USAGE_SUMMARY_DAYS by
+    default): totals, and totals per day and per chat, most used chat first.
+    Usage not written by the ledger yet is included.
+    """
+    since = _usage_since(days)
+    rows = _read(
+        _usage_rows_steps(supabase_client, user_id, since),
+        supabase_client,
+        user_id,
+        since,
+    )
+    pending = [row for row in usage_ledger.pending(user_id) if row["day"] >= since]
+    return _usage_summary(rows + pending, since)
+
+
+def export_chats(supabase_client, user_id, page_size=EXPORT_PAGE_SIZE):
+    """
+    Generator of the export records of all the chats of a user: a header, then
+    each chat followed by its messages. Turns still queued are written first.
+    """
+    write_behind.flush()
+    yield _export_header()
+    after_id = 0
+    while True:
+        chats = _run(_export_chats_steps(supabase_client, user_id, after_id, page_size))
+        for chat in chats:
+            yield _chat_record(chat)
+            after_seq = -1
+            while True:
+                messages = _run(
+                    _export_messages_steps(
+                        supabase_client, chat["id"], after_seq, page_size
+                    )
+                )
+                for msg in messages:
+                    yield _message_record(chat["name"], msg)
+                if len(messages) < page_size:
+                    break
+                after_seq = messages[-1]["seq"]
+        if len(chats) < page_size:
+            return
+        after_id = chats[-1]["id"]
+
+
+def import_chats(supabase_client, importer, records):
+    """
+    Write the export `records` with a ChatImporter and return its progress.
+
+    Raises:
+        ValueError: If a record is malformed; what was written before stays.
+    """
+    for record in records:
+        for steps in importer.add(supabase_client, record):
+            _run(steps)
+    for steps in importer.finish(supabase_client):
+        _run(steps)
+    return importer.progress()
+
+
+async def acheck_chat_exists(supabase_client, user_id, chat_name):
+    """
+    Async version of check_chat_exists.
+    """
+    return await _aread(
+        _check_chat_exists_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+async def acreate_chat(supabase_client, user_id, chat_name):
+    """
+    Async version of create_chat.
+    """
+    try:
+        return await _arun(_create_chat_steps(supabase_client, user_id, chat_name))
+    finally:
+        _forget_reads(user_id)
+
+
+async def aget_chat_history_list(supabase_client, user_id):
+    """
+    Async version of get_chat_history_list.
+    """
+    return await _aread(
+        _get_chat_history_list_steps(supabase_client, user_id),
+        supabase_client,
+        user_id,
+    )
+
+
+async def aget_conversation(supabase_client, user_id, chat_name):
+    """
+    Async version of get_conversation.
+    """
+    return await _aread(
+        _get_conversation_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+async def aget_chat_version(supabase_client, user_id, chat_name):
+    """
+    Async version of get_chat_version.
+    """
+    return await _aread(
+        _get_chat_version_steps(supabase_client, user_id, chat_name),
+        supabase_client,
+        user_id,
+        chat_name,
+    )
+
+
+async def aget_messages_page(supabase_client, user_id, chat_name, limit, **cursor):
+    """
+    Async version of get_messages_page.
+    """
+    return await _aread(
+        _get_messages_page_steps(supabase_client, user_id, chat_name, limit, **cursor),
+        supabase_client,
+        user_id,
+        chat_name,
+        limit,
+        *(cursor.get(key) for key in ("before", "after", "since")),
+        _version(cursor.get("chat")),
+    )
+
+
+async def asearch(supabase_client, user_id, query, limit=None):
+    """
+    Async version of search.
+    """
+    if limit is None:
+        limit = search_utils.DEFAULT_RESULTS
+    limit = min(max(limit, 1), search_utils.MAX_RESULTS)
+    return await _aread(
+        _search_steps(supabase_client, user_id, query, limit),
+        supabase_client,
+        user_id,
+        query,
+        limit,
+    )
+
+
+async def aget_usage_summary(supabase_client, user_id, days=None):
+    """
+    Async version of get_usage_summary.
+    """
+    since = _usage_since(days)
+    rows = await _aread(
+        _usage_rows_steps(supabase_client, user_id, since),
+        supabase_client,
+        user_id,
+        since,
+    )
+    pending = [row for row in usage_ledger.pending(user_id) if row["day"] >= since]
+    return _usage_summary(rows + pending, since)
+
+
+async def aexport_chats(supabase_client, user_id, page_size=EXPORT_PAGE_SIZE):
+    """
+    Async version of export_chats.
+    """
+    await write_behind.aflush()
+    yield _export_header()
+    after_id = 0
+    while True:
+        chats = await _arun(
+            _export_chats_steps(supabase_client, user_id, after_id, page_size)
+        )
+        for chat in chats:
+            yield _chat_record(chat)
+            after_seq = -1
+            while True:
+                messages = await _arun(
+                    _export_messages_steps(
+                        supabase_client, chat["id"], after_seq, page_size
+                    )
+                )
+                for msg in messages:
+                    yield _message_record(chat["name"], msg)
+                if len(messages) < page_size:
+                    break
+                after_seq = messages[-1]["seq"]
+        if len(chats) < page_size:
+            return
+        after_id = chats[-1]["id"]
+
+
+async def aimport_chats(supabase_client, importer, records):
+    """
+    Async version of import_chats, for an async iterator of records.
+    """
+    async for record in records:
+        for steps in importer.add(supabase_client, record):
+            await _arun(steps)
+    for steps in importer.finish(supabase_client):
+        await _arun(steps)
+    return importer.progress()
+
+
+async def aupdate_database(
+    client,
+    updated_messages,
+    message,
+    assistant_message,
+    conversation,
+    summary=None,
+    interrupted=False,
+):
+    """
+    Async version of update_database.
+    """
+    try:
+        await _arun(
+            _update_database_steps(
+                client,
+                updated_messages,
+                message,
+                assistant_message,
+                conversation,
+                summary,
+                interrupted,
+            )
+        )
+    finally:
+        _forget_reads(conversation.data[0].get("user_id"))
 
     print("Database updated successfully")
@@ -0,0 +1,74 @@
+# utils/http_utils.py
+import hashlib
+import json
+
+
+def make_etag(*parts):
+    """
+    Build a weak ETag from the values that identify a version of a resource.
+    """
+    digest = hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header value against an ETag (weak comparison).
+    """
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    strip_weak = lambda value: value[2:] if value.startswith("W/") else value
+    return "*" in candidates or strip_weak(etag) in map(strip_weak, candidates)
+
+
+def ndjson_lines(records):
+    """Encode records as newline-delimited JSON, one line (bytes) per record."""
+    for record in records:
+        yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def andjson_lines(records):
+    """Async version of ndjson_lines, for an async iterator of records."""
+    async for record in records:
+        yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def ndjson_records(lines):
+    """
+    Decode newline-delimited JSON from an iterator of lines (bytes), skipping
+    blank lines.
+
+    Raises:
+        ValueError: If a line is not a JSON object; the message has its number.
+    """
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            yield _ndjson_record(number, line)
+
+
+async def andjson_records(chunks):
+    """
+    Async version of ndjson_records, for an async iterator of chunks (bytes)
+    that may split lines anywhere, e.g. a request body.
+    """
+    number, rest = 0, b""
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield _ndjson_record(number, line)
+    if rest.strip():
+        yield _ndjson_record(number + 1, rest)
+
+
+def _ndjson_record(number, line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise ValueError(f"Line {number}: invalid JSON") from None
+    if not isinstance(record, dict):
+        raise ValueError(f"Line {number}: expected a JSON object")
+    return record
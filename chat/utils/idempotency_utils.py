@@ -0,0 +1,236 @@
+# utils/idempotency_utils.py
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from utils import metrics_utils
+
+# Clients send an Idempotency-Key with /send_message and reuse it when they
+# retry, so a retry never generates or stores the reply a second time. The
+# requests seen are kept in a SQLite file shared by the worker processes of the
+# host; the gateway routes the requests of a key to the same host.
+IDEMPOTENCY_PATH = os.environ.get(
+    "IDEMPOTENCY_PATH",
+    os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "chat-idempotency.sqlite3",
+    ),
+)
+# Seconds a completed reply is replayed to retries
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", "3600"))
+# Seconds after which a request still running is taken as lost with its worker
+IDEMPOTENCY_PENDING_TTL = float(os.environ.get("IDEMPOTENCY_PENDING_TTL", "600"))
+# Seconds a retry waits for the original request to produce something to attach to
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", "30"))
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """Raised when a key is reused with a different request payload."""
+
+
+class IdempotencyPending(Exception):
+    """Raised when the request of a key is still running after the wait."""
+
+
+def fingerprint(payload):
+    """Digest of a JSON request payload, independent of the order of its keys."""
+    data = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Requests by (user, key), shared by the workers of a host.
+
+    The first request of a key claims it and runs; it then records the stream
+    of its reply (`attach`) and the reply itself once complete (`complete`), or
+    gives the key up if it failed (`release`). A request claiming a key already
+    taken gets that request's record instead, once it has a stream to follow
+    or a reply to replay.
+    """
+
+    def __init__(
+        self,
+        path,
+        ttl=IDEMPOTENCY_TTL,
+        pending_ttl=IDEMPOTENCY_PENDING_TTL,
+        poll_interval=IDEMPOTENCY_POLL_INTERVAL,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, reopened in a forked worker
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS requests (user_id TEXT, key TEXT, "
+                "fingerprint TEXT, stream_id TEXT, done INTEGER, reply TEXT, "
+                "interrupted INTEGER, updated_at REAL, PRIMARY KEY (user_id, key))"
+            )
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def _expire(self, connection, now):
+        connection.execute(
+            "DELETE FROM requests WHERE updated_at <= ? "
+            "AND (done = 1 OR updated_at <= ?)",
+            (now - self.ttl, now - self.pending_ttl),
+        )
+
+    def begin(self, user_id, key, digest):
+        """
+        Claim `key` for a request with the payload `digest`. Returns None when
+        the caller claimed it and must run the request, else the record of the
+        request that did.
+
+        Raises:
+            IdempotencyConflict: If the key was used with another payload.
+        """
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "DELETE FROM requests WHERE user_id = ? AND key = ? AND done = 0 "
+                "AND updated_at <= ?",
+                (str(user_id), key, now - self.pending_ttl),
+            )
+            record = self._get(connection, user_id, key)
+            if record is None:
+                self._expire(connection, now)
+                connection.execute(
+                    "INSERT INTO requests VALUES (?, ?, ?, NULL, 0, NULL, 0, ?)",
+                    (str(user_id), key, digest, now),
+                )
+                return None
+        if record["fingerprint"] != digest:
+            metrics_utils.idempotent_requests.labels("conflict").inc()
+            raise IdempotencyConflict(
+                "Idempotency-Key was already used with a different request"
+            )
+        return record
+
+    def _get(self, connection, user_id, key):
+        row = connection.execute(
+            "SELECT fingerprint, stream_id, done, reply, interrupted FROM requests "
+            "WHERE user_id = ? AND key = ?",
+            (str(user_id), key),
+        ).fetchone()
+        if row is None:
+            return None
+        keys = ("fingerprint", "stream_id", "done", "reply", "interrupted")
+        record = dict(zip(keys, row))
+        record["done"], record["interrupted"] = bool(record["done"]), bool(
+            record["interrupted"]
+        )
+        return record
+
+    def get(self, user_id, key):
+        """Record of the request of `key`, or None if there is none."""
+        return self._get(self._connection(), user_id, key)
+
+    def _update(self, sql, params):
+        connection = self._connection()
+        with connection:
+            connection.execute(sql, params)
+
+    def attach(self, user_id, key, stream_id):
+        """Record the stream of the reply, for retries to follow."""
+        self._update(
+            "UPDATE requests SET stream_id = ?, updated_at = ? "
+            "WHERE user_id = ? AND key = ?",
+            (stream_id, time.time(), str(user_id), key),
+        )
+
+    def complete(self, user_id, key, reply, interrupted=False):
+        """Record the reply, replayed to retries for `ttl` seconds."""
+        self._update(
+            "UPDATE requests SET done = 1, reply = ?, interrupted = ?, "
+            "updated_at = ? WHERE user_id = ? AND key = ?",
+            (reply, int(interrupted), time.time(), str(user_id), key),
+        )
+
+    def release(self, user_id, key):
+        """Give up a key whose request failed, so that a retry runs it again."""
+        self._update(
+            "DELETE FROM requests WHERE user_id = ? AND key = ? AND done = 0",
+            (str(user_id), key),
+        )
+
+    @staticmethod
+    def _ready(record):
+        return record["done"] or record["stream_id"] is not None
+
+    @staticmethod
+    def _claimed(record):
+        if record is not None:
+            outcome = "replayed" if record["done"] else "attached"
+            metrics_utils.idempotent_requests.labels(outcome).inc()
+        return record
+
+    def claim(self, user_id, key, digest, timeout=IDEMPOTENCY_WAIT):
+        """
+        `begin`, then wait up to `timeout` seconds until the request holding the
+        key has a stream or a reply. If that request fails meanwhile, the key is
+        claimed again.
+
+        Raises:
+            IdempotencyConflict: If the key was used with another payload.
+            IdempotencyPending: If the request is still running after `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.begin(user_id, key, digest)
+            if record is None or self._ready(record):
+                return self._claimed(record)
+            if time.monotonic() >= deadline:
+                raise IdempotencyPending("The original request is still running")
+            time.sleep(self.poll_interval)
+
+    async def _abegin(self, user_id, key, digest):
+        # If the request is cancelled while `begin` runs in its thread, a key
+        # it claimed meanwhile is given up again
+        begin = asyncio.ensure_future(
+            asyncio.to_thread(self.begin, user_id, key, digest)
+        )
+        try:
+            return await asyncio.shield(begin)
+        except asyncio.CancelledError:
+            begin.add_done_callback(lambda done: self._unclaim(done, user_id, key))
+            raise
+
+    def _unclaim(self, begin, user_id, key):
+        if not begin.cancelled() and begin.exception() is None:
+            if begin.result() is None:
+                asyncio.ensure_future(asyncio.to_thread(self.release, user_id, key))
+
+    async def aclaim(self, user_id, key, digest, timeout=IDEMPOTENCY_WAIT):
+        """
+        Asyncio version of `claim`. The file is queried in a thread, so a worker
+        holding its lock does not stall the event loop.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            record = await self._abegin(user_id, key, digest)
+            if record is None or self._ready(record):
+                return self._claimed(record)
+            if time.monotonic() >= deadline:
+                raise IdempotencyPending("The original request is still running")
+            await asyncio.sleep(self.poll_interval)
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_PATH)
@@ -0,0 +1,448 @@
+# utils/llm_pool_utils.py
+import asyncio
+import inspect
+import queue
+import random
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+# Circuit breaker states, as in the gateway's balancer
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Recent latency samples kept per endpoint for the p95: time to first token of
+# streamed calls, time to the whole reply of the others
+TTFT_SAMPLES = 100
+# Hedging waits for the p95 only once this many samples exist
+MIN_HEDGE_SAMPLES = 20
+
+
+class NoAvailableEndpoint(Exception):
+    """Raised when every LLM endpoint is ejected."""
+
+
+def llm_endpoints(base_url, api_key, extra=None):
+    """
+    (base_url, api_key) of every configured provider endpoint: the primary one,
+    then the comma separated `url|key` entries of `extra` (LLM_ENDPOINTS). An
+    entry without a key reuses the primary key.
+    """
+    endpoints = [(base_url, api_key)]
+    for entry in (extra or "").split(","):
+        url, _, key = entry.strip().partition("|")
+        if url:
+            endpoints.append((url, key or api_key))
+    return endpoints
+
+
+def _has_content(chunk):
+    choices = getattr(chunk, "choices", None)
+    return bool(choices) and bool(getattr(choices[0].delta, "content", None))
+
+
+class Endpoint:
+    """Health and latency of one provider endpoint."""
+
+    def __init__(self, client, name=None):
+        self.client = client
+        self.name = name or str(getattr(client, "base_url", "llm"))
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.ttft_ewma = None
+        self.ttfts = deque(maxlen=TTFT_SAMPLES)
+        self.latency_ewma = None
+        self.latencies = deque(maxlen=TTFT_SAMPLES)
+        self.last_error = None
+
+    def p95(self, stream=True):
+        return _percentile(self.ttfts if stream else self.latencies, 0.95)
+
+    def ewma(self, stream=True):
+        return self.ttft_ewma if stream else self.latency_ewma
+
+    def to_dict(self):
+        p95, latency_p95 = self.p95(), self.p95(stream=False)
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "ttft_ewma_ms": (
+                None if self.ttft_ewma is None else round(self.ttft_ewma * 1000, 2)
+            ),
+            "ttft_p95_ms": None if p95 is None else round(p95 * 1000, 2),
+            "latency_ewma_ms": (
+                None
+                if self.latency_ewma is None
+                else round(self.latency_ewma * 1000, 2)
+            ),
+            "latency_p95_ms": (
+                None if latency_p95 is None else round(latency_p95 * 1000, 2)
+            ),
+            "last_error": self.last_error,
+        }
+
+
+def _percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Race:
+    """Attempts of one request; the first to produce a first token wins."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.decided = False
+
+
+class EndpointPool:
+    """
+    Routing state shared by the sync and async pools.
+
+    Requests go to the available endpoint with the lowest smoothed time to first
+    token, or time to the whole reply for calls that do not stream (endpoints
+    without samples first, so each gets measured). After
+    `failure_threshold` consecutive failures an endpoint is ejected for
+    `open_timeout` seconds, then a single probe may re-admit it.
+
+    The pool stands in for an OpenAI client: `pool.chat.completions.create`
+    takes the same arguments. A failed attempt is retried on the next endpoint
+    as long as no token was returned, up to `max_attempts` attempts. With
+    `hedge`, a second attempt is started when the first has produced no token
+    after the pool's p95 time to first token (p95 time to the reply for calls
+    that do not stream), and the faster one is kept.
+    """
+
+    def __init__(
+        self,
+        clients,
+        max_attempts=3,
+        hedge=False,
+        hedge_delay=1.0,
+        min_hedge_delay=0.05,
+        failure_threshold=3,
+        open_timeout=30.0,
+    ):
+        self.endpoints = [Endpoint(client) for client in clients]
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.default_hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.hedges = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _is_available(self, endpoint, now):
+        if endpoint.state == CLOSED:
+            return True
+        if endpoint.state == OPEN and now - endpoint.opened_at >= self.open_timeout:
+            endpoint.state = HALF_OPEN
+        return endpoint.state == HALF_OPEN and not endpoint.probe_in_flight
+
+    def _pick(self, tried, stream=True):
+        """The fastest available endpoint, preferring ones not tried yet."""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if self._is_available(e, now)]
+            if not candidates:
+                return None
+            untried = [e for e in candidates if e not in tried]
+            candidates = untried or candidates
+            fastest = min(e.ewma(stream) or 0.0 for e in candidates)
+            endpoint = random.choice(
+                [e for e in candidates if (e.ewma(stream) or 0.0) == fastest]
+            )
+            if endpoint.state == HALF_OPEN:
+                endpoint.probe_in_flight = True
+            endpoint.total_requests += 1
+        return endpoint
+
+    def _succeeded(self, endpoint, seconds, stream=True):
+        # `seconds` is the time to first token of a stream, else to the reply
+        with self._lock:
+            endpoint.probe_in_flight = False
+            endpoint.consecutive_failures = 0
+            endpoint.state = CLOSED
+            (endpoint.ttfts if stream else endpoint.latencies).append(seconds)
+            average = endpoint.ewma(stream)
+            if average is not None:
+                seconds = 0.8 * average + 0.2 * seconds
+            if stream:
+                endpoint.ttft_ewma = seconds
+            else:
+                endpoint.latency_ewma = seconds
+
+    def _failed(self, endpoint, error):
+        with self._lock:
+            endpoint.probe_in_flight = False
+            endpoint.total_failures += 1
+            endpoint.consecutive_failures += 1
+            endpoint.last_error = str(error) or type(error).__name__
+            if (
+                endpoint.state == HALF_OPEN
+                or endpoint.consecutive_failures >= self.failure_threshold
+            ):
+                endpoint.state = OPEN
+                endpoint.opened_at = time.monotonic()
+
+    def hedge_delay(self, stream=True):
+        """
+        Seconds to wait for a first token (for the reply, when not streaming)
+        before hedging, None when off.
+        """
+        if not self.hedge:
+            return None
+        with self._lock:
+            samples = [
+                seconds
+                for e in self.endpoints
+                for seconds in (e.ttfts if stream else e.latencies)
+            ]
+        if len(samples) < MIN_HEDGE_SAMPLES:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, _percentile(samples, 0.95))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "endpoints": [e.to_dict() for e in self.endpoints],
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won,
+            }
+
+
+class LLMPool(EndpointPool):
+    """Pool of OpenAI clients; attempts run in threads so they can race."""
+
+    def create(self, **kwargs):
+        if kwargs.get("stream"):
+            endpoint, (chunks, stream) = self._race(self._start_stream, kwargs)
+            return self._relay(endpoint, chunks, stream)
+        return self._race(self._start, kwargs)[1]
+
+    @staticmethod
+    def _start(client, kwargs):
+        return client.chat.completions.create(**kwargs)
+
+    @staticmethod
+    def _start_stream(client, kwargs):
+        # Read up to the first chunk carrying content; what came before is kept
+        stream = client.chat.completions.create(**kwargs)
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                if _has_content(chunk):
+                    break
+        except BaseException:
+            stream.close()
+            raise
+        return chunks, stream
+
+    @staticmethod
+    def _discard(result):
+        if isinstance(result, tuple):
+            result[1].close()
+
+    def _attempt(self, race, endpoint, start, kwargs, results):
+        started = time.monotonic()
+        try:
+            result = start(endpoint.client, kwargs)
+        except Exception as e:
+            self._failed(endpoint, e)
+            results.put((endpoint, None, e))
+            return
+        self._succeeded(
+            endpoint, time.monotonic() - started, bool(kwargs.get("stream"))
+        )
+        with race.lock:
+            late = race.decided
+            race.decided = True
+        if late:
+            self._discard(result)  # Lost the race, nobody reads it
+        else:
+            results.put((endpoint, result, None))
+
+    def _race(self, start, kwargs):
+        race, results = _Race(), queue.Queue()
+        tried, pending, hedged, error = [], 0, False, None
+        stream = bool(kwargs.get("stream"))
+
+        def launch():
+            endpoint = None
+            if len(tried) < self.max_attempts:
+                endpoint = self._pick(tried, stream)
+            if endpoint is None:
+                return False
+            tried.append(endpoint)
+            threading.Thread(
+                target=self._attempt,
+                args=(race, endpoint, start, kwargs, results),
+                daemon=True,
+            ).start()
+            return True
+
+        if not launch():
+            raise NoAvailableEndpoint("No healthy LLM endpoint available")
+        pending = 1
+        while pending:
+            delay = None if hedged else self.hedge_delay(stream)
+            try:
+                endpoint, result, error = results.get(timeout=delay)
+            except queue.Empty:
+                hedged = True
+                if launch():
+                    pending += 1
+                    with self._lock:
+                        self.hedges += 1
+                continue
+            pending -= 1
+            if error is None:
+                if hedged and endpoint is not tried[0]:
+                    with self._lock:
+                        self.hedges_won += 1
+                return endpoint, result
+            # No token was returned yet, so the request can move on
+            if pending == 0 and launch():
+                pending += 1
+        raise error
+
+    def _relay(self, endpoint, chunks, stream):
+        try:
+            yield from chunks
+            yield from stream
+        except Exception as e:
+            self._failed(endpoint, e)
+            raise
+        finally:
+            stream.close()
+
+
+class AsyncLLMPool(EndpointPool):
+    """Pool of AsyncOpenAI clients; attempts race as tasks."""
+
+    async def create(self, **kwargs):
+        if kwargs.get("stream"):
+            endpoint, (chunks, stream) = await self._race(self._start_stream, kwargs)
+            return self._relay(endpoint, chunks, stream)
+        return (await self._race(self._start, kwargs))[1]
+
+    @staticmethod
+    async def _start(client, kwargs):
+        return await client.chat.completions.create(**kwargs)
+
+    @staticmethod
+    async def _start_stream(client, kwargs):
+        stream = await client.chat.completions.create(**kwargs)
+        chunks = []
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                if _has_content(chunk):
+                    break
+        except BaseException:
+            await _aclose(stream)
+            raise
+        return chunks, stream
+
+    async def _attempt(self, endpoint, start, kwargs):
+        started = time.monotonic()
+        try:
+            result = await start(endpoint.client, kwargs)
+        except asyncio.CancelledError:
+            with self._lock:
+                endpoint.probe_in_flight = False
+            raise
+        except Exception as e:
+            self._failed(endpoint, e)
+            raise
+        self._succeeded(
+            endpoint, time.monotonic() - started, bool(kwargs.get("stream"))
+        )
+        return result
+
+    async def _race(self, start, kwargs):
+        tried, tasks, hedged, error = [], {}, False, None
+        stream = bool(kwargs.get("stream"))
+
+        def launch():
+            endpoint = None
+            if len(tried) < self.max_attempts:
+                endpoint = self._pick(tried, stream)
+            if endpoint is None:
+                return False
+            tried.append(endpoint)
+            task = asyncio.ensure_future(self._attempt(endpoint, start, kwargs))
+            tasks[task] = endpoint
+            return True
+
+        if not launch():
+            raise NoAvailableEndpoint("No healthy LLM endpoint available")
+        try:
+            while tasks:
+                delay = None if hedged else self.hedge_delay(stream)
+                done, _ = await asyncio.wait(
+                    tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    if launch():
+                        with self._lock:
+                            self.hedges += 1
+                    continue
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    if task.exception() is None:
+                        if hedged and endpoint is not tried[0]:
+                            with self._lock:
+                                self.hedges_won += 1
+                        return endpoint, task.result()
+                    error = task.exception()
+                # No token was returned yet, so the request can move on
+                if not tasks:
+                    launch()
+            raise error
+        finally:
+            # Losing attempts are cancelled; a stream that already opened is closed
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(_close_result)
+
+    async def _relay(self, endpoint, chunks, stream):
+        try:
+            for chunk in chunks:
+                yield chunk
+            async for chunk in stream:
+                yield chunk
+        except Exception as e:
+            self._failed(endpoint, e)
+            raise
+        finally:
+            await _aclose(stream)
+
+
+async def _aclose(stream):
+    result = stream.close()
+    if inspect.isawaitable(result):
+        await result
+
+
+def _close_result(task):
+    if not task.cancelled() and task.exception() is None:
+        result = task.result()
+        if isinstance(result, tuple):
+            asyncio.ensure_future(_aclose(result[1]))
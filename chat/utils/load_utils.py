@@ -0,0 +1,556 @@
+# utils/load_utils.py
+import asyncio
+import fcntl
+import functools
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import psutil
+
+# Host-wide admission state, shared by every worker process through one file
+LOAD_STATE_PATH = os.environ.get(
+    "LOAD_STATE_PATH", os.path.join(tempfile.gettempdir(), "chat-load-state.json")
+)
+# Seconds between CPU/memory samples; 0 disables the sampler thread
+LOAD_SAMPLE_INTERVAL = float(os.environ.get("LOAD_SAMPLE_INTERVAL", "1"))
+# Weight of the newest sample in the smoothed CPU and memory figures
+LOAD_SMOOTHING = 0.3
+# Concurrent LLM calls allowed on this host, across all workers
+LLM_CONCURRENCY_LIMIT = int(os.environ.get("LLM_CONCURRENCY_LIMIT", "64"))
+# Requests allowed to wait for a free slot, and for how long (seconds)
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "256"))
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", "30"))
+ADMISSION_POLL_INTERVAL = 0.02
+# New LLM calls are shed while the smoothed CPU or memory usage is above these
+SHED_CPU_PERCENT = float(os.environ.get("SHED_CPU_PERCENT", "95"))
+SHED_MEMORY_PERCENT = float(os.environ.get("SHED_MEMORY_PERCENT", "95"))
+# Fair sharing between users: waiting requests get a slot lightest user first,
+# by the tokens each used recently (halved every USAGE_HALF_LIFE seconds) over
+# the user's weight. A user over HEAVY_USER_TOKENS is heavy: fewer concurrent
+# streams and a lower max_tokens per reply.
+USAGE_HALF_LIFE = float(os.environ.get("USAGE_HALF_LIFE", "600"))
+HEAVY_USER_TOKENS = float(os.environ.get("HEAVY_USER_TOKENS", "50000"))
+USER_CONCURRENCY_LIMIT = int(os.environ.get("USER_CONCURRENCY_LIMIT", "4"))
+HEAVY_USER_CONCURRENCY = int(os.environ.get("HEAVY_USER_CONCURRENCY", "1"))
+HEAVY_USER_MAX_TOKENS = int(os.environ.get("HEAVY_USER_MAX_TOKENS", "2048"))
+# Weights of users with a larger share, as comma separated "user_id:weight"
+USER_WEIGHTS = os.environ.get("USER_WEIGHTS", "")
+
+
+def parse_weights(spec):
+    """{"user_id": weight} of a USER_WEIGHTS value."""
+    weights = {}
+    for item in spec.split(","):
+        user_id, _, weight = item.strip().rpartition(":")
+        if user_id:
+            weights[user_id] = float(weight)
+    return weights
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted. `status` is 429 when the wait queue is
+    full and 503 when the host is saturated or the wait deadline passed.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedState:
+    """
+    A small JSON document shared by the worker processes of one host. Every
+    read-modify-write happens under an exclusive flock on the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def update(self):
+        with self._lock, open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            raw = f.read()
+            try:
+                state = json.loads(raw or "{}")
+            except ValueError:
+                state = {}
+            yield state
+            data = json.dumps(state)
+            # Unchanged state is not rewritten, so version() only moves on changes
+            if data != raw:
+                f.seek(0)
+                f.truncate()
+                f.write(data)
+
+    def version(self):
+        """Cheap change marker of the state, without taking the lock."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        with self._lock, open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            f.seek(0)
+            try:
+                return json.loads(f.read() or "{}")
+            except ValueError:
+                return {}
+
+
+class LoadSampler:
+    """
+    Background sampler of smoothed host CPU and memory usage.
+
+    Each worker runs the thread, but a sample is only taken when no worker took
+    one within the interval. CPU usage is computed from the host's cpu_times
+    stored in the shared state, so it does not depend on which process sampled
+    last.
+    """
+
+    def __init__(self, state, interval=LOAD_SAMPLE_INTERVAL, smoothing=LOAD_SMOOTHING):
+        self.state = state
+        self.interval = interval
+        self.smoothing = smoothing
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return (1 - self.smoothing) * previous + self.smoothing * value
+
+    def sample(self, now=None):
+        now = time.time() if now is None else now
+        times = psutil.cpu_times()
+        idle = times.idle + getattr(times, "iowait", 0.0)
+        total = sum(times)
+        memory = psutil.virtual_memory().percent
+        with self.state.update() as state:
+            load = state.setdefault("load", {})
+            if now - load.get("sampled_at", 0) < self.interval * 0.9:
+                return
+            previous = load.get("cpu_times")
+            if previous and total > previous[1]:
+                busy = (total - idle) - (previous[1] - previous[0])
+                cpu = 100.0 * busy / (total - previous[1])
+                load["cpu_percent"] = self._smooth(load.get("cpu_percent"), cpu)
+            load["cpu_times"] = [idle, total]
+            load["memory_percent"] = self._smooth(load.get("memory_percent"), memory)
+            load["sampled_at"] = now
+
+    def _loop(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Load sampling failed: {e}")
+            time.sleep(self.interval)
+
+    def ensure_started(self):
+        """Start the sampling thread once per (forked) worker process."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+
+class Slot:
+    """
+    Permission for one LLM call. Released exactly once, when the call (or the
+    stream) is over, with the tokens it used. `max_tokens` caps the reply of a
+    heavy user (None: no cap).
+    """
+
+    def __init__(self, controller, user=None, max_tokens=None):
+        self.controller = controller
+        self.user = user
+        self.max_tokens = max_tokens
+        self.started = time.time()
+        self.released = False
+
+    def release(self, tokens=0):
+        if not self.released:
+            self.released = True
+            self.controller.release(self, tokens)
+
+    async def arelease(self, tokens=0):
+        """`release` from a coroutine; the shared state is written off the loop."""
+        if not self.released:
+            self.released = True
+            await asyncio.to_thread(self.controller.release, self, tokens)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Host-wide concurrency limit on LLM calls with a bounded wait queue.
+
+    The slots in use and the queue live in the shared state, keyed by worker pid,
+    so entries of a worker that died are dropped by the next caller. A request
+    waits at most `timeout` seconds for a slot.
+
+    Requests of a user (see `acquire`) are scheduled fairly: a free slot goes to
+    the waiting request whose user used the fewest tokens lately for their
+    weight, FIFO among equals, and a user holds at most USER_CONCURRENCY_LIMIT
+    slots (HEAVY_USER_CONCURRENCY when heavy).
+    """
+
+    def __init__(
+        self,
+        state,
+        sampler,
+        limit=LLM_CONCURRENCY_LIMIT,
+        queue_size=ADMISSION_QUEUE_SIZE,
+        timeout=ADMISSION_TIMEOUT,
+        poll_interval=ADMISSION_POLL_INTERVAL,
+        half_life=USAGE_HALF_LIFE,
+        heavy_tokens=HEAVY_USER_TOKENS,
+        user_limit=USER_CONCURRENCY_LIMIT,
+        heavy_user_limit=HEAVY_USER_CONCURRENCY,
+        heavy_max_tokens=HEAVY_USER_MAX_TOKENS,
+        weights=None,
+    ):
+        self.state = state
+        self.sampler = sampler
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.half_life = half_life
+        self.heavy_tokens = heavy_tokens
+        self.user_limit = user_limit
+        self.heavy_user_limit = heavy_user_limit
+        self.heavy_max_tokens = heavy_max_tokens
+        self.weights = parse_weights(USER_WEIGHTS) if weights is None else weights
+        # Wakes waiting threads of this process when one of its slots is freed
+        self._released = threading.Condition()
+
+    def _prune(self, state, now):
+        workers = state.setdefault("workers", {})
+        queue = state.get("queue", [])
+        pids = {int(pid) for pid in workers} | {entry[1] for entry in queue}
+        dead = {pid for pid in pids if not _alive(pid)}
+        for pid in dead:
+            workers.pop(str(pid), None)
+        # Waiters remove their own ticket on timeout, these were abandoned
+        state["queue"] = [
+            entry for entry in queue if entry[1] not in dead and entry[2] + 5 > now
+        ]
+        users = state.setdefault("users", {})
+        for user, usage in list(users.items()):
+            usage["pids"] = [pid for pid in usage["pids"] if pid not in dead]
+            if not usage["pids"] and self._decayed(usage, now) < 1:
+                del users[user]
+
+    def _decayed(self, usage, now):
+        return usage["tokens"] * 0.5 ** (max(0.0, now - usage["at"]) / self.half_life)
+
+    def _share(self, state, user, now):
+        # Recent tokens of a user over their weight
+        usage = state.get("users", {}).get(user)
+        if user is None or usage is None:
+            return 0.0
+        return self._decayed(usage, now) / self.weights.get(user, 1.0)
+
+    def _user_limits(self, share):
+        """(concurrent slots, max_tokens) of a user with this share."""
+        if share >= self.heavy_tokens:
+            return self.heavy_user_limit, self.heavy_max_tokens
+        return self.user_limit, None
+
+    def _schedule(self, state, now):
+        """Tickets of the queue in the order they get a free slot."""
+        users = state.get("users", {})
+        held = Counter({user: len(usage["pids"]) for user, usage in users.items()})
+        shares = {}
+        for entry in state["queue"]:
+            user = _entry_user(entry)
+            if user not in shares:
+                shares[user] = self._share(state, user, now)
+        order = []
+        for entry in sorted(
+            state["queue"], key=lambda e: (shares[_entry_user(e)], e[0])
+        ):
+            user = _entry_user(entry)
+            if user is not None:
+                if held[user] >= self._user_limits(shares[user])[0]:
+                    continue  # Waits for a slot of the same user
+                held[user] += 1
+            order.append(entry[0])
+        return order
+
+    def _retry_after(self, state):
+        hold_time = state.get("hold_time") or 1.0
+        waiting = len(state.get("queue", [])) + 1
+        return min(60, max(1, math.ceil(hold_time * waiting / max(self.limit, 1))))
+
+    def _overloaded(self, state, now):
+        load = state.get("load") or {}
+        # Stale samples (sampler stopped) do not shed traffic
+        if now - load.get("sampled_at", 0) > max(5 * self.sampler.interval, 5):
+            return False
+        return (load.get("cpu_percent") or 0) > SHED_CPU_PERCENT or (
+            load.get("memory_percent") or 0
+        ) > SHED_MEMORY_PERCENT
+
+    def _reject(self, state, counter, message, status):
+        state[counter] = state.get(counter, 0) + 1
+        return Overloaded(message, status, self._retry_after(state))
+
+    def _step(self, ticket, deadline, user=None):
+        """
+        Try to take a slot for `user`. Returns None once admitted, otherwise the
+        ticket of the request in the wait queue.
+        """
+        now = time.time()
+        pid = os.getpid()
+        error = None
+        with self.state.update() as state:
+            self._prune(state, now)
+            workers = state["workers"]
+            queue = state["queue"]
+            free = self.limit - sum(workers.values())
+            usage = state["users"].get(user) or {"pids": []}
+            if ticket is None:
+                limit, _ = self._user_limits(self._share(state, user, now))
+                if self._overloaded(state, now):
+                    error = self._reject(
+                        state, "shed", "Service is overloaded, try again later", 503
+                    )
+                elif free > 0 and not queue and len(usage["pids"]) < limit:
+                    pass  # Admitted right away
+                elif len(queue) >= self.queue_size:
+                    error = self._reject(
+                        state, "rejected", "Too many requests, try again later", 429
+                    )
+                else:
+                    ticket = state.get("next_ticket", 0)
+                    state["next_ticket"] = ticket + 1
+                    queue.append([ticket, pid, deadline, user])
+                    return ticket
+            else:
+                tickets = [entry[0] for entry in queue]
+                position = tickets.index(ticket) if ticket in tickets else None
+                admitted = self._schedule(state, now)[: max(free, 0)]
+                if position is not None and ticket in admitted:
+                    del queue[position]
+                elif now >= deadline or position is None:
+                    state["queue"] = [entry for entry in queue if entry[0] != ticket]
+                    error = self._reject(
+                        state, "timed_out", "Timed out waiting for the model", 503
+                    )
+                else:
+                    return ticket
+            if error is None:
+                workers[str(pid)] = workers.get(str(pid), 0) + 1
+                state["admitted"] = state.get("admitted", 0) + 1
+                if user is not None:
+                    usage = state["users"].setdefault(
+                        user, {"tokens": 0.0, "at": now, "pids": []}
+                    )
+                    usage["pids"].append(pid)
+        if error is not None:
+            raise error
+        return None
+
+    def _unchanged(self, deadline, seen):
+        # Slots and queue positions only change when the state is written; a
+        # full step still runs now and then in case of a coarse file clock.
+        # Returns None when nothing changed, else the new `seen` marker.
+        now = time.time()
+        version = self.state.version()
+        if seen and version == seen[0] and now < min(deadline, seen[1] + 0.25):
+            return None
+        return version, now
+
+    def _poll(self, ticket, deadline, user, seen):
+        marker = self._unchanged(deadline, seen)
+        if marker is None:
+            return ticket, seen
+        return self._step(ticket, deadline, user), marker
+
+    async def _astep(self, ticket, deadline, user):
+        # The step takes the file lock, so it runs in a thread. If the request
+        # is cancelled meanwhile, the step still completes and is then undone.
+        step = asyncio.ensure_future(
+            asyncio.to_thread(self._step, ticket, deadline, user)
+        )
+        try:
+            return await asyncio.shield(step)
+        except asyncio.CancelledError:
+            step.add_done_callback(lambda done: self._undo(done, user))
+            raise
+
+    def _undo(self, step, user):
+        if step.cancelled() or step.exception() is not None:
+            return
+        ticket = step.result()
+        if ticket is None:
+            undo = Slot(self, user).release  # Admitted after all
+        else:
+            undo = functools.partial(self._abandon, ticket)
+        asyncio.ensure_future(asyncio.to_thread(undo))
+
+    def _abandon(self, ticket):
+        with self.state.update() as state:
+            state["queue"] = [e for e in state.get("queue", []) if e[0] != ticket]
+
+    def _slot(self, user):
+        limits = self.limits(user) if user is not None else {"max_tokens": None}
+        return Slot(self, user, limits["max_tokens"])
+
+    def acquire(self, user_id=None, timeout=None):
+        """
+        Take an LLM slot for a request of `user_id` (None: not scheduled per
+        user), waiting in the queue while none is free.
+
+        Raises:
+            Overloaded: If the queue is full, the host is saturated or no slot
+                became free before the deadline.
+        """
+        self.sampler.ensure_started()
+        user = None if user_id is None else str(user_id)
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        ticket = self._step(None, deadline, user)
+        try:
+            seen = None
+            while ticket is not None:
+                with self._released:
+                    self._released.wait(self.poll_interval)
+                ticket, seen = self._poll(ticket, deadline, user, seen)
+        except BaseException:
+            if ticket is not None:
+                self._abandon(ticket)
+            raise
+        return self._slot(user)
+
+    async def aacquire(self, user_id=None, timeout=None):
+        """
+        Asyncio version of `acquire`. The shared state is read and written in
+        threads, so a worker holding its lock does not stall the event loop.
+        """
+        self.sampler.ensure_started()
+        user = None if user_id is None else str(user_id)
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        ticket = await self._astep(None, deadline, user)
+        try:
+            seen = None
+            while ticket is not None:
+                await asyncio.sleep(self.poll_interval)
+                marker = self._unchanged(deadline, seen)
+                if marker is not None:
+                    seen = marker
+                    ticket = await self._astep(ticket, deadline, user)
+        except BaseException:
+            # Also reached when the client goes away while the request waits
+            if ticket is not None:
+                await asyncio.shield(asyncio.to_thread(self._abandon, ticket))
+            raise
+        try:
+            return await asyncio.to_thread(self._slot, user)
+        except BaseException:
+            await asyncio.shield(asyncio.to_thread(Slot(self, user).release))
+            raise
+
+    def release(self, slot, tokens=0):
+        now = time.time()
+        held = now - slot.started
+        key = str(os.getpid())
+        with self.state.update() as state:
+            workers = state.setdefault("workers", {})
+            if workers.get(key, 0) <= 1:
+                workers.pop(key, None)
+            else:
+                workers[key] -= 1
+            usage = state.setdefault("users", {}).get(slot.user)
+            if usage is not None:
+                if os.getpid() in usage["pids"]:
+                    usage["pids"].remove(os.getpid())
+                # The tokens of the call count towards the user's share
+                usage["tokens"] = self._decayed(usage, now) + tokens
+                usage["at"] = now
+            hold_time = state.get("hold_time")
+            state["hold_time"] = (
+                held if hold_time is None else 0.8 * hold_time + 0.2 * held
+            )
+        with self._released:
+            self._released.notify_all()
+
+    def limits(self, user_id):
+        """Recent usage, share and current limits of a user on this host."""
+        user = str(user_id)
+        now = time.time()
+        state = self.state.read()
+        usage = (state.get("users") or {}).get(user)
+        share = self._share(state, user, now)
+        concurrency, max_tokens = self._user_limits(share)
+        return {
+            "recent_tokens": 0.0 if usage is None else self._decayed(usage, now),
+            "weight": self.weights.get(user, 1.0),
+            "heavy": share >= self.heavy_tokens,
+            "in_flight": 0 if usage is None else len(usage["pids"]),
+            "concurrency_limit": concurrency,
+            "max_tokens": max_tokens,
+        }
+
+    def snapshot(self):
+        """Smoothed load and admission counters of the host."""
+        state = self.state.read()
+        load = state.get("load") or {}
+        return {
+            "cpu_percent": load.get("cpu_percent"),
+            "memory_percent": load.get("memory_percent"),
+            "sampled_at": load.get("sampled_at"),
+            "in_flight": sum((state.get("workers") or {}).values()),
+            "users": len(state.get("users") or {}),
+            "queued": len(state.get("queue") or []),
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "hold_time": state.get("hold_time"),
+            "admitted": state.get("admitted", 0),
+            "rejected": state.get("rejected", 0),
+            "shed": state.get("shed", 0),
+            "timed_out": state.get("timed_out", 0),
+        }
+
+
+def _entry_user(entry):
+    # Queue entries are [ticket, pid, deadline, user]
+    return entry[3] if len(entry) > 3 else None
+
+
+shared_state = SharedState(LOAD_STATE_PATH)
+load_sampler = LoadSampler(shared_state)
+admission = AdmissionController(shared_state, load_sampler)
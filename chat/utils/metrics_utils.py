@@ -0,0 +1,130 @@
+# utils/metrics_utils.py
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# With PROMETHEUS_MULTIPROC_DIR set, every gunicorn worker writes its samples to
+# files in that directory and /metrics sums them over the workers (see
+# gunicorn.conf.py). Without it the metrics are those of the current process.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+llm_ttft_seconds = Histogram(
+    "chat_llm_ttft_seconds",
+    "Time from sending a streamed completion request to its first token",
+    buckets=LATENCY_BUCKETS,
+)
+llm_tokens_per_second = Histogram(
+    "chat_llm_tokens_per_second",
+    "Completion tokens per second of a stream, after its first token",
+    buckets=TOKEN_RATE_BUCKETS,
+)
+llm_tokens = Counter(
+    "chat_llm_tokens",
+    "Tokens reported in the usage of completions",
+    ["kind"],
+)
+llm_requests = Counter(
+    "chat_llm_requests",
+    "Completion requests by outcome (ok, error, cancelled or cached)",
+    ["stream", "outcome"],
+)
+llm_tokens_saved = Counter(
+    "chat_llm_tokens_saved",
+    "max_tokens left unused by streams closed because the client went away, "
+    "an upper bound of the generation avoided",
+)
+llm_streams_in_flight = Gauge(
+    "chat_llm_streams_in_flight",
+    "Completion streams currently open",
+    multiprocess_mode="livesum",
+)
+db_seconds = Histogram(
+    "chat_db_seconds",
+    "Latency of a db_utils function, all of its queries included",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+db_errors = Counter(
+    "chat_db_errors",
+    "db_utils functions that raised",
+    ["operation"],
+)
+db_coalesced = Counter(
+    "chat_db_coalesced",
+    "db_utils reads that shared the query of an identical read in flight",
+    ["operation"],
+)
+idempotent_requests = Counter(
+    "chat_idempotent_requests",
+    "Retries of /send_message answered by the request of their Idempotency-Key",
+    ["outcome"],  # attached, replayed or conflict
+)
+
+
+def record_usage(usage):
+    """Count the prompt and completion tokens of a usage object (may be None)."""
+    if usage is None:
+        return
+    for kind in ("prompt", "completion"):
+        tokens = getattr(usage, f"{kind}_tokens", None)
+        if isinstance(tokens, int):
+            llm_tokens.labels(kind).inc(tokens)
+
+
+class StreamTimer:
+    """TTFT and token rate of one completion stream."""
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.chunks = 0
+        self.usage = None
+        llm_streams_in_flight.inc()
+
+    def chunk(self, chunk, content):
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if content:
+            self.chunks += 1
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+                llm_ttft_seconds.observe(self.first_token_at - self.started)
+
+    def finish(self, outcome):
+        """`outcome` is ok, error or cancelled (the client went away)."""
+        llm_streams_in_flight.dec()
+        llm_requests.labels("true", outcome).inc()
+        record_usage(self.usage)
+        # Without usage, one content chunk is about one token
+        tokens = getattr(self.usage, "completion_tokens", None) or self.chunks
+        if outcome == "cancelled" and self.max_tokens:
+            llm_tokens_saved.inc(max(0, self.max_tokens - tokens))
+        if outcome != "ok" or self.first_token_at is None:
+            return
+        elapsed = time.monotonic() - self.first_token_at
+        if elapsed > 0 and tokens > 1:
+            llm_tokens_per_second.observe((tokens - 1) / elapsed)
+
+
+def metrics_response():
+    """(body, content type) of the /metrics endpoint."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
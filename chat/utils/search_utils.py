@@ -0,0 +1,81 @@
+# utils/search_utils.py
+import math
+import os
+import re
+from collections import Counter
+
+# Full-text search over a user's messages. Every stored message adds one posting
+# per distinct term to the 'chat_search' table, keyed by (user_id, term, chat_id,
+# seq) with the term frequency (migrations/004_chat_search.sql), so a query reads
+# the postings of its terms for one user instead of scanning messages.
+#
+# Terms are lower-cased runs of word characters, except that CJK ideographs are
+# terms on their own since Chinese is not written with spaces. The migration
+# backfills postings with the same regular expression in Postgres.
+TERM_PATTERN = re.compile(r"[\u4e00-\u9fff]|[^\W\u4e00-\u9fff]+")
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+# Results per query, and postings read per query term (a very common term
+# keeps those with the highest term frequency)
+DEFAULT_RESULTS = int(os.environ.get("SEARCH_RESULTS", "10"))
+MAX_RESULTS = 50
+MAX_POSTINGS = int(os.environ.get("SEARCH_MAX_POSTINGS", "5000"))
+SNIPPET_CHARS = 160
+
+
+def tokenize(text):
+    """Terms of a text, in order and with repeats."""
+    return [
+        term
+        for term in TERM_PATTERN.findall((text or "").lower())
+        if len(term) <= MAX_TERM_LENGTH
+    ]
+
+
+def query_terms(query):
+    """Distinct terms of a search query, at most MAX_QUERY_TERMS."""
+    return list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+
+
+def postings(user_id, chat_id, seq, content):
+    """The 'chat_search' rows of one message."""
+    return [
+        {"user_id": user_id, "term": term, "chat_id": chat_id, "seq": seq, "tf": tf}
+        for term, tf in Counter(tokenize(content)).items()
+    ]
+
+
+def rank(terms, rows, documents, limit, df=None):
+    """
+    Score the messages of the postings `rows` with tf-idf over the user's
+    `documents` (number of messages), scaled by the fraction of the query terms
+    each message contains. `df` maps each term to its number of postings, when
+    `rows` holds only some of them. Returns the best `limit` as
+    ((chat_id, seq), score).
+    """
+    if df is None:
+        df = Counter(row["term"] for row in rows)
+    scores, matched = Counter(), Counter()
+    for row in rows:
+        key = (row["chat_id"], row["seq"])
+        idf = math.log(1 + max(documents, 1) / df[row["term"]])
+        scores[key] += (1 + math.log(row["tf"])) * idf
+        matched[key] += 1
+    for key in scores:
+        scores[key] *= matched[key] / len(terms)
+    # Ties go to the most recent message
+    best = sorted(scores.items(), key=lambda item: (-item[1], -item[0][1]))
+    return best[:limit]
+
+
+def snippet(content, terms, size=SNIPPET_CHARS):
+    """About `size` characters of `content` around the first query term."""
+    lowered = content.lower()
+    hits = [lowered.find(term) for term in terms]
+    first = min((hit for hit in hits if hit >= 0), default=0)
+    start = max(0, min(first - size // 3, len(content) - size))
+    text = content[start : start + size].strip()
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if start + size < len(content) else ""
+    return f"{prefix}{text}{suffix}"
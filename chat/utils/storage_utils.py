@@ -0,0 +1,301 @@
+# utils/storage_utils.py
+import json
+import os
+import sqlite3
+import threading
+
+# db_utils talks to storage through a small subset of the Supabase query
+# builder, so any client providing it is a storage backend:
+#
+#   client.table(name)
+#       .select(columns="*", count=None) | .insert(rows) | .update(values) | .delete()
+#       .eq / .gt / .gte / .lt / .lte (column, value), .in_(column, values)
+#       .order(column, desc=False), .limit(size), .range(start, end)
+#       .execute()  -> response with .data (list of row dicts) and .count
+#
+# The Supabase Client (AsyncClient for deepseek_async) is one backend. SQLiteClient
+# (AsyncSQLiteClient) keeps the same tables in an embedded SQLite file, for
+# single-node and edge deployments and as a local stand-in in tests and
+# benchmarks. deepseek.py picks one with STORAGE_BACKEND.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_history (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id       INTEGER NOT NULL,
+    name          TEXT    NOT NULL,
+    messages      TEXT,
+    message_count INTEGER,
+    summary       TEXT,
+    summary_seq   INTEGER,
+    created_at    TEXT,
+    updated_at    TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS chat_history_user_name
+    ON chat_history (user_id, name);
+CREATE INDEX IF NOT EXISTS chat_history_user_updated_at
+    ON chat_history (user_id, updated_at);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    chat_id     INTEGER NOT NULL REFERENCES chat_history (id) ON DELETE CASCADE,
+    seq         INTEGER NOT NULL,
+    role        TEXT    NOT NULL,
+    content     TEXT    NOT NULL,
+    timestamp   TEXT,
+    interrupted INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chat_messages_chat_timestamp
+    ON chat_messages (chat_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS chat_search (
+    user_id INTEGER NOT NULL,
+    term    TEXT    NOT NULL,
+    chat_id INTEGER NOT NULL REFERENCES chat_history (id) ON DELETE CASCADE,
+    seq     INTEGER NOT NULL,
+    tf      INTEGER NOT NULL,
+    PRIMARY KEY (user_id, term, chat_id, seq)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS chat_usage (
+    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id           INTEGER NOT NULL,
+    chat_name         TEXT,
+    day               TEXT    NOT NULL,
+    requests          INTEGER NOT NULL,
+    prompt_tokens     INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    created_at        TEXT
+);
+CREATE INDEX IF NOT EXISTS chat_usage_user_day ON chat_usage (user_id, day);
+"""
+
+# Columns stored as JSON text, and as 0/1
+JSON_COLUMNS = {"messages"}
+BOOLEAN_COLUMNS = {"interrupted"}
+
+
+class SQLiteResponse:
+    """Result of a query, shaped like a Supabase response."""
+
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class SQLiteQuery:
+    """
+    Query builder of SQLiteClient. Values are always bound as parameters, so
+    SQLite reuses the compiled statement of every query shape (the sqlite3
+    module keeps a per-connection statement cache); column names are checked
+    against the table.
+    """
+
+    def __init__(self, client, table):
+        self.client = client
+        self.table = table
+        self.action = "select"
+        self.columns = "*"
+        self.count = None
+        self.payload = None
+        self.filters = []  # (SQL condition, parameters)
+        self.ordering = []
+        self.size = None
+        self.offset = None
+
+    def select(self, columns="*", count=None):
+        self.action, self.columns, self.count = "select", columns, count
+        return self
+
+    def insert(self, data):
+        self.action, self.payload = "insert", data
+        return self
+
+    def update(self, data):
+        self.action, self.payload = "update", data
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    def _column(self, column):
+        column = column.strip()
+        if column not in self.client.columns(self.table):
+            raise ValueError(f"Unknown column {column!r} of {self.table}")
+        return f'"{column}"'
+
+    def _filter(self, column, operator, value):
+        condition = f"{self._column(column)} {operator} ?"
+        self.filters.append((condition, [_encode(column, value)]))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "=", value)
+
+    def gt(self, column, value):
+        return self._filter(column, ">", value)
+
+    def gte(self, column, value):
+        return self._filter(column, ">=", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "<", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "<=", value)
+
+    def in_(self, column, values):
+        values = list(values)
+        marks = ", ".join("?" * len(values))
+        condition = f"{self._column(column)} IN ({marks})"
+        self.filters.append((condition, [_encode(column, v) for v in values]))
+        return self
+
+    def order(self, column, desc=False):
+        self.ordering.append(f"{self._column(column)} {'DESC' if desc else 'ASC'}")
+        return self
+
+    def limit(self, size):
+        self.size = size
+        return self
+
+    def range(self, start, end):
+        self.offset, self.size = start, end - start + 1
+        return self
+
+    def _where(self):
+        if not self.filters:
+            return "", []
+        conditions = " AND ".join(condition for condition, _ in self.filters)
+        return f" WHERE {conditions}", [p for _, params in self.filters for p in params]
+
+    def _select(self, connection):
+        if self.columns.strip() == "*":
+            columns = "*"
+        else:
+            columns = ", ".join(self._column(c) for c in self.columns.split(","))
+        where, params = self._where()
+        sql = f'SELECT {columns} FROM "{self.table}"{where}'
+        if self.ordering:
+            sql += " ORDER BY " + ", ".join(self.ordering)
+        window = []
+        if self.size is not None or self.offset is not None:
+            sql += " LIMIT ? OFFSET ?"
+            window = [-1 if self.size is None else self.size, self.offset or 0]
+        rows = connection.execute(sql, params + window).fetchall()
+        count = None
+        if self.count:
+            count = connection.execute(
+                f'SELECT COUNT(*) FROM "{self.table}"{where}', params
+            ).fetchone()[0]
+        return rows, count
+
+    def _write(self, connection):
+        where, params = self._where()
+        if self.action == "delete":
+            return connection.execute(
+                f'DELETE FROM "{self.table}"{where} RETURNING *', params
+            ).fetchall()
+        if self.action == "update":
+            columns = list(self.payload)
+            assignments = ", ".join(f"{self._column(c)} = ?" for c in columns)
+            values = [_encode(c, self.payload[c]) for c in columns]
+            return connection.execute(
+                f'UPDATE "{self.table}" SET {assignments}{where} RETURNING *',
+                values + params,
+            ).fetchall()
+        rows = self.payload if isinstance(self.payload, list) else [self.payload]
+        inserted = []
+        for row in rows:
+            columns = list(row)
+            names = ", ".join(self._column(c) for c in columns)
+            marks = ", ".join("?" * len(columns))
+            inserted += connection.execute(
+                f'INSERT INTO "{self.table}" ({names}) VALUES ({marks}) RETURNING *',
+                [_encode(c, row[c]) for c in columns],
+            ).fetchall()
+        return inserted
+
+    def _execute(self):
+        connection = self.client.connection()
+        if self.action == "select":
+            rows, count = self._select(connection)
+        else:
+            # A write is one transaction: a batch insert lands whole or not at all
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                rows, count = self._write(connection), None
+        return SQLiteResponse([_decode(row) for row in rows], count)
+
+    def execute(self):
+        return self._execute()
+
+
+class AsyncSQLiteQuery(SQLiteQuery):
+    async def execute(self):
+        # Queries of the local file take microseconds, so they run inline
+        return self._execute()
+
+
+def _encode(column, value):
+    if column.strip() in JSON_COLUMNS and value is not None:
+        return json.dumps(value)
+    return value
+
+
+def _decode(row):
+    data = dict(row)
+    for column in JSON_COLUMNS & data.keys():
+        if data[column] is not None:
+            data[column] = json.loads(data[column])
+    for column in BOOLEAN_COLUMNS & data.keys():
+        data[column] = bool(data[column])
+    return data
+
+
+class SQLiteClient:
+    """
+    Storage backend keeping the chat tables in a SQLite file in WAL mode, so
+    the worker processes of a host share it. `path` must be a file: every
+    thread has its own connection.
+    """
+
+    query_class = SQLiteQuery
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._columns = {}
+
+    def connection(self):
+        # One connection per thread, reopened in a forked worker
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None, cached_statements=256
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def columns(self, table):
+        columns = self._columns.get(table)
+        if columns is None:
+            rows = self.connection().execute(f'PRAGMA table_info("{table}")')
+            columns = self._columns[table] = {row["name"] for row in rows}
+            if not columns:
+                raise ValueError(f"Unknown table {table!r}")
+        return columns
+
+    def table(self, name):
+        return self.query_class(self, name)
+
+
+class AsyncSQLiteClient(SQLiteClient):
+    """SQLiteClient whose queries are awaited, like the Supabase AsyncClient."""
+
+    query_class = AsyncSQLiteQuery
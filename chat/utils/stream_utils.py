@@ -0,0 +1,451 @@
+# utils/stream_utils.py
+import asyncio
+import inspect
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# Streamed replies are written to a SQLite file shared by the worker processes
+# of the host, on tmpfs when available, so a client can resume a reply from any
+# worker. The gateway routes a resume to the host that started the stream.
+STREAM_BUFFER_PATH = os.environ.get(
+    "STREAM_BUFFER_PATH",
+    os.path.join(
+        "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+        "chat-streams.sqlite3",
+    ),
+)
+# Bytes of a reply kept for resuming; older bytes are dropped like in a ring
+STREAM_BUFFER_BYTES = int(os.environ.get("STREAM_BUFFER_BYTES", str(256 * 1024)))
+# Seconds a finished reply stays resumable
+STREAM_RESUME_TTL = float(os.environ.get("STREAM_RESUME_TTL", "60"))
+# Seconds the model keeps generating while no client reads the reply
+STREAM_RESUME_GRACE = float(os.environ.get("STREAM_RESUME_GRACE", "10"))
+STREAM_POLL_INTERVAL = 0.02
+# Model deltas are a few bytes each; they are written to the buffer (and so to
+# the client) in batches of at least this many bytes, or after this many seconds;
+# the first delta is written at once
+STREAM_FLUSH_BYTES = int(os.environ.get("STREAM_FLUSH_BYTES", "32"))
+STREAM_FLUSH_INTERVAL = float(os.environ.get("STREAM_FLUSH_INTERVAL", "0.02"))
+# Seconds a closed `coalesce` waits for its reader thread to close the chunks
+STREAM_CLOSE_WAIT = 0.05
+
+
+class StreamGone(Exception):
+    """Raised when a resume offset was already dropped from the buffer."""
+
+
+# Put by the reader thread of `coalesce` after the last chunk
+_END = object()
+
+
+def _read_ahead(chunks, items, stop):
+    # Runs in the reader thread of `coalesce`. A generator cannot be closed
+    # while another thread runs it, so once stopped this thread closes the
+    # chunks itself, as soon as the chunk it is waiting for arrives.
+    try:
+        for chunk in chunks:
+            items.put((chunk, None))
+            if stop.is_set():
+                close = getattr(chunks, "close", None)
+                if close is not None:
+                    close()
+                return
+    except Exception as e:
+        items.put((None, e))
+        return
+    items.put((_END, None))
+
+
+def coalesce(chunks, min_bytes=STREAM_FLUSH_BYTES, max_delay=STREAM_FLUSH_INTERVAL):
+    """
+    Merge small text chunks into batches of at least `min_bytes` bytes (UTF-8),
+    flushing a smaller batch once `max_delay` seconds passed since its first
+    chunk, even if no further chunk arrives. The first chunk is not held back,
+    and the last batch is flushed when the chunks run out.
+
+    The chunks are read by a helper thread. Closing the generator returns at
+    once and closes the chunks (in that thread, when the chunk it is waiting
+    for arrives), so a reply cut short does not wait for the model.
+    """
+    items, stop = queue.SimpleQueue(), threading.Event()
+    reader = threading.Thread(
+        target=_read_ahead, args=(chunks, items, stop), daemon=True
+    )
+    reader.start()
+    batch, size, deadline, sent = [], 0, None, False
+    try:
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                chunk, error = items.get(timeout=timeout)
+            except queue.Empty:
+                chunk, error = "", None  # Timed out: flush what is buffered
+            if error is not None:
+                raise error
+            if chunk is _END:
+                break
+            if chunk:
+                batch.append(chunk)
+                size += len(chunk.encode("utf-8"))
+                if deadline is None:
+                    deadline = time.monotonic() + max_delay
+            if batch and (
+                not sent or size >= min_bytes or time.monotonic() >= deadline
+            ):
+                text, batch, size, deadline, sent = "".join(batch), [], 0, None, True
+                yield text
+        if batch:
+            yield "".join(batch)
+    finally:
+        stop.set()
+        # Usually the next chunk is close, and the chunks are closed on return
+        reader.join(STREAM_CLOSE_WAIT)
+
+
+async def acoalesce(
+    chunks, min_bytes=STREAM_FLUSH_BYTES, max_delay=STREAM_FLUSH_INTERVAL
+):
+    """Asyncio version of `coalesce`, for an async iterator of chunks."""
+    iterator = chunks.__aiter__()
+    batch, size, deadline, sent = [], 0, None, False
+    pending = None  # The next chunk, awaited across flushes
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                chunk = await asyncio.wait_for(asyncio.shield(pending), timeout)
+                pending = None
+            except asyncio.TimeoutError:
+                chunk = ""  # Timed out: flush what is buffered
+            except StopAsyncIteration:
+                pending = None
+                break
+            if chunk:
+                batch.append(chunk)
+                size += len(chunk.encode("utf-8"))
+                if deadline is None:
+                    deadline = time.monotonic() + max_delay
+            if batch and (
+                not sent or size >= min_bytes or time.monotonic() >= deadline
+            ):
+                text, batch, size, deadline, sent = "".join(batch), [], 0, None, True
+                yield text
+        if batch:
+            yield "".join(batch)
+    finally:
+        if pending is not None:
+            # Stop waiting for the next chunk before the chunks are closed
+            pending.cancel()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()
+
+
+class StreamBuffer:
+    """
+    Bounded buffer of streamed replies, shared by the workers of a host.
+
+    A producer appends the chunks of a reply as the model generates them; any
+    number of readers follow it from a byte offset. Readers record when they
+    last read, so the producer can stop a reply that nobody has been reading
+    for `grace` seconds. Only the last `max_bytes` of a reply are kept.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=STREAM_BUFFER_BYTES,
+        ttl=STREAM_RESUME_TTL,
+        grace=STREAM_RESUME_GRACE,
+        poll_interval=STREAM_POLL_INTERVAL,
+        flush_bytes=STREAM_FLUSH_BYTES,
+        flush_interval=STREAM_FLUSH_INTERVAL,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.grace = grace
+        self.poll_interval = poll_interval
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        # Wakes the readers of this process when a chunk is appended
+        self._appended = threading.Condition()
+
+    def _connection(self):
+        # One connection per thread, reopened in a forked worker
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")  # Lost on reboot anyway
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS streams (id TEXT PRIMARY KEY, "
+                "user_id TEXT, total INTEGER, start INTEGER, done INTEGER, "
+                "interrupted INTEGER, read_at REAL, updated_at REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (stream_id TEXT, "
+                "offset INTEGER, data BLOB, PRIMARY KEY (stream_id, offset))"
+            )
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def create(self, user_id):
+        """Register a new reply of `user_id` and return its stream id."""
+        stream_id = uuid.uuid4().hex
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            self._expire(connection, now)
+            connection.execute(
+                "INSERT INTO streams VALUES (?, ?, 0, 0, 0, 0, ?, ?)",
+                (stream_id, str(user_id), now, now),
+            )
+        return stream_id
+
+    def _expire(self, connection, now):
+        # Finished replies after the TTL, unfinished ones whose producer died
+        expired = [
+            row[0]
+            for row in connection.execute(
+                "SELECT id FROM streams WHERE updated_at <= ? "
+                "AND (done = 1 OR updated_at <= ?)",
+                (now - self.ttl, now - self.ttl - self.grace),
+            )
+        ]
+        for stream_id in expired:
+            connection.execute("DELETE FROM chunks WHERE stream_id = ?", (stream_id,))
+            connection.execute("DELETE FROM streams WHERE id = ?", (stream_id,))
+
+    def append(self, stream_id, text):
+        data = text.encode("utf-8")
+        if not data:
+            return
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            total, start = connection.execute(
+                "SELECT total, start FROM streams WHERE id = ?", (stream_id,)
+            ).fetchone()
+            connection.execute(
+                "INSERT INTO chunks VALUES (?, ?, ?)", (stream_id, total, data)
+            )
+            total += len(data)
+            if total - start > self.max_bytes:
+                # Drop whole chunks from the front until the rest fits
+                connection.execute(
+                    "DELETE FROM chunks WHERE stream_id = ? "
+                    "AND offset + length(data) <= ?",
+                    (stream_id, total - self.max_bytes),
+                )
+                start = connection.execute(
+                    "SELECT MIN(offset) FROM chunks WHERE stream_id = ?",
+                    (stream_id,),
+                ).fetchone()[0]
+            connection.execute(
+                "UPDATE streams SET total = ?, start = ?, updated_at = ? "
+                "WHERE id = ?",
+                (total, start, time.time(), stream_id),
+            )
+        with self._appended:
+            self._appended.notify_all()
+
+    def finish(self, stream_id, interrupted=False):
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "UPDATE streams SET done = 1, interrupted = ?, updated_at = ? "
+                "WHERE id = ?",
+                (int(interrupted), time.time(), stream_id),
+            )
+        with self._appended:
+            self._appended.notify_all()
+
+    def info(self, stream_id):
+        """State of a reply, or None if it is unknown or expired."""
+        row = (
+            self._connection()
+            .execute(
+                "SELECT user_id, total, start, done, interrupted, read_at "
+                "FROM streams WHERE id = ?",
+                (stream_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        keys = ("user_id", "total", "start", "done", "interrupted", "read_at")
+        info = dict(zip(keys, row))
+        info["done"], info["interrupted"] = bool(info["done"]), bool(
+            info["interrupted"]
+        )
+        return info
+
+    def read(self, stream_id, offset):
+        """
+        Bytes of the reply from `offset` on, and whether the reply is complete.
+
+        Raises:
+            KeyError: If the stream is unknown or expired.
+            StreamGone: If `offset` is before the oldest byte kept.
+        """
+        connection = self._connection()
+        # One read transaction, so a concurrent append cannot drop chunks
+        # between the check of the offset and the read of the chunks
+        with connection:
+            connection.execute("BEGIN")
+            info = self.info(stream_id)
+            if info is None:
+                raise KeyError(stream_id)
+            if offset < info["start"]:
+                raise StreamGone(f"Offset {offset} is no longer buffered")
+            rows = connection.execute(
+                "SELECT offset, data FROM chunks WHERE stream_id = ? "
+                "AND offset + length(data) > ? ORDER BY offset",
+                (stream_id, offset),
+            ).fetchall()
+        data = b"".join(
+            bytes(chunk)[max(0, offset - chunk_offset) :]
+            for chunk_offset, chunk in rows
+        )
+        # A reply finished before this read only has the rows read above
+        return data, info["done"]
+
+    def touch(self, stream_id):
+        """Record that a client is reading the reply."""
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "UPDATE streams SET read_at = ? WHERE id = ?", (time.time(), stream_id)
+            )
+
+    def unread(self, stream_id):
+        """True when no client has read the reply for `grace` seconds."""
+        info = self.info(stream_id)
+        return info is None or time.time() - info["read_at"] > self.grace
+
+    def _heartbeat(self):
+        # Readers check in often enough that a live one never looks gone
+        return min(1.0, self.grace / 3)
+
+    def follow(self, stream_id, offset=0):
+        """
+        Generator of the reply's bytes from `offset` on, waiting for new chunks
+        until the reply is complete. Call `read` first to validate the offset.
+        """
+        touched = 0.0
+        while True:
+            data, done = self.read(stream_id, offset)
+            if data:
+                offset += len(data)
+                yield data
+            if done:
+                return
+            now = time.monotonic()
+            if now - touched >= self._heartbeat():
+                self.touch(stream_id)
+                touched = now
+            if not data:
+                with self._appended:
+                    self._appended.wait(self.poll_interval)
+
+    async def afollow(self, stream_id, offset=0):
+        """
+        Asyncio version of `follow`. Like the other coroutines here, it queries
+        the file in a thread, so a writer holding its lock does not stall the
+        event loop.
+        """
+        touched = 0.0
+        while True:
+            data, done = await asyncio.to_thread(self.read, stream_id, offset)
+            if data:
+                offset += len(data)
+                yield data
+            if done:
+                return
+            now = time.monotonic()
+            if now - touched >= self._heartbeat():
+                await asyncio.to_thread(self.touch, stream_id)
+                touched = now
+            if not data:
+                await asyncio.sleep(self.poll_interval)
+
+    def _check_every(self):
+        return max(self.poll_interval, self._heartbeat())
+
+    def _done(self, stream_id, parts, interrupted, on_done):
+        # The reply is handed over (e.g. queued for the database) before the
+        # readers see its end, so a client reading the history next has it
+        try:
+            if on_done is not None:
+                on_done("".join(parts), interrupted)
+        finally:
+            self.finish(stream_id, interrupted)
+
+    def pump(self, stream_id, chunks, on_done=None):
+        """
+        Copy the chunks of a reply into the buffer, coalesced into batches (see
+        `coalesce`), until they run out or until no client has read the reply
+        for `grace` seconds; a reply cut short has its chunks closed, which
+        stops the model. Then call `on_done(text, interrupted)` with the text
+        copied and whether the reply was cut short.
+        """
+        parts, interrupted, checked = [], True, time.monotonic()
+        batches = coalesce(chunks, self.flush_bytes, self.flush_interval)
+        try:
+            for batch in batches:
+                parts.append(batch)
+                self.append(stream_id, batch)
+                if time.monotonic() - checked >= self._check_every():
+                    checked = time.monotonic()
+                    if self.unread(stream_id):
+                        break
+            else:
+                interrupted = False
+        finally:
+            batches.close()
+            self._done(stream_id, parts, interrupted, on_done)
+
+    async def apump(self, stream_id, chunks, on_done=None):
+        """
+        Asyncio version of `pump`, for an async iterator of chunks. `on_done`
+        may be a coroutine function.
+        """
+        parts, interrupted, checked = [], True, time.monotonic()
+        batches = acoalesce(chunks, self.flush_bytes, self.flush_interval)
+        try:
+            async for batch in batches:
+                parts.append(batch)
+                await asyncio.to_thread(self.append, stream_id, batch)
+                if time.monotonic() - checked >= self._check_every():
+                    checked = time.monotonic()
+                    if await asyncio.to_thread(self.unread, stream_id):
+                        break
+            else:
+                interrupted = False
+        finally:
+            await batches.aclose()
+            # on_done runs in the event loop, as the caller's code expects
+            try:
+                if on_done is not None:
+                    result = on_done("".join(parts), interrupted)
+                    if inspect.isawaitable(result):
+                        await result
+            finally:
+                await asyncio.to_thread(self.finish, stream_id, interrupted)
+
+
+stream_buffer = StreamBuffer(STREAM_BUFFER_PATH)
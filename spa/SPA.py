@@ -1,8 +1,16 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import (
+    Flask,
+    render_template,
+    request,
+    jsonify,
+    Response,
+    stream_with_context,
+)
 import requests
 import os
-import random
-
+import zlib
+from utils import metrics_utils, upstream_utils
+from utils.balancer_utils import LoadBalancer, NoAvailableBackend
 
 app = Flask(__name__)
 
@@ -11,18 +19,155 @@ CHAT_SERVICE_URL1 = os.environ.get("CHAT_SERVICE_URL1", "http://127.0.0.1:5002")
 CHAT_SERVICE_URL2 = os.environ.get("CHAT_SERVICE_URL2", "http://127.0.0.1:5002")
 lt = [CHAT_SERVICE_URL1, CHAT_SERVICE_URL2]
 
+# Route chat requests to the least loaded healthy backend in lt
+balancer = LoadBalancer(
+    lt,
+    failure_threshold=int(os.environ.get("CHAT_FAILURE_THRESHOLD", "3")),
+    open_timeout=float(os.environ.get("CHAT_OPEN_TIMEOUT", "10")),
+    health_interval=float(os.environ.get("CHAT_HEALTH_INTERVAL", "5")),
+)
+
+# Upper bound (bytes) on a single chunk relayed from the chat service to the browser
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", "1024"))
+
+
+def relay_stream(upstream_response, lease=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Forward an upstream streaming response chunk by chunk.
+
+    Each chunk is yielded as soon as it arrives, so at most `chunk_size` bytes are
+    held by the gateway at any time. The upstream connection is always closed,
+    including when the browser disconnects and the WSGI server closes this generator.
+    The backend lease is held until then, so long streams count as in-flight.
+    """
+    metrics_utils.streams_in_flight.inc()
+    try:
+        for chunk in upstream_response.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    except requests.exceptions.RequestException as e:
+        if lease:
+            lease.fail(str(e))
+        raise
+    finally:
+        metrics_utils.streams_in_flight.dec()
+        upstream_response.close()
+        if lease:
+            lease.release()
+
+
+# Backpressure and replay headers of /send_message relayed to the browser
+RELAYED_SEND_HEADERS = ("Retry-After", "Idempotent-Replayed")
+
+
+# A streamed reply can only be resumed on the backend that generates it, so the
+# stream id given to the browser is prefixed with that backend's index
+def public_stream_id(lease, stream_id):
+    return f"{balancer.backends.index(lease.backend)}.{stream_id}"
+
+
+def stream_backend(public_id):
+    index, _, stream_id = public_id.partition(".")
+    if not index.isdigit() or int(index) >= len(balancer.backends) or not stream_id:
+        return None, None
+    return balancer.backends[int(index)].url, stream_id
+
+
+def stream_headers(response, lease):
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Disable proxy buffering in nginx
+        **{
+            key: response.headers[key]
+            for key in RELAYED_SEND_HEADERS
+            if key in response.headers
+        },
+    }
+    if "X-Stream-Id" in response.headers:
+        headers["X-Stream-Id"] = public_stream_id(
+            lease, response.headers["X-Stream-Id"]
+        )
+    return headers
+
+
+# The chat service deduplicates retries of /send_message by their
+# Idempotency-Key in a store per host, so all the requests of a key go to the
+# same backend while it is available
+def keyed_lease(token, key):
+    if key is None:
+        return balancer.lease()
+    index = zlib.crc32(f"{token}|{key}".encode("utf-8")) % len(balancer.backends)
+    try:
+        return balancer.lease(balancer.backends[index].url)
+    except NoAvailableBackend:
+        return balancer.lease()
+
+
+# Validation headers relayed untouched between the browser and the chat service
+CONDITIONAL_REQUEST_HEADERS = ("If-None-Match",)
+CONDITIONAL_RESPONSE_HEADERS = ("ETag", "Cache-Control")
+
+
+def conditional_headers():
+    return {
+        key: request.headers[key]
+        for key in CONDITIONAL_REQUEST_HEADERS
+        if key in request.headers
+    }
+
+
+def relay_response(upstream_response):
+    """
+    Relay a buffered upstream response as-is, including 304 Not Modified replies
+    and their validation headers.
+    """
+    return Response(
+        upstream_response.content,
+        status=upstream_response.status_code,
+        content_type=upstream_response.headers.get("Content-Type"),
+        headers={
+            key: upstream_response.headers[key]
+            for key in CONDITIONAL_RESPONSE_HEADERS
+            if key in upstream_response.headers
+        },
+    )
+
 
 @app.route("/")
 def index():
     return render_template("index.html")
 
 
+@app.errorhandler(NoAvailableBackend)
+def no_available_backend(e):
+    return (
+        jsonify({"error": "Chat service unavailable", "details": str(e)}),
+        503,
+        {"Retry-After": str(int(balancer.open_timeout))},
+    )
+
+
+@app.route("/api/backends")
+def backends():
+    """Expose the balancer's per-backend state"""
+    return jsonify({"backends": balancer.snapshot()}), 200
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics of the gateway, summed over its workers"""
+    body, content_type = metrics_utils.metrics_response()
+    return Response(body, content_type=content_type)
+
+
 @app.route("/api/health")
 def health():
-    CHAT_SERVICE_URL = random.choice(lt)
     try:
-        response = requests.get(f"{CHAT_SERVICE_URL}/health")
+        with balancer.lease() as lease:
+            response = lease.check(upstream_utils.get(f"{lease.url}/health"))
         return jsonify(response.json()), response.status_code
+    except NoAvailableBackend:
+        raise
     except requests.exceptions.RequestException as e:
         return (
             jsonify({"error": "Authentication service unreachable", "details": str(e)}),
@@ -42,7 +187,7 @@ def login():
     """Proxy user login request to the authentication service"""
     try:
         data = request.json
-        response = requests.post(f"{AUTH_SERVICE_URL}/login", json=data)
+        response = upstream_utils.post(f"{AUTH_SERVICE_URL}/login", json=data)
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
         return (
@@ -63,7 +208,7 @@ def register():
     """Proxy user registration request to the authentication service"""
     try:
         data = request.json
-        response = requests.post(f"{AUTH_SERVICE_URL}/register", json=data)
+        response = upstream_utils.post(f"{AUTH_SERVICE_URL}/register", json=data)
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException as e:
         return (
@@ -79,7 +224,6 @@ def register():
 @app.route("/api/start_chat", methods=["POST"])
 def start_chat():
     """Proxy chat initiation request to the chat service"""
-    CHAT_SERVICE_URL = random.choice(lt)
     try:
         token = request.headers.get("Authorization")
         if not token:
@@ -89,9 +233,12 @@ def start_chat():
             "Authorization": token,  # Forward authentication token
             "Content-Type": "application/json",
         }
-        response = requests.post(
-            f"{CHAT_SERVICE_URL}/start_chat", json=data, headers=headers
-        )  # Forward request to chat service
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.post(
+                    f"{lease.url}/start_chat", json=data, headers=headers
+                )
+            )  # Forward request to chat service
         return jsonify(response.json()), response.status_code
 
     except requests.exceptions.RequestException as e:
@@ -104,7 +251,6 @@ def start_chat():
 @app.route("/api/chat_list", methods=["GET"])
 def chat_list():
     """Proxy chat list request to the chat service"""
-    CHAT_SERVICE_URL = random.choice(lt)
     try:
         token = request.headers.get("Authorization")
 
@@ -114,13 +260,15 @@ def chat_list():
         headers = {
             "Authorization": token,  # Forward authentication token
             "Content-Type": "application/json",
+            **conditional_headers(),
         }
 
-        response = requests.get(
-            f"{CHAT_SERVICE_URL}/chat_list", headers=headers
-        )  # Forward request to chat service
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.get(f"{lease.url}/chat_list", headers=headers)
+            )  # Forward request to chat service
 
-        return jsonify(response.json()), response.status_code
+        return relay_response(response)
 
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
@@ -132,25 +280,145 @@ def chat_list():
 @app.route("/api/chat_history", methods=["GET"])
 def chat_history():
     """Forward the /api/chat_history request to the backend service."""
-    CHAT_SERVICE_URL = random.choice(lt)
     try:
         token = request.headers.get("Authorization")
         if not token:
             return jsonify({"error": "Authorization token is missing"}), 401
 
-        # Get the chat_name from query parameters
+        # Get the chat_name and the page window from query parameters
         chat_name = request.args.get("chat_name", "")
         params = {"chat_name": chat_name}
+        for key in ("limit", "before", "after", "since"):
+            if key in request.args:
+                params[key] = request.args[key]
         headers = {
             "Authorization": token,  # Forward the authentication token
             "Content-Type": "application/json",
+            **conditional_headers(),
         }
 
         # Forward the request to the backend service's /chat_history endpoint
-        response = requests.get(
-            f"{CHAT_SERVICE_URL}/chat_history", headers=headers, params=params
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.get(
+                    f"{lease.url}/chat_history", headers=headers, params=params
+                )
+            )
+        return relay_response(response)
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
+
+
+# search the messages of all the user's chats
+@app.route("/api/search", methods=["GET"])
+def search():
+    """Forward the /api/search request to the backend service."""
+    try:
+        token = request.headers.get("Authorization")
+        if not token:
+            return jsonify({"error": "Authorization token is missing"}), 401
+
+        params = {
+            key: request.args[key] for key in ("q", "limit") if key in request.args
+        }
+        headers = {"Authorization": token}
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.get(
+                    f"{lease.url}/search", headers=headers, params=params
+                )
+            )
+        return relay_response(response)
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
+
+
+@app.route("/api/usage", methods=["GET"])
+def usage():
+    """Forward the /api/usage request to the backend service."""
+    try:
+        token = request.headers.get("Authorization")
+        if not token:
+            return jsonify({"error": "Authorization token is missing"}), 401
+
+        params = {"days": request.args["days"]} if "days" in request.args else {}
+        headers = {"Authorization": token}
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.get(f"{lease.url}/usage", headers=headers, params=params)
+            )
+        return relay_response(response)
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
+
+
+# Bytes of an uploaded export read and sent upstream at a time
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", str(64 * 1024)))
+
+
+@app.route("/api/export", methods=["GET"])
+def export():
+    """Relay the NDJSON export of the user's chats as it is read."""
+    try:
+        token = request.headers.get("Authorization")
+        if not token:
+            return jsonify({"error": "Authorization token is missing"}), 401
+
+        lease = balancer.lease()
+        try:
+            response = lease.check(
+                upstream_utils.get(
+                    f"{lease.url}/export",
+                    headers={"Authorization": token},
+                    stream=True,
+                )
+            )
+        except Exception as e:
+            lease.fail(str(e))
+            lease.release()
+            raise
+        headers = {"X-Accel-Buffering": "no"}
+        if "Content-Disposition" in response.headers:
+            headers["Content-Disposition"] = response.headers["Content-Disposition"]
+        return Response(
+            stream_with_context(relay_stream(response, lease)),
+            status=response.status_code,
+            content_type=response.headers.get("Content-Type"),
+            headers=headers,
         )
-        return jsonify(response.json()), response.status_code
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
+
+
+@app.route("/api/import", methods=["POST"])
+def import_chats():
+    """
+    Forward an NDJSON export to the backend service without buffering it: the
+    body is sent upstream chunked, as it is read from the browser.
+    """
+    try:
+        token = request.headers.get("Authorization")
+        if not token:
+            return jsonify({"error": "Authorization token is missing"}), 401
+
+        body = iter(lambda: request.stream.read(IMPORT_CHUNK_SIZE), b"")
+        headers = {"Authorization": token, "Content-Type": "application/x-ndjson"}
+        with balancer.lease() as lease:
+            response = lease.check(
+                upstream_utils.post(
+                    f"{lease.url}/import",
+                    headers=headers,
+                    params=request.args,
+                    data=body,
+                    # A large import takes longer than a buffered request
+                    timeout=upstream_utils.default_timeout(stream=True),
+                )
+            )
+        return relay_response(response)
 
     except requests.exceptions.RequestException as e:
         return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
@@ -159,7 +427,6 @@ def chat_history():
 @app.route("/api/send_message", methods=["POST"])
 def send_message():
     """Forward the /send_message request to the backend service."""
-    CHAT_SERVICE_URL = random.choice(lt)
     try:
         token = request.headers.get("Authorization")
         if not token:
@@ -170,14 +437,66 @@ def send_message():
             "Authorization": token,  # Forward the authentication token
             "Content-Type": "application/json",
         }
+        key = request.headers.get("Idempotency-Key")
+        if key is not None:
+            headers["Idempotency-Key"] = key
         # Forward the request to the backend service's /send_message endpoint
-        response = requests.post(
-            f"{CHAT_SERVICE_URL}/send_message", headers=headers, json=data
+        # and relay the reply while it is still being generated
+        lease = keyed_lease(token, key)
+        try:
+            response = lease.check(
+                upstream_utils.post(
+                    f"{lease.url}/send_message",
+                    headers=headers,
+                    json=data,
+                    stream=True,
+                )
+            )
+        except Exception as e:
+            lease.fail(str(e))
+            lease.release()
+            raise
+        return Response(
+            stream_with_context(relay_stream(response, lease)),
+            status=response.status_code,
+            content_type=response.headers.get("Content-Type"),
+            headers=stream_headers(response, lease),
         )
+
+    except requests.exceptions.RequestException as e:
+        return jsonify({"error": "Chat service unreachable", "details": str(e)}), 500
+
+
+@app.route("/api/stream/<stream_id>", methods=["GET"])
+def resume_stream(stream_id):
+    """Resume a streamed reply on the backend generating it, from `offset`."""
+    try:
+        token = request.headers.get("Authorization")
+        if not token:
+            return jsonify({"error": "Authorization token is missing"}), 401
+        url, backend_stream_id = stream_backend(stream_id)
+        if url is None:
+            return jsonify({"message": "Stream not found"}), 404
+
+        lease = balancer.lease(url)
+        try:
+            response = lease.check(
+                upstream_utils.get(
+                    f"{lease.url}/stream/{backend_stream_id}",
+                    headers={"Authorization": token},
+                    params=request.args,
+                    stream=True,
+                )
+            )
+        except Exception as e:
+            lease.fail(str(e))
+            lease.release()
+            raise
         return Response(
-            response.content,
+            stream_with_context(relay_stream(response, lease)),
             status=response.status_code,
             content_type=response.headers.get("Content-Type"),
+            headers=stream_headers(response, lease),
         )
 
     except requests.exceptions.RequestException as e:
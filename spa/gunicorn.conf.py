@@ -0,0 +1,21 @@
+# gunicorn.conf.py, read by gunicorn from the working directory
+import os
+import shutil
+
+# Per-worker metric files of prometheus_client, see utils/metrics_utils.py
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to the new ones
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR)
+
+
+def child_exit(server, worker):
+    # Drop the in-flight gauges of a worker that exited
+    if PROMETHEUS_MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
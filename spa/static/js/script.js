@@ -1,5 +1,12 @@
 let currentChatName = '';
 
+// chat history is loaded page by page, most recent first
+const HISTORY_PAGE_SIZE = 50;
+let oldestLoadedSeq = null;
+let hasOlderHistory = false;
+let loadingOlderHistory = false;
+let newestLoadedSeq = null;
+
 async function hashPassword(password) {
     const encoder = new TextEncoder();
     const data = encoder.encode(password);
@@ -92,8 +99,10 @@ async function startChat() {
 // get historical chat name
 async function fetchChatHistoryList() {
     try {
+        // revalidate with If-None-Match, an unchanged list comes back as an empty 304
         const response = await fetch('/api/chat_list', {
             method: 'GET',
+            cache: 'no-cache',
             headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
         });
 
@@ -118,67 +127,200 @@ async function fetchChatHistoryList() {
     }
 }
 
-// get conversation history
+// text of a stored message; a reply cut short by a disconnect is marked as such
+function messageText(msg) {
+    const text = msg.content || (msg.interrupted ? '' : "[Empty Message]");
+    return msg.interrupted ? `${text} <em>[interrupted]</em>` : text;
+}
+
+// get one page of conversation history, older than `before` or newer than `since` if given
+async function fetchHistoryPage(chatName, before, since) {
+    const params = new URLSearchParams({ chat_name: chatName, limit: HISTORY_PAGE_SIZE });
+    if (before !== null && before !== undefined) params.set('before', before);
+    if (since !== null && since !== undefined) params.set('since', since);
+
+    const response = await fetch(`/api/chat_history?${params}`, {
+        method: 'GET',
+        cache: 'no-cache',  // revalidate with If-None-Match
+        headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+    });
+    const data = await response.json();
+    if (!response.ok || !data.messages) throw new Error(data.message || 'Failed to load chat history');
+    return data;
+}
+
+// get conversation history, starting with the most recent page
 async function fetchChatHistory(chatName) {
     try {
-        const response = await fetch(`/api/chat_history?chat_name=${encodeURIComponent(chatName)}`, {
-            method: 'GET',
-            headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+        const data = await fetchHistoryPage(chatName);
+        console.log("[DEBUG] Chat history:", data);
+
+        const chatBox = document.getElementById('chat-box');
+        chatBox.innerHTML = "";
+
+        data.messages.forEach(msg => {
+            const sender = msg.role || "Unknown"; 
+            updateChatBox(sender, messageText(msg));
         });
+        oldestLoadedSeq = data.next_before;
+        newestLoadedSeq = data.next_after;
+        hasOlderHistory = data.has_more;
+    } catch (error) {
+        console.error("Error fetching chat history:", error);
+        alert(error.message);
+    }
+}
 
-        const data = await response.json();
-        console.log("[DEBUG] Chat history:", data);
+const HISTORY_SYNC_RETRIES = 3;
 
-        if (response.ok && data.messages) {
-            const chatBox = document.getElementById('chat-box');
-            chatBox.innerHTML = "";
+// after sending, fetch only the messages newer than the last one loaded
+// and show those written elsewhere (e.g. another tab) before this turn
+async function syncChatHistory(chatName, message, pendingBubbles, retries = 0) {
+    try {
+        const data = await fetchHistoryPage(chatName, null, newestLoadedSeq);
+        if (chatName !== currentChatName) return;
+        const chatBox = document.getElementById('chat-box');
+        const ownTurn = data.messages.slice(-2);
+        const stored = ownTurn.length === 2 && ownTurn[0].role === 'user' && ownTurn[0].content === message;
+        const others = stored ? data.messages.slice(0, -2) : data.messages;
+        others.forEach(msg => {
+            const bubble = createChatMessage(msg.role || "Unknown", messageText(msg));
+            chatBox.insertBefore(bubble, pendingBubbles[0] || null);
+        });
+        if (data.messages.length) newestLoadedSeq = data.next_after;
+        if (!stored && retries < HISTORY_SYNC_RETRIES) {
+            // the server that answered may not see this turn yet, so keep the
+            // bubbles and look again; reopening the chat shows what was stored
+            setTimeout(() => syncChatHistory(chatName, message, pendingBubbles, retries + 1),
+                500 * (retries + 1));
+        }
+    } catch (error) {
+        console.error("Error syncing chat history:", error);
+    }
+}
 
-            data.messages.forEach(msg => {
-                const sender = msg.role || "Unknown"; 
-                const message = msg.content || "[Empty Message]";
-                updateChatBox(sender, message);
-            });
-        } else {
-            alert(data.message);
+// prepend the previous page when the user scrolls to the top of the chat box
+async function loadOlderHistory() {
+    if (loadingOlderHistory || !hasOlderHistory || !currentChatName) return;
+    loadingOlderHistory = true;
+    try {
+        const chatBox = document.getElementById('chat-box');
+        const data = await fetchHistoryPage(currentChatName, oldestLoadedSeq);
+        const previousHeight = chatBox.scrollHeight;
+
+        for (let i = data.messages.length - 1; i >= 0; i--) {
+            const msg = data.messages[i];
+            chatBox.prepend(createChatMessage(msg.role || "Unknown", messageText(msg)));
         }
+        MathJax.typesetPromise();
+        // keep the messages the user was looking at in place
+        chatBox.scrollTop = chatBox.scrollHeight - previousHeight;
+
+        oldestLoadedSeq = data.next_before;
+        hasOlderHistory = data.has_more;
     } catch (error) {
-        console.error("Error fetching chat history:", error);
+        console.error("Error fetching older chat history:", error);
+    } finally {
+        loadingOlderHistory = false;
     }
 }
 
+document.getElementById('chat-box').addEventListener('scroll', event => {
+    if (event.target.scrollTop < 50) loadOlderHistory();
+});
+
 
 // send message and get response 
+const STREAM_RESUME_RETRIES = 5;
+const SEND_RETRIES = 3;
+
+// post a message, retrying when the request fails on the way; the retries share
+// an Idempotency-Key, so the chat service answers each message only once
+async function postMessage(body) {
+    const idempotencyKey = crypto.randomUUID();
+    for (let retries = 0; ; retries++) {
+        try {
+            const response = await fetch('/api/send_message', {
+                method: 'POST',
+                body: JSON.stringify(body),
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${localStorage.getItem('token')}`,
+                    'Idempotency-Key': idempotencyKey
+                }
+            });
+            // 409: the first attempt is still running; 502/504: a proxy gave up
+            if (![409, 502, 504].includes(response.status) || retries >= SEND_RETRIES) {
+                return response;
+            }
+        } catch (error) {
+            if (retries >= SEND_RETRIES) throw error;
+        }
+        await new Promise(resolve => setTimeout(resolve, 500 * (retries + 1)));
+    }
+}
+
+// reopen a streamed reply from a byte offset; 404/410 mean it cannot be resumed
+async function resumeStream(streamId, offset) {
+    const response = await fetch(`/api/stream/${streamId}?offset=${offset}`, {
+        headers: { 'Authorization': `Bearer ${localStorage.getItem('token')}` }
+    });
+    if (!response.ok) throw new Error(`Cannot resume reply (${response.status})`);
+    return response.body.getReader();
+}
+
 async function sendMessage() {
     const message = document.getElementById('message').value.trim();
     if (!message) return;
 
     // show user's latest message
-    updateChatBox('User', message);
+    const pendingBubbles = [updateChatBox('User', message)];
     // clear input box
     document.getElementById('message').value = '';
 
     try {
-        const response = await fetch('/api/send_message', {
-            method: 'POST',
-            body: JSON.stringify({ message, chat_name: currentChatName }),
-            headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${localStorage.getItem('token')}`
-            }
-        });
+        const response = await postMessage({ message, chat_name: currentChatName });
+
+        if (!response.ok) {
+            // 429/503: the chat service is busy, tell the user when to retry
+            const data = await response.json().catch(() => ({}));
+            const retryAfter = response.headers.get('Retry-After');
+            let note = data.message || data.error || `Request failed (${response.status})`;
+            if (retryAfter) note += ` Please try again in ${retryAfter}s.`;
+            updateChatBox('DeepSeek', note);
+            return;
+        }
 
-        const reader = response.body.getReader();
+        const streamId = response.headers.get('X-Stream-Id');
+        let reader = response.body.getReader();
         const decoder = new TextDecoder();
         let done = false;
         let assistantMessage = '';
+        // bytes received so far, the offset to resume the reply from
+        let received = 0;
+        let retries = 0;
 
         // show deepseek's message
-        updateChatBox('DeepSeek', '');
+        pendingBubbles.push(updateChatBox('DeepSeek', ''));
 
         while (!done) {
-            const { value, done: readerDone } = await reader.read();
+            let result;
+            try {
+                result = await reader.read();
+            } catch (error) {
+                // the connection dropped: resume the reply where it stopped
+                if (!streamId || retries >= STREAM_RESUME_RETRIES) throw error;
+                retries += 1;
+                await new Promise(resolve => setTimeout(resolve, 500 * retries));
+                reader = await resumeStream(streamId, received).catch(() => null);
+                if (!reader) throw error;
+                continue;
+            }
+            const { value, done: readerDone } = result;
             done = readerDone;
             if (value) {
+                received += value.length;
+                retries = 0;
                 // update chunk content
                 const chunk = decoder.decode(value, { stream: true });
                 console.log("[DEBUG] chunk in front-end:", chunk);
@@ -190,6 +332,7 @@ async function sendMessage() {
             }
         }
 
+        await syncChatHistory(currentChatName, message, pendingBubbles);
     } catch (error) {
         console.error("Send message error:", error);
     }
@@ -200,20 +343,28 @@ function mapRoleToDisplayName(role) {
     if (role === 'user') return 'User';
     return 'unidentified';
 }
-// update chatbox
-function updateChatBox(sender, message) {
-    const chatBox = document.getElementById('chat-box');
+// build a chat bubble
+function createChatMessage(sender, message) {
     const messageDiv = document.createElement('div');
 
     messageDiv.classList.add('chat-message', sender.toLowerCase() === 'user' ? 'user' : 'assistant');
 
     messageDiv.innerHTML = `<p><strong>${sender}:</strong> ${message}</p>`;
 
+    return messageDiv;
+}
+
+// update chatbox
+function updateChatBox(sender, message) {
+    const chatBox = document.getElementById('chat-box');
+
+    const messageDiv = createChatMessage(sender, message);
     chatBox.appendChild(messageDiv);
 
     MathJax.typesetPromise();
 
     chatBox.scrollTop = chatBox.scrollHeight;
+    return messageDiv;
 }
 
 
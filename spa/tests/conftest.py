@@ -0,0 +1,4 @@
+import os
+
+# Disable the background /health polling of chat backends during tests
+os.environ.setdefault("CHAT_HEALTH_INTERVAL", "0")
@@ -0,0 +1,121 @@
+import pytest
+from utils import balancer_utils
+from utils.balancer_utils import LoadBalancer, NoAvailableBackend
+
+
+class DummyResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def make_balancer(**kwargs):
+    kwargs.setdefault("health_interval", 0)
+    return LoadBalancer(["http://chat1", "http://chat2"], **kwargs)
+
+
+def test_duplicate_urls_are_one_backend():
+    balancer = LoadBalancer(["http://chat", "http://chat"], health_interval=0)
+    assert len(balancer.backends) == 1
+
+
+def test_routes_to_least_outstanding_backend():
+    balancer = make_balancer()
+    first = balancer.lease()
+    second = balancer.lease()
+    # The two in-flight requests are spread across both backends
+    assert first.url != second.url
+    first.release()
+    third = balancer.lease()
+    assert third.url == first.url
+    states = {b["url"]: b["in_flight"] for b in balancer.snapshot()}
+    assert states == {"http://chat1": 1, "http://chat2": 1}
+
+
+def test_lease_a_specific_backend():
+    balancer = make_balancer()
+    busy = balancer.lease("http://chat2")
+    # Even the busier backend is used when the request is tied to it
+    assert balancer.lease("http://chat2").url == "http://chat2"
+    busy.backend.healthy = False
+    with pytest.raises(NoAvailableBackend):
+        balancer.lease("http://chat2")
+    with pytest.raises(NoAvailableBackend):
+        balancer.lease("http://unknown")
+
+
+def test_consecutive_failures_eject_backend():
+    balancer = make_balancer(failure_threshold=2, open_timeout=60)
+    chat1 = balancer.backends[0]
+    for _ in range(2):
+        lease = balancer.lease()
+        while lease.backend is not chat1:
+            lease.release()
+            lease = balancer.lease()
+        lease.check(DummyResponse(503))
+        lease.release()
+    assert chat1.state == balancer_utils.OPEN
+    for _ in range(5):
+        with balancer.lease() as lease:
+            assert lease.url == "http://chat2"
+
+
+def test_load_shedding_is_not_a_failure():
+    balancer = make_balancer(failure_threshold=1)
+    with balancer.lease() as lease:
+        lease.check(DummyResponse(503, {"Retry-After": "2"}))
+    assert not lease.failed
+    assert all(b.state == balancer_utils.CLOSED for b in balancer.backends)
+
+
+def test_half_open_probe_closes_breaker(monkeypatch):
+    balancer = LoadBalancer(
+        ["http://chat1"], failure_threshold=1, open_timeout=10, health_interval=0
+    )
+    clock = [100.0]
+    monkeypatch.setattr(balancer_utils.time, "monotonic", lambda: clock[0])
+    with pytest.raises(RuntimeError):
+        with balancer.lease():
+            raise RuntimeError("connection reset")
+    with pytest.raises(NoAvailableBackend):
+        balancer.lease()
+    clock[0] += 10
+    probe = balancer.lease()
+    assert probe.backend.state == balancer_utils.HALF_OPEN
+    # Only one probe at a time while half-open
+    with pytest.raises(NoAvailableBackend):
+        balancer.lease()
+    probe.release()
+    assert probe.backend.state == balancer_utils.CLOSED
+    assert balancer.snapshot()[0]["last_error"] == "connection reset"
+
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    balancer = LoadBalancer(
+        ["http://chat1"], failure_threshold=3, open_timeout=10, health_interval=0
+    )
+    backend = balancer.backends[0]
+    backend.state = balancer_utils.OPEN
+    backend.opened_at = balancer_utils.time.monotonic() - 10
+    probe = balancer.lease()
+    probe.fail("timeout")
+    probe.release()
+    assert backend.state == balancer_utils.OPEN
+
+
+def test_active_health_check(monkeypatch):
+    balancer = make_balancer()
+
+    def fake_get(url, timeout=None):
+        if url.startswith("http://chat1"):
+            raise ConnectionError("refused")
+        return DummyResponse(200)
+
+    monkeypatch.setattr(balancer_utils.upstream_utils, "get", fake_get)
+    balancer.check_health()
+    snapshot = {b["url"]: b for b in balancer.snapshot()}
+    assert snapshot["http://chat1"]["healthy"] is False
+    assert snapshot["http://chat2"]["healthy"] is True
+    for _ in range(5):
+        with balancer.lease() as lease:
+            assert lease.url == "http://chat2"
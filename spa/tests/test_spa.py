@@ -1,6 +1,8 @@
 import json
+import threading
 import pytest
-from ..SPA import app as spa_app
+from ..SPA import app as spa_app, balancer
+from utils.balancer_utils import Backend
 
 
 # Define a dummy object to simulate the response from requests
@@ -37,7 +39,7 @@ def test_login_success(client_spa, monkeypatch):
             {"message": "Login successful", "token": "dummy_token"}, 200
         )
 
-    monkeypatch.setattr("SPA.requests.post", fake_post)
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
     data = {"username": "user", "password": "pass"}
     response = client_spa.post("/api/login", json=data)
     result = response.get_json()
@@ -51,7 +53,7 @@ def test_login_invalid_json_response(client_spa, monkeypatch):
         # Simulate the returned content is not valid JSON
         raise Exception("JSONDecodeError")
 
-    monkeypatch.setattr("SPA.requests.post", fake_post)
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
     data = {"username": "user", "password": "pass"}
     response = client_spa.post("/api/login", json=data)
     result = response.get_json()
@@ -64,7 +66,7 @@ def test_login_service_unreachable(client_spa, monkeypatch):
     def fake_post(url, json):
         raise Exception("Service down")
 
-    monkeypatch.setattr("SPA.requests.post", fake_post)
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
     data = {"username": "user", "password": "pass"}
     response = client_spa.post("/api/login", json=data)
     result = response.get_json()
@@ -77,7 +79,7 @@ def test_register_success(client_spa, monkeypatch):
     def fake_post(url, json):
         return DummyResponse({"message": "Register successful", "user_id": 123}, 200)
 
-    monkeypatch.setattr("SPA.requests.post", fake_post)
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
     data = {"username": "newuser", "password": "newpass"}
     response = client_spa.post("/api/register", json=data)
     result = response.get_json()
@@ -89,9 +91,323 @@ def test_register_invalid_json(client_spa, monkeypatch):
     def fake_post(url, json):
         raise Exception("JSONDecodeError")
 
-    monkeypatch.setattr("SPA.requests.post", fake_post)
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
     data = {"username": "newuser", "password": "newpass"}
     response = client_spa.post("/api/register", json=data)
     result = response.get_json()
     # Adjusted expected status code from 500 to 400
     assert response.status_code == 400
+
+
+# Simulate a streaming chat service reply that blocks until the test releases it
+class DummyStreamResponse:
+    def __init__(self, chunks, release):
+        self.chunks = chunks
+        self.release = release
+        self.status_code = 200
+        self.headers = {"Content-Type": "text/plain;charset=utf-8"}
+        self.finished = False
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        yield self.chunks[0]
+        self.release.wait(timeout=5)
+        for chunk in self.chunks[1:]:
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_send_message_streams_first_chunk(client_spa, monkeypatch):
+    release = threading.Event()
+    upstream = DummyStreamResponse([b"Hello", b", ", b"world"], release)
+
+    def fake_post(url, headers=None, json=None, stream=False):
+        assert stream is True
+        return upstream
+
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
+    response = client_spa.post(
+        "/api/send_message",
+        headers={"Authorization": "Bearer dummy_token"},
+        json={"message": "Hi", "chat_name": "Test Chat"},
+    )
+    chunks = response.iter_encoded()
+    # The first chunk reaches the client while the upstream is still generating
+    assert next(chunks) == b"Hello"
+    assert not upstream.finished
+    release.set()
+    assert b"".join(chunks) == b", world"
+    assert upstream.finished
+    response.close()
+    assert upstream.closed
+
+
+def test_send_message_client_disconnect_closes_upstream(client_spa, monkeypatch):
+    release = threading.Event()
+    upstream = DummyStreamResponse([b"Hello", b"never sent"], release)
+
+    def fake_post(url, headers=None, json=None, stream=False):
+        return upstream
+
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
+    response = client_spa.post(
+        "/api/send_message",
+        headers={"Authorization": "Bearer dummy_token"},
+        json={"message": "Hi", "chat_name": "Test Chat"},
+    )
+    assert next(response.iter_encoded()) == b"Hello"
+    # The browser goes away before the reply is complete
+    response.close()
+    assert upstream.closed
+    assert not upstream.finished
+
+
+def test_send_message_relays_retry_after(client_spa, monkeypatch):
+    done = threading.Event()
+    done.set()
+    upstream = DummyStreamResponse([b'{"message": "Too many requests"}'], done)
+    upstream.status_code = 429
+    upstream.headers = {"Content-Type": "application/json", "Retry-After": "3"}
+    monkeypatch.setattr("SPA.upstream_utils.post", lambda url, **kwargs: upstream)
+    response = client_spa.post(
+        "/api/send_message",
+        headers={"Authorization": "Bearer dummy_token"},
+        json={"message": "Hi", "chat_name": "Test Chat"},
+    )
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert response.get_json() == {"message": "Too many requests"}
+
+
+def test_backends_state(client_spa):
+    response = client_spa.get("/api/backends")
+    result = response.get_json()
+    assert response.status_code == 200
+    assert {"url", "state", "in_flight", "healthy"} <= set(result["backends"][0])
+
+
+def test_chat_list_no_available_backend(client_spa, monkeypatch):
+    for backend in balancer.backends:
+        monkeypatch.setattr(backend, "healthy", False)
+    response = client_spa.get(
+        "/api/chat_list", headers={"Authorization": "Bearer dummy_token"}
+    )
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_chat_history_forwards_page_params(client_spa, monkeypatch):
+    captured = {}
+
+    def fake_get(url, headers=None, params=None):
+        captured.update(params)
+        return DummyResponse({"messages": [], "total": 0}, 200)
+
+    monkeypatch.setattr("SPA.upstream_utils.get", fake_get)
+    response = client_spa.get(
+        "/api/chat_history?chat_name=Chat&limit=20&before=40",
+        headers={"Authorization": "Bearer dummy_token"},
+    )
+    assert response.status_code == 200
+    assert captured == {"chat_name": "Chat", "limit": "20", "before": "40"}
+
+
+def test_search_forwards_query(client_spa, monkeypatch):
+    captured = {}
+
+    def fake_get(url, headers=None, params=None):
+        captured.update(url=url, params=params)
+        return DummyResponse({"query": "otters", "results": []}, 200)
+
+    monkeypatch.setattr("SPA.upstream_utils.get", fake_get)
+    response = client_spa.get(
+        "/api/search?q=otters&limit=5&other=1",
+        headers={"Authorization": "Bearer dummy_token"},
+    )
+    assert response.status_code == 200
+    assert response.get_json() == {"query": "otters", "results": []}
+    assert captured["url"].endswith("/search")
+    assert captured["params"] == {"q": "otters", "limit": "5"}
+    assert client_spa.get("/api/search?q=otters").status_code == 401
+
+
+def test_chat_history_passes_validation_headers(client_spa, monkeypatch):
+    captured = {}
+
+    class NotModifiedResponse:
+        status_code = 304
+        content = b""
+        headers = {"ETag": 'W/"abc"', "Cache-Control": "private, no-cache"}
+
+    def fake_get(url, headers=None, params=None):
+        captured.update(headers)
+        return NotModifiedResponse()
+
+    monkeypatch.setattr("SPA.upstream_utils.get", fake_get)
+    response = client_spa.get(
+        "/api/chat_history?chat_name=Chat&since=3",
+        headers={"Authorization": "Bearer dummy_token", "If-None-Match": 'W/"abc"'},
+    )
+    assert captured["If-None-Match"] == 'W/"abc"'
+    assert response.status_code == 304
+    assert response.headers["ETag"] == 'W/"abc"'
+
+
+def test_metrics_stream_gauge_and_upstream_latency(client_spa, monkeypatch):
+    from prometheus_client import REGISTRY
+
+    def value(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    release = threading.Event()
+    upstream = DummyStreamResponse([b"Hello", b", world"], release)
+    monkeypatch.setattr("SPA.upstream_utils.post", lambda url, **kwargs: upstream)
+    response = client_spa.post(
+        "/api/send_message",
+        headers={"Authorization": "Bearer dummy_token"},
+        json={"message": "Hi", "chat_name": "Test Chat"},
+    )
+    url = balancer.backends[0].url
+    count = value("gateway_upstream_seconds_count", backend=url)
+    assert next(response.iter_encoded()) == b"Hello"
+    assert value("gateway_streams_in_flight") == 1
+    release.set()
+    response.close()
+    assert value("gateway_streams_in_flight") == 0
+    assert value("gateway_upstream_seconds_count", backend=url) == count + 1
+
+    body = client_spa.get("/metrics").get_data(as_text=True)
+    assert f'gateway_upstream_seconds_count{{backend="{url}"}}' in body
+
+
+def test_resume_stream_goes_to_the_backend_of_the_stream(client_spa, monkeypatch):
+    done = threading.Event()
+    done.set()
+    upstream = DummyStreamResponse([b"Hello"], done)
+    upstream.headers = {"Content-Type": "text/plain", "X-Stream-Id": "abc"}
+    monkeypatch.setattr("SPA.upstream_utils.post", lambda url, **kwargs: upstream)
+    response = client_spa.post(
+        "/api/send_message",
+        headers={"Authorization": "Bearer dummy_token"},
+        json={"message": "Hi", "chat_name": "Test Chat"},
+    )
+    stream_id = response.headers["X-Stream-Id"]
+    index, _, chat_stream_id = stream_id.partition(".")
+    index = int(index)
+    assert chat_stream_id == "abc" and index < len(balancer.backends)
+    response.close()
+
+    captured = {}
+
+    def fake_get(url, headers=None, params=None, stream=False):
+        captured.update(url=url, params=dict(params), stream=stream)
+        resumed = DummyStreamResponse([b"lo"], done)
+        resumed.headers = {"Content-Type": "text/plain", "X-Stream-Id": "abc"}
+        return resumed
+
+    monkeypatch.setattr("SPA.upstream_utils.get", fake_get)
+    response = client_spa.get(
+        f"/api/stream/{stream_id}?offset=3",
+        headers={"Authorization": "Bearer dummy_token"},
+    )
+    assert response.data == b"lo"
+    assert response.headers["X-Stream-Id"] == stream_id
+    assert captured == {
+        "url": f"{balancer.backends[index].url}/stream/abc",
+        "params": {"offset": "3"},
+        "stream": True,
+    }
+    for malformed in ("abc", "99.abc", "0."):
+        response = client_spa.get(
+            f"/api/stream/{malformed}", headers={"Authorization": "Bearer t"}
+        )
+        assert response.status_code == 404
+
+
+def test_export_and_import_are_streamed(client_spa, monkeypatch):
+    done = threading.Event()
+    done.set()
+    upstream = DummyStreamResponse(
+        [b'{"type": "export"}\n', b'{"type": "chat"}\n'], done
+    )
+    upstream.headers = {"Content-Type": "application/x-ndjson"}
+    monkeypatch.setattr("SPA.upstream_utils.get", lambda url, **kwargs: upstream)
+    headers = {"Authorization": "Bearer dummy_token"}
+    response = client_spa.get("/api/export", headers=headers)
+    assert response.mimetype == "application/x-ndjson"
+    assert response.data == b'{"type": "export"}\n{"type": "chat"}\n'
+    assert upstream.closed
+
+    captured = {}
+
+    def fake_post(url, headers=None, params=None, data=None, timeout=None):
+        # The body is handed over as an iterator of chunks, not read up front
+        captured.update(url=url, params=dict(params), body=b"".join(data))
+        return DummyResponse({"chats": 1}, 200)
+
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
+    monkeypatch.setattr("SPA.IMPORT_CHUNK_SIZE", 4)
+    response = client_spa.post(
+        "/api/import?resume_from=Chat", headers=headers, data=b"line 1\nline 2\n"
+    )
+    assert response.get_json() == {"chats": 1}
+    assert captured["url"].endswith("/import")
+    assert captured["params"] == {"resume_from": "Chat"}
+    assert captured["body"] == b"line 1\nline 2\n"
+    assert client_spa.post("/api/import", data=b"").status_code == 401
+
+
+def test_send_message_keeps_an_idempotency_key_on_one_backend(client_spa, monkeypatch):
+    # Two distinct backends (the default URLs are one and the same)
+    monkeypatch.setattr(
+        balancer,
+        "backends",
+        [Backend("http://chat-a:5002"), Backend("http://chat-b:5002")],
+    )
+    done = threading.Event()
+    done.set()
+    captured = []
+
+    def fake_post(url, headers=None, **kwargs):
+        captured.append((url, headers.get("Idempotency-Key")))
+        upstream = DummyStreamResponse([b"Hello"], done)
+        upstream.headers = {"Content-Type": "text/plain", "Idempotent-Replayed": "true"}
+        return upstream
+
+    monkeypatch.setattr("SPA.upstream_utils.post", fake_post)
+
+    def send(key):
+        headers = {"Authorization": "Bearer dummy_token", "Idempotency-Key": key}
+        response = client_spa.post(
+            "/api/send_message", headers=headers, json={"message": "Hi"}
+        )
+        assert response.headers["Idempotent-Replayed"] == "true"
+        response.close()
+        return captured[-1]
+
+    # Every retry of a key goes to the same backend
+    assert len({send("k1") for _ in range(5)}) == 1
+    assert captured[0][1] == "k1"
+    # Other keys are spread over both backends
+    backends = {send(f"key-{i}")[0].rsplit("/", 1)[0] for i in range(20)}
+    assert backends == {"http://chat-a:5002", "http://chat-b:5002"}
+
+
+def test_usage_forwards_days(client_spa, monkeypatch):
+    captured = {}
+
+    def fake_get(url, headers=None, params=None):
+        captured.update(url=url, params=params)
+        return DummyResponse({"total": {"requests": 1}}, 200)
+
+    monkeypatch.setattr("SPA.upstream_utils.get", fake_get)
+    response = client_spa.get(
+        "/api/usage?days=7", headers={"Authorization": "Bearer dummy_token"}
+    )
+    assert response.get_json() == {"total": {"requests": 1}}
+    assert captured["url"].endswith("/usage")
+    assert captured["params"] == {"days": "7"}
+    assert client_spa.get("/api/usage").status_code == 401
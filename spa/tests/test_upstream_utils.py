@@ -0,0 +1,45 @@
+from utils import upstream_utils
+
+
+def test_session_reused_per_upstream():
+    first = upstream_utils.get_session("http://chat1:5002/chat_list")
+    second = upstream_utils.get_session("http://chat1:5002/chat_history?chat_name=a")
+    other = upstream_utils.get_session("http://chat2:5002/chat_list")
+    assert first is second
+    assert first is not other
+
+
+def test_sessions_recreated_after_fork(monkeypatch):
+    before = upstream_utils.get_session("http://auth:5000/login")
+    # Simulate a new gunicorn worker process
+    monkeypatch.setattr(upstream_utils, "_sessions_pid", -1)
+    after = upstream_utils.get_session("http://auth:5000/login")
+    assert before is not after
+
+
+def test_pool_and_retry_config():
+    session = upstream_utils.get_session("http://chat1:5002")
+    adapter = session.get_adapter("http://chat1:5002/chat_list")
+    assert adapter._pool_maxsize == upstream_utils.POOL_MAXSIZE
+    retry = adapter.max_retries
+    assert retry.total == upstream_utils.GET_RETRIES
+    # Only idempotent requests are retried after they were sent
+    assert retry.is_retry("GET", 503)
+    assert not retry.is_retry("POST", 503)
+
+
+def test_default_timeouts(monkeypatch):
+    calls = []
+
+    class FakeSession:
+        def post(self, url, **kwargs):
+            calls.append(kwargs)
+
+    monkeypatch.setattr(upstream_utils, "get_session", lambda url: FakeSession())
+    upstream_utils.post("http://chat1:5002/start_chat", json={})
+    upstream_utils.post("http://chat1:5002/send_message", json={}, stream=True)
+    assert calls[0]["timeout"] == (
+        upstream_utils.CONNECT_TIMEOUT,
+        upstream_utils.READ_TIMEOUT,
+    )
+    assert calls[1]["timeout"][1] == upstream_utils.STREAM_READ_TIMEOUT
@@ -0,0 +1,223 @@
+# utils/balancer_utils.py
+import os
+import random
+import threading
+import time
+
+from utils import metrics_utils, upstream_utils
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class NoAvailableBackend(Exception):
+    """Raised when every chat backend is ejected or unhealthy."""
+
+
+class Backend:
+    """Routing state of a single chat service backend."""
+
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.state = CLOSED
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.total_requests = 0
+        self.total_failures = 0
+        self.latency_ewma = None
+        self.last_error = None
+        self.last_health_check = None
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "state": self.state,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "latency_ewma_ms": (
+                None if self.latency_ewma is None else round(self.latency_ewma, 2)
+            ),
+            "last_error": self.last_error,
+            "last_health_check": self.last_health_check,
+        }
+
+
+class Lease:
+    """
+    One request routed to a backend. Released exactly once, either by leaving the
+    `with` block or by calling `release()` when a streamed response finishes.
+    """
+
+    def __init__(self, balancer, backend):
+        self.balancer = balancer
+        self.backend = backend
+        self.url = backend.url
+        self.started = time.monotonic()
+        self.failed = False
+        self.error = None
+        self.released = False
+
+    def check(self, response):
+        # A 5xx reply counts as a backend failure, 4xx is the client's problem.
+        # A 503 with Retry-After is a live backend shedding load, not a failure.
+        shedding = response.status_code == 503 and "Retry-After" in response.headers
+        if response.status_code >= 500 and not shedding:
+            self.fail(f"HTTP {response.status_code}")
+        return response
+
+    def fail(self, error=None):
+        self.failed = True
+        self.error = error
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.balancer.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.fail(str(exc))
+        self.release()
+        return False
+
+
+class LoadBalancer:
+    """
+    Least-outstanding-requests balancer over the chat service backends.
+
+    Backends are ejected passively after `failure_threshold` consecutive failures
+    and re-admitted through a single half-open probe once `open_timeout` seconds
+    have passed. A background thread also polls each backend's /health.
+    """
+
+    def __init__(
+        self,
+        urls,
+        failure_threshold=3,
+        open_timeout=10.0,
+        health_interval=5.0,
+        health_timeout=2.0,
+    ):
+        # The same URL listed twice is still one backend
+        self.backends = [Backend(url) for url in dict.fromkeys(urls)]
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._health_pid = None
+
+    def _is_available(self, backend, now):
+        if not backend.healthy:
+            return False
+        if backend.state == CLOSED:
+            return True
+        if backend.state == OPEN and now - backend.opened_at >= self.open_timeout:
+            backend.state = HALF_OPEN
+        return backend.state == HALF_OPEN and not backend.probe_in_flight
+
+    def lease(self, url=None):
+        """
+        Route a request to the least loaded available backend, or to the
+        backend at `url` for requests tied to it (e.g. resuming a stream).
+
+        Raises:
+            NoAvailableBackend: If every backend (or the one at `url`) is
+                ejected or unhealthy.
+        """
+        self.ensure_health_checks()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                b
+                for b in self.backends
+                if (url is None or b.url == url) and self._is_available(b, now)
+            ]
+            if not candidates:
+                raise NoAvailableBackend("No healthy chat service available")
+            fewest = min(b.in_flight for b in candidates)
+            backend = random.choice([b for b in candidates if b.in_flight == fewest])
+            if backend.state == HALF_OPEN:
+                backend.probe_in_flight = True
+            backend.in_flight += 1
+            backend.total_requests += 1
+        return Lease(self, backend)
+
+    def release(self, lease):
+        backend = lease.backend
+        elapsed_ms = (time.monotonic() - lease.started) * 1000
+        metrics_utils.upstream_seconds.labels(backend.url).observe(elapsed_ms / 1000)
+        if lease.failed:
+            metrics_utils.upstream_errors.labels(backend.url).inc()
+        with self._lock:
+            backend.in_flight -= 1
+            backend.probe_in_flight = False
+            if backend.latency_ewma is None:
+                backend.latency_ewma = elapsed_ms
+            else:
+                backend.latency_ewma = 0.8 * backend.latency_ewma + 0.2 * elapsed_ms
+            if lease.failed:
+                backend.total_failures += 1
+                backend.consecutive_failures += 1
+                backend.last_error = lease.error
+                if (
+                    backend.state == HALF_OPEN
+                    or backend.consecutive_failures >= self.failure_threshold
+                ):
+                    backend.state = OPEN
+                    backend.opened_at = time.monotonic()
+            else:
+                backend.consecutive_failures = 0
+                backend.state = CLOSED
+
+    def check_health(self):
+        """Poll /health on every backend once."""
+        for backend in self.backends:
+            try:
+                response = upstream_utils.get(
+                    f"{backend.url}/health",
+                    timeout=(self.health_timeout, self.health_timeout),
+                )
+                healthy = response.status_code == 200
+                error = None if healthy else f"health HTTP {response.status_code}"
+            except Exception as e:
+                healthy, error = False, str(e)
+            with self._lock:
+                backend.healthy = healthy
+                backend.last_health_check = time.time()
+                if error:
+                    backend.last_error = error
+                elif backend.state == OPEN:
+                    # The backend answers again, let the next request probe it
+                    backend.state = HALF_OPEN
+
+    def _health_loop(self):
+        while True:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def ensure_health_checks(self):
+        """Start the health polling thread once per (forked) worker process."""
+        if self.health_interval <= 0 or self._health_pid == os.getpid():
+            return
+        with self._lock:
+            if self._health_pid == os.getpid():
+                return
+            self._health_pid = os.getpid()
+        threading.Thread(target=self._health_loop, daemon=True).start()
+
+    def snapshot(self):
+        """Per-backend routing state, for debugging why traffic moved."""
+        with self._lock:
+            return [backend.to_dict() for backend in self.backends]
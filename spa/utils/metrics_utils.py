@@ -0,0 +1,47 @@
+# utils/metrics_utils.py
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# With PROMETHEUS_MULTIPROC_DIR set, every gunicorn worker writes its samples to
+# files in that directory and /metrics sums them over the workers (see
+# gunicorn.conf.py). Without it the metrics are those of the current process.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+upstream_seconds = Histogram(
+    "gateway_upstream_seconds",
+    "Time a request held a chat backend, streamed replies until their end",
+    ["backend"],
+    buckets=LATENCY_BUCKETS,
+)
+upstream_errors = Counter(
+    "gateway_upstream_errors",
+    "Requests that failed on a chat backend",
+    ["backend"],
+)
+streams_in_flight = Gauge(
+    "gateway_streams_in_flight",
+    "Replies currently streamed from a chat backend to a browser",
+    multiprocess_mode="livesum",
+)
+
+
+def metrics_response():
+    """(body, content type) of the /metrics endpoint."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,101 @@
+# utils/upstream_utils.py
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connection pool config, shared by every upstream (auth service, chat services)
+POOL_CONNECTIONS = int(os.environ.get("UPSTREAM_POOL_CONNECTIONS", "4"))
+POOL_MAXSIZE = int(os.environ.get("UPSTREAM_POOL_MAXSIZE", "32"))
+KEEP_ALIVE = os.environ.get("UPSTREAM_KEEP_ALIVE", "true").lower() == "true"
+CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", "30"))
+# Streaming replies may wait a long time for the first token
+STREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_STREAM_READ_TIMEOUT", "300"))
+GET_RETRIES = int(os.environ.get("UPSTREAM_GET_RETRIES", "2"))
+RETRY_BACKOFF = float(os.environ.get("UPSTREAM_RETRY_BACKOFF", "0.1"))
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+def build_retry():
+    """
+    Retry policy for upstream calls.
+
+    Only idempotent methods are retried on read errors and 502/503/504. A failed
+    connect is retried for any method, since the request never reached the upstream.
+    """
+    return Retry(
+        total=GET_RETRIES,
+        connect=GET_RETRIES,
+        read=GET_RETRIES,
+        status=GET_RETRIES,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        raise_on_status=False,
+    )
+
+
+def create_session():
+    """
+    Create a requests session backed by a keep-alive connection pool.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=build_retry(),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not KEEP_ALIVE:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_session(url):
+    """
+    Return the pooled session for the upstream (scheme://host:port) of a URL.
+
+    Sessions are created lazily once per process, so each gunicorn worker owns its
+    pools and never shares sockets inherited from the master across a fork.
+    """
+    global _sessions_pid
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}"
+    with _lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(key)
+        if session is None:
+            session = create_session()
+            _sessions[key] = session
+        return session
+
+
+def default_timeout(stream=False):
+    return (CONNECT_TIMEOUT, STREAM_READ_TIMEOUT if stream else READ_TIMEOUT)
+
+
+def get(url, **kwargs):
+    """
+    Send a GET request to an upstream over its pooled connection.
+    """
+    kwargs.setdefault("timeout", default_timeout(kwargs.get("stream", False)))
+    return get_session(url).get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    """
+    Send a POST request to an upstream over its pooled connection. POSTs are not
+    retried once sent.
+    """
+    kwargs.setdefault("timeout", default_timeout(kwargs.get("stream", False)))
+    return get_session(url).post(url, **kwargs)